@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core low-pass filtering and downsampling of raw recordings
+
+The channels of a raw (non preloaded) mne Raw are read by blocks of time
+points, each block being extended on both sides by a padding long enough
+to cover the impulse response of the filter. Every padded block is
+low-pass filtered (zero-phase FIR, designed as mne 'firwin' filters with
+the default transition bandwidth) and resampled with a polyphase filter
+(scipy.signal.resample_poly, rational factor down_sfreq / sfreq), and only
+its central part is written to a memory-mapped .npy file.
+
+When resampling, the low-pass filter is fused with the anti-alias filter
+of the polyphase resampling: a single FIR, designed at the upsampled rate,
+is applied only at the output samples (cost proportional to the number of
+time points, whatever their number, instead of the FFT of the whole
+recording of mne resample). resample_polyphase and resample_raw_polyphase
+apply the same filter to in-memory recordings.
+
+Blocks start on multiples of the decimation factor, so that the output
+samples of each block fall exactly on the output grid of the whole
+recording: away from the edges of the recording, the result is identical
+to filtering and resampling the whole recording at once. At the edges of
+the recording, the signal is extended by reflection (as the
+'reflect_limited' padding of mne filters).
+
+Peak memory is a few padded blocks, the number of time points per block
+being bounded by spectral_engine.max_block_bytes.
+"""
+from fractions import Fraction
+
+import numpy as np
+
+from scipy.signal import fftconvolve, firwin, resample_poly
+
+from neuropype_ephy import spectral_engine
+
+
+def design_lowpass_fir(h_freq, sfreq, max_freq=None):
+    """
+    Coefficients of a zero-phase low-pass FIR filter (odd length, hamming
+    window), with the transition bandwidth and length of mne 'auto' filters
+
+    max_freq: upper bound of the transition band (Nyquist frequency of
+    sfreq by default)
+    """
+    if max_freq is None:
+        max_freq = sfreq / 2.
+
+    trans_bandwidth = min(max(0.25 * h_freq, 2.), max_freq - h_freq)
+
+    if trans_bandwidth <= 0.:
+        raise ValueError('h_freq ({}) should be below the Nyquist frequency '
+                         '({})'.format(h_freq, max_freq))
+
+    n_taps = int(np.ceil(3.3 * sfreq / trans_bandwidth))
+    n_taps += 1 - n_taps % 2
+
+    return firwin(n_taps, h_freq + trans_bandwidth / 2., window='hamming',
+                  fs=sfreq)
+
+
+def get_resample_factors(sfreq, down_sfreq):
+    """ Upsampling and downsampling factors (up, down) of down_sfreq / sfreq """
+    if down_sfreq is None:
+        return 1, 1
+
+    ratio = Fraction(float(down_sfreq) / float(sfreq)).limit_denominator(1000)
+
+    return ratio.numerator, ratio.denominator
+
+
+def design_filter(sfreq, h_freq, up=1, down=1):
+    """
+    FIR coefficients of the low-pass filter at h_freq (None for no
+    low-pass), fused with the anti-alias filter when resampling by up / down
+    (designed at the upsampled rate sfreq * up)
+
+    Returns None when no filter is needed, or when h_freq is above the
+    Nyquist frequency of the output (default resample_poly filter)
+    """
+    if (up, down) == (1, 1):
+        return None if h_freq is None else design_lowpass_fir(h_freq, sfreq)
+
+    nyquist = min(sfreq, sfreq * up / float(down)) / 2.
+
+    if h_freq is None or h_freq >= nyquist:
+        return None
+
+    return design_lowpass_fir(h_freq, sfreq * up, max_freq=nyquist)
+
+
+def _get_block_padding(fir_coefs, up, down):
+    """ Padding (time points, multiple of down) covering the filter """
+    if (up, down) == (1, 1):
+        pad = 0 if fir_coefs is None else (len(fir_coefs) - 1) // 2
+    else:
+        # half length of the filter (by default, the resample_poly one)
+        half_len = 10 * max(up, down) if fir_coefs is None \
+            else (len(fir_coefs) - 1) // 2
+        pad = int(np.ceil(half_len / float(up))) + 1
+
+    return int(np.ceil(pad / float(down))) * down
+
+
+def _filter_block(block, fir_coefs, up, down):
+    if (up, down) != (1, 1):
+        window = ('kaiser', 5.0) if fir_coefs is None else fir_coefs
+        return resample_poly(block, up, down, axis=-1, window=window)
+
+    if fir_coefs is not None:
+        block = fftconvolve(block, fir_coefs[np.newaxis, :], mode='same',
+                            axes=-1)
+
+    return block
+
+
+def resample_polyphase(data, sfreq, down_sfreq, h_freq=None):
+    """
+    Low-pass filter (h_freq, None for the anti-alias filter only) and
+    resample data (n_channels * n_times) from sfreq to down_sfreq with a
+    single fused polyphase filter, the edges being extended by odd reflection
+
+    Returns the resampled data and its sampling frequency
+    """
+    up, down = get_resample_factors(sfreq, down_sfreq)
+
+    fir_coefs = design_filter(sfreq, h_freq, up, down)
+
+    pad = _get_block_padding(fir_coefs, up, down)
+
+    n_times = data.shape[-1]
+    n_output_times = -(-n_times * up // down)
+
+    if pad:
+        data = np.pad(data, ((0, 0), (pad, pad)), mode='reflect',
+                      reflect_type='odd')
+
+    data = _filter_block(data, fir_coefs, up, down)
+
+    out_pad = pad * up // down
+
+    return data[:, out_pad:out_pad + n_output_times], float(sfreq) * up / down
+
+
+def resample_raw_polyphase(raw, down_sfreq, h_freq=None):
+    """
+    New RawArray with all the channels of the preloaded raw resampled by
+    resample_polyphase (low-pass at h_freq fused with the anti-alias filter)
+
+    As in mne Raw.resample, stim channels are not filtered but decimated
+    (first non-zero value of each output sample), and the annotations of
+    raw are kept
+    """
+    import mne
+    from mne.filter import _resample_stim_channels
+
+    up, down = get_resample_factors(raw.info['sfreq'], down_sfreq)
+
+    stim_picks = mne.pick_types(raw.info, meg=False, ref_meg=False,
+                                stim=True, exclude=[])
+    data_picks = np.setdiff1d(np.arange(raw.info['nchan']), stim_picks)
+
+    n_output_times = -(-raw.n_times * up // down)
+    sfreq = float(raw.info['sfreq']) * up / down
+
+    data = np.zeros((raw.info['nchan'], n_output_times))
+
+    if len(data_picks):
+        data[data_picks] = resample_polyphase(
+            raw.get_data(picks=data_picks), raw.info['sfreq'], down_sfreq,
+            h_freq)[0]
+
+    if len(stim_picks):
+        data[stim_picks] = _resample_stim_channels(
+            raw.get_data(picks=stim_picks), n_output_times, raw.n_times)
+
+    info = raw.info.copy()
+    info['sfreq'] = sfreq
+    info['lowpass'] = min([info['lowpass'], sfreq / 2.] +
+                          ([] if h_freq is None else [h_freq]))
+
+    new_raw = mne.io.RawArray(data, info,
+                              first_samp=raw.first_samp * up // down,
+                              verbose=False)
+    new_raw.set_annotations(raw.annotations)
+
+    return new_raw
+
+
+def _read_padded_block(read_fun, n_times, start, stop, pad):
+    """
+    Time points start - pad to stop + pad of the recording, extended by
+    reflection beyond its edges
+    """
+    read_start = max(start - pad, 0)
+    read_stop = min(stop + pad, n_times)
+
+    block = read_fun(read_start, read_stop)
+
+    pad_before = read_start - (start - pad)
+    pad_after = (stop + pad) - read_stop
+
+    if pad_before or pad_after:
+        block = np.pad(block, ((0, 0), (pad_before, pad_after)),
+                       mode='reflect', reflect_type='odd')
+
+    return block
+
+
+def filter_resample_to_npy(read_fun, n_channels, n_times, sfreq, ts_file,
+                           h_freq=None, down_sfreq=None, dtype='float64'):
+    """
+    Low-pass filter (h_freq, None for no filtering) and resample (down_sfreq,
+    None to keep sfreq) a recording read by blocks, into the memory-mapped
+    .npy ts_file (n_channels * n_output_times, of dtype)
+
+    read_fun(start, stop): function returning the time points start to stop
+    of the n_channels of the recording (n_times time points at sfreq)
+
+    Returns ts_file and the sampling frequency of the saved time series
+    """
+    up, down = get_resample_factors(sfreq, down_sfreq)
+
+    fir_coefs = design_filter(sfreq, h_freq, up, down)
+
+    pad = _get_block_padding(fir_coefs, up, down)
+
+    block_times = spectral_engine.max_block_bytes // (8 * n_channels * up)
+    block_times = max(block_times // down, 1) * down
+
+    n_output_times = -(-n_times * up // down)
+
+    ts = np.lib.format.open_memmap(ts_file, mode='w+', dtype=dtype,
+                                   shape=(n_channels, n_output_times))
+
+    for start in range(0, n_times, block_times):
+
+        stop = min(start + block_times, n_times)
+
+        block = _read_padded_block(read_fun, n_times, start, stop, pad)
+
+        block = _filter_block(block, fir_coefs, up, down)
+
+        out_start = start * up // down
+        out_stop = min(-(-stop * up // down), n_output_times)
+        out_pad = pad * up // down
+
+        ts[:, out_start:out_stop] = \
+            block[:, out_pad:out_pad + out_stop - out_start]
+
+    ts.flush()
+    del ts
+
+    return ts_file, float(sfreq) * up / down
+
+
+def filter_resample_raw_to_npy(raw, picks, ts_file, h_freq=None,
+                               down_sfreq=None, dtype='float64'):
+    """
+    filter_resample_to_npy of the channels picks of a raw mne Raw, read
+    from disk by blocks (raw does not need to be preloaded)
+    """
+    def read_fun(start, stop):
+        return raw[picks, start:stop][0]
+
+    return filter_resample_to_npy(read_fun, len(picks), raw.n_times,
+                                  raw.info['sfreq'], ts_file, h_freq=h_freq,
+                                  down_sfreq=down_sfreq, dtype=dtype)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of cross-spectral sums
+
+The sums over epochs of the cross-spectral densities (and of the other
+per-epoch quantities needed by the metrics, see spectral_engine) are stored
+per frequency in memory-mapped .npy files, in one directory per entry.
+Entries are keyed by a hash of the ts_file contents and of the parameters
+of the spectral transform (sfreq, mode, epoching), so that rerunning a
+pipeline with another con_method, or with bands inside an already computed
+frequency range, is served by a reduction of the cached sums instead of a
+new spectral transform.
+
+Entries are removed in least recently used order when the total size of
+the cache exceeds max_cache_bytes.
+
+Entries are written in temporary directories renamed into place, and the
+sums of an entry removed or replaced while being read are computed again,
+so that several processes can share the cache directory; the sums just
+computed are used from memory, whether they could be written or not.
+
+The cache is opt-in: its directory is given to cached_spectral_connectivity,
+or set by the NEUROPYPE_EPHY_CSD_CACHE_DIR environment variable (cache_dir,
+None when it is not defined).
+"""
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+from neuropype_ephy.spectral_engine import (_method_accumulators,
+                                            average_con_bands,
+                                            compute_con_from_accumulators,
+                                            compute_stream_accumulators,
+                                            con_methods_numpy,
+                                            get_band_freq_mask)
+
+# default directory of the cache entries (None: no cache)
+cache_dir = os.environ.get('NEUROPYPE_EPHY_CSD_CACHE_DIR')
+
+max_cache_bytes = 2 * 1024 ** 3
+
+_hash_block_bytes = 2 ** 24
+
+
+def get_csd_cache_key(ts_file, sfreq, mode='multitaper',
+                      epoch_window_length=None, dtype='float64',
+                      epoch_overlap=0.):
+    """
+    Key of the cache entry of ts_file: hash of the file contents and of the
+    parameters of the spectral transform (including the precision of the
+    cached sums, and the overlap of the epochs when they overlap, so that
+    the keys of contiguous epochs are unchanged)
+    """
+    sha = hashlib.sha1()
+
+    with open(ts_file, 'rb') as f:
+        block = f.read(_hash_block_bytes)
+        while block:
+            sha.update(block)
+            block = f.read(_hash_block_bytes)
+
+    params = (float(sfreq), mode, epoch_window_length, np.dtype(dtype).name)
+    if epoch_overlap:
+        params += (float(epoch_overlap),)
+
+    sha.update(repr(params).encode())
+
+    return sha.hexdigest()
+
+
+def _entry_stats(entry_dir):
+    """
+    Last access time and size of an entry, None if it was removed (or is
+    being replaced) by another process
+    """
+    try:
+        mtime = os.path.getmtime(os.path.join(entry_dir, 'meta.json'))
+        size = sum(os.path.getsize(os.path.join(entry_dir, fname))
+                   for fname in os.listdir(entry_dir))
+    except OSError:
+        return None
+
+    return mtime, size
+
+
+def _evict_cache(cache_dir, keep_key=None):
+    """
+    Remove least recently used entries beyond max_cache_bytes (directories
+    being written or replaced, named .tmp_*, are never removed)
+    """
+    entries = []
+
+    for key in os.listdir(cache_dir):
+
+        if key.startswith('.tmp_'):
+            continue
+
+        stats = _entry_stats(os.path.join(cache_dir, key))
+
+        if stats is not None:
+            entries.append((stats[0], stats[1], key))
+
+    # meta.json is touched each time the entry is used
+    entries.sort()
+
+    total_bytes = sum(size for _, size, _ in entries)
+
+    for _, size, key in entries:
+
+        if total_bytes <= max_cache_bytes:
+            break
+
+        if key == keep_key:
+            continue
+
+        total_bytes -= size
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+
+
+def _read_meta(entry_dir):
+    """ Metadata of an entry, None if it does not exist (or is replaced) """
+    try:
+        with open(os.path.join(entry_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_entry(cache_dir, key, acc, freqs, bands, old_entry_dir=None):
+    """
+    Write the accumulators acc of a new entry of cache_dir, keeping the
+    accumulators of old_entry_dir that are not in acc (same frequencies)
+
+    The entry is written in a temporary directory renamed into place; an
+    entry being replaced is first renamed aside, so that no partially
+    written or removed entry is ever read under its key. If another process
+    writes the entry at the same time, one of the two entries is kept.
+    Writing is best effort (nothing is written on a read-only or full disk)
+    """
+    tmp_dir = old_dir = None
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=cache_dir)
+
+        acc_names = []
+
+        for acc_name, value in acc.items():
+            if acc_name == 'n_epochs':
+                continue
+            np.save(os.path.join(tmp_dir, acc_name + '.npy'), value)
+            acc_names.append(acc_name)
+
+        old_meta = None if old_entry_dir is None \
+            else _read_meta(old_entry_dir)
+
+        if old_meta is not None:
+            for acc_name in old_meta['accumulators']:
+                if acc_name in acc_names:
+                    continue
+                try:
+                    shutil.copy(os.path.join(old_entry_dir,
+                                             acc_name + '.npy'), tmp_dir)
+                    acc_names.append(acc_name)
+                except (IOError, OSError):
+                    # old entry removed meanwhile
+                    pass
+
+        meta = {'n_epochs': int(acc['n_epochs']),
+                'freqs': [float(freq) for freq in freqs],
+                'bands': [[float(f_lo), float(f_hi)] for f_lo, f_hi in bands],
+                'accumulators': sorted(acc_names)}
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        entry_dir = os.path.join(cache_dir, key)
+
+        if os.path.exists(entry_dir):
+            # renamed over an empty directory (atomic replacement)
+            old_dir = tempfile.mkdtemp(prefix='.tmp_', dir=cache_dir)
+            os.rename(entry_dir, old_dir)
+
+        os.rename(tmp_dir, entry_dir)
+        tmp_dir = None
+
+        _evict_cache(cache_dir, keep_key=key)
+
+    except (IOError, OSError):
+        # entry written at the same time by another process, or read-only
+        # or full disk: the accumulators are only used in memory
+        if old_dir is not None and not os.path.exists(entry_dir):
+            try:
+                os.rename(old_dir, entry_dir)
+                old_dir = None
+            except OSError:
+                pass
+
+    finally:
+        for dir_name in [tmp_dir, old_dir]:
+            if dir_name is not None:
+                shutil.rmtree(dir_name, ignore_errors=True)
+
+
+def _load_accumulators(entry_dir, meta, acc_names, freq_slice):
+    """
+    Accumulators acc_names of an entry over the frequencies freq_slice, None
+    if the entry was removed or replaced in the meantime
+    """
+    acc = {'n_epochs': meta['n_epochs']}
+
+    try:
+        for acc_name in acc_names:
+            cached_acc = np.load(os.path.join(entry_dir, acc_name + '.npy'),
+                                 mmap_mode='r')
+            # contiguous read of the frequency range
+            acc[acc_name] = np.array(cached_acc[freq_slice])
+    except (IOError, OSError, ValueError):
+        return None
+
+    return acc
+
+
+def _bands_covered(cached_bands, fmins, fmaxs):
+    """ True if all the bands are inside the frequency ranges of the cache """
+    merged = []
+    for f_lo, f_hi in sorted(cached_bands):
+        if len(merged) and f_lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], f_hi)
+        else:
+            merged.append([f_lo, f_hi])
+
+    return all(any(m_lo <= f_lo and f_hi <= m_hi for m_lo, m_hi in merged)
+               for f_lo, f_hi in zip(fmins, fmaxs))
+
+
+def cached_spectral_connectivity(ts_file, epoch_chunks_fun, method, sfreq,
+                                 fmin, fmax, epoch_window_length=None,
+                                 indices=None, dtype='float64',
+                                 epoch_overlap=0., csd_cache_dir=None):
+    """
+    Multitaper spectral connectivity of the epochs of ts_file, computed from
+    the cached cross-spectral sums when the cache entry of ts_file covers
+    the requested metrics and bands
+
+    epoch_chunks_fun: function returning an iterable of epoch chunks of
+    ts_file (see spectral.iter_epoch_chunks), only called on cache misses
+
+    fmin, fmax: lists of floats (one per band)
+
+    dtype: precision of the epochs given by epoch_chunks_fun, part of the key
+
+    epoch_overlap: overlap of the epochs of a continuous ts_file (see
+    spectral.epoch_continuous_data), part of the key
+
+    csd_cache_dir: directory of the cache entries (None for the module
+    cache_dir, set from NEUROPYPE_EPHY_CSD_CACHE_DIR)
+
+    Returns the same values as spectral_engine.spectral_connectivity_stream
+    """
+    entries_dir = cache_dir if csd_cache_dir is None else csd_cache_dir
+
+    if entries_dir is None:
+        raise ValueError('No CSD cache directory: give csd_cache_dir or set '
+                         'the NEUROPYPE_EPHY_CSD_CACHE_DIR environment '
+                         'variable')
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    fmins = [float(f) for f in np.atleast_1d(fmin)]
+    fmaxs = [float(f) for f in np.atleast_1d(fmax)]
+
+    key = get_csd_cache_key(ts_file, sfreq, 'multitaper', epoch_window_length,
+                            dtype, epoch_overlap)
+    entry_dir = os.path.join(entries_dir, key)
+
+    meta = _read_meta(entry_dir)
+
+    needed = set()
+    for met in methods:
+        needed.update(_method_accumulators[met])
+
+    acc = None
+
+    if meta is not None and _bands_covered(meta['bands'], fmins, fmaxs) \
+            and needed.issubset(meta['accumulators']):
+
+        cached_freqs = np.array(meta['freqs'])
+        freq_mask = get_band_freq_mask(cached_freqs, fmins, fmaxs)[0]
+        freq_idx = np.where(freq_mask)[0]
+
+        acc = _load_accumulators(entry_dir, meta, needed.union(['psd']),
+                                 slice(freq_idx[0], freq_idx[-1] + 1))
+
+        if acc is not None:
+            print("CSD cache: using {}".format(entry_dir))
+            cached_freqs = cached_freqs[freq_idx[0]:freq_idx[-1] + 1]
+            try:
+                # the modification time is used as last access time
+                os.utime(os.path.join(entry_dir, 'meta.json'), None)
+            except OSError:
+                pass
+
+    if acc is None:
+
+        bands = [list(band) for band in zip(fmins, fmaxs)]
+        methods_entry = list(methods)
+        old_entry_dir = None
+
+        if meta is not None:
+            if _bands_covered(meta['bands'], fmins, fmaxs):
+                # new sums over the cached bands, added to the entry
+                if needed.issubset(meta['accumulators']):
+                    print("CSD cache: {} was removed or replaced, "
+                          "computing again".format(entry_dir))
+                else:
+                    print("CSD cache: adding accumulators {} to {}".format(
+                        sorted(needed - set(meta['accumulators'])),
+                        entry_dir))
+                bands = meta['bands']
+                old_entry_dir = entry_dir
+            else:
+                # the new entry covers the old and the new frequency ranges
+                bands = meta['bands'] + bands
+                methods_entry += [
+                    met for met in con_methods_numpy
+                    if set(_method_accumulators[met]).issubset(
+                        meta['accumulators'])]
+                print("CSD cache: computing {}".format(entry_dir))
+        else:
+            print("CSD cache: computing {}".format(entry_dir))
+
+        acc, cached_freqs, _ = compute_stream_accumulators(
+            epoch_chunks_fun(), methods_entry, sfreq,
+            [band[0] for band in bands], [band[1] for band in bands])
+
+        _write_entry(entries_dir, key, acc, cached_freqs, bands,
+                     old_entry_dir=old_entry_dir)
+
+    # reduction of the sums over the requested frequencies (computed, or
+    # read from the cache)
+    freq_mask, freq_idx_bands = get_band_freq_mask(cached_freqs, fmins, fmaxs)
+
+    if indices is not None:
+        indices = (np.asarray(indices[0], dtype=int),
+                   np.asarray(indices[1], dtype=int))
+
+    for acc_name in needed.union(['psd']):
+        value = acc[acc_name][freq_mask]
+        if indices is not None and acc_name != 'psd':
+            value = value[..., indices[0], indices[1]]
+        acc[acc_name] = value
+
+    cons = [average_con_bands(compute_con_from_accumulators(acc, met, indices),
+                              freq_idx_bands, indices)
+            for met in methods]
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, cached_freqs[freq_mask]
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Amplitude envelope correlation (AEC), plain and orthogonalized
+
+Band-limited analytic signals are computed for all epochs and signals at
+once: the data is transformed with a single real FFT (in the precision of
+the data, see spectral_engine), and for each band the frequencies outside
+the band are set to 0 before the inverse FFT of the positive frequencies
+(batched Hilbert transform of the band-passed data, one forward FFT shared
+by all the bands). Bands are computed one after the other, so that only
+one analytic signal is in memory at a time.
+
+- 'aec': correlation over time of the amplitude envelopes of two signals,
+  computed for all pairs with a matrix product of the normalized envelopes
+- 'aec_orth': correlation of the envelope of a signal with the envelope of
+  the other signal orthogonalized with respect to it (Hipp et al., 2012,
+  Nat Neurosci), in absolute value and averaged over both orthogonalization
+  directions; the orthogonalized envelope |Im(z_j conj(z_i)) / |z_i||
+  is computed for blocks of pairs (bounded by
+  spectral_engine.max_block_bytes)
+
+Correlations are computed within each epoch and averaged over epochs. The
+connectivity is returned in the same layout as spectral_engine (lower
+triangular n_signals * n_signals matrices, or pair lists with indices).
+"""
+import numpy as np
+
+from scipy import fftpack
+
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.spectral_engine import get_band_freq_mask
+
+envelope_methods = ['aec', 'aec_orth']
+
+
+def iter_band_analytic_signals(data, sfreq, fmin, fmax):
+    """
+    Band-limited analytic signals of data (..., n_signals, n_times), yielded
+    band by band as arrays (..., n_signals, n_times) (complex64 for float32
+    data, the FFTs being computed in single precision)
+    """
+    n_times = data.shape[-1]
+    complex_dtype = spectral_engine.get_complex_dtype(data)
+
+    data = data - np.mean(data, axis=-1)[..., np.newaxis]
+
+    data_fft = spectral_engine._rfft(data)
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+
+    # the Nyquist frequency of even lengths is not a positive frequency
+    if n_times % 2 == 0:
+        freqs[-1] = -1.
+
+    freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+    used_idx = np.where(freq_mask)[0]
+
+    for freq_idx in freq_idx_bands:
+
+        # only the positive frequencies of the band are kept (x2, analytic)
+        band_fft = np.zeros(data.shape, dtype=complex_dtype)
+        band_idx = used_idx[freq_idx]
+        band_fft[..., band_idx] = 2. * data_fft[..., band_idx]
+
+        yield fftpack.ifft(band_fft, axis=-1, overwrite_x=True)
+
+
+def compute_band_analytic_signals(data, sfreq, fmin, fmax):
+    """
+    Band-limited analytic signals of data (..., n_signals, n_times), one
+    array (..., n_signals, n_times) per band (see iter_band_analytic_signals)
+    """
+    return list(iter_band_analytic_signals(data, sfreq, fmin, fmax))
+
+
+def _normalize(x):
+    """ Centered and unit norm time courses (0 if constant) """
+    x = x - np.mean(x, axis=-1)[..., np.newaxis]
+    norm = np.sqrt(np.sum(x ** 2, axis=-1))[..., np.newaxis]
+    norm[norm == 0.] = 1.
+    return x / norm
+
+
+def _orth_envelope(z_ref, z):
+    """ Envelope of z orthogonalized with respect to z_ref """
+    abs_ref = np.abs(z_ref)
+    abs_ref[abs_ref == 0.] = 1.
+    return np.abs(np.imag(z * np.conj(z_ref)) / abs_ref)
+
+
+def _aec(z, indices=None):
+    """ AEC of analytic signals z (n_epochs, n_signals, n_times) """
+    env = _normalize(np.abs(z))
+
+    if indices is None:
+        corr = np.matmul(env, np.swapaxes(env, -1, -2))
+    else:
+        corr = np.sum(env[:, indices[0], :] * env[:, indices[1], :], axis=-1)
+
+    return np.mean(corr, axis=0)
+
+
+def _aec_orth(z, rows, cols):
+    """
+    Orthogonalized AEC of analytic signals z (n_epochs, n_signals, n_times)
+    for the pairs (rows, cols), computed by blocks of pairs
+    """
+    n_epochs, n_times = z.shape[0], z.shape[-1]
+
+    env = _normalize(np.abs(z))
+
+    pair_bytes = 6 * n_epochs * n_times * z.real.itemsize
+    block_size = int(max(1, spectral_engine.max_block_bytes // pair_bytes))
+
+    con = np.zeros(len(rows), dtype=z.real.dtype)
+
+    for start in range(0, len(rows), block_size):
+
+        block = slice(start, start + block_size)
+        z_rows, z_cols = z[:, rows[block], :], z[:, cols[block], :]
+
+        # envelope of each signal orthogonalized with respect to the other
+        env_cols_orth = _normalize(_orth_envelope(z_rows, z_cols))
+        env_rows_orth = _normalize(_orth_envelope(z_cols, z_rows))
+
+        corr_rows = np.sum(env[:, rows[block], :] * env_cols_orth, axis=-1)
+        corr_cols = np.sum(env[:, cols[block], :] * env_rows_orth, axis=-1)
+
+        con[block] = np.mean((np.abs(corr_rows) + np.abs(corr_cols)) / 2.,
+                             axis=0)
+
+    return con
+
+
+def envelope_connectivity(data, method, sfreq, fmin, fmax, indices=None):
+    """
+    Amplitude envelope correlation of data in frequency bands
+
+    data: array (n_epochs, n_signals, n_times) or (n_signals, n_times)
+    method: 'aec' or 'aec_orth', or a list of them
+    fmin, fmax: floats or lists of floats (one per band)
+    indices: (seeds, targets) to restrict the computation to these pairs
+
+    Returns con (array (n_signals, n_signals, n_bands), lower triangular, or
+    (n_pairs, n_bands) with indices; list of arrays if method is a list)
+    and the frequencies used
+    """
+    data = np.asarray(data)
+
+    if data.ndim == 2:
+        data = data[np.newaxis]
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in envelope_methods:
+            raise ValueError('con_method {} is not an envelope method '
+                             '({})'.format(met, envelope_methods))
+
+    n_signals, n_times = data.shape[-2:]
+
+    if indices is None:
+        rows, cols = np.tril_indices(n_signals, -1)
+    else:
+        rows = np.asarray(indices[0], dtype=int)
+        cols = np.asarray(indices[1], dtype=int)
+
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    freq_mask, _ = get_band_freq_mask(freqs, fmin, fmax)
+
+    band_cons = [[] for met in methods]
+
+    # one analytic signal at a time, used by all the methods
+    for z in iter_band_analytic_signals(data, sfreq, fmin, fmax):
+
+        for met, met_band_cons in zip(methods, band_cons):
+
+            if met == 'aec':
+                con = _aec(z, None if indices is None else (rows, cols))
+                if indices is None:
+                    con = np.tril(con, -1)
+            else:
+                pair_con = _aec_orth(z, rows, cols)
+                if indices is None:
+                    con = np.zeros((n_signals, n_signals), pair_con.dtype)
+                    con[rows, cols] = pair_con
+                else:
+                    con = pair_con
+
+            met_band_cons.append(con)
+
+        del z
+
+    cons = [np.stack(met_band_cons, axis=-1) for met_band_cons in band_cons]
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs[freq_mask]
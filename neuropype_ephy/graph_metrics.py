@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Graph metrics of thresholded conmats, on scipy sparse matrices
+
+Conmats (lower triangular, or full directed matrices) are made symmetric
+with the maximum of the absolute values of both directions, and only the
+strongest edges are kept (proportional threshold: given density of edges;
+absolute threshold: weights above a value), in a scipy.sparse CSR
+adjacency matrix. Metrics only use sparse operations:
+
+- degree (binary) and strength (weighted), per node
+- clustering: binary local clustering coefficient, from the number of
+  triangles diag(A^3) / 2, obtained as sum((A.A) * A) on the sparse pattern
+- efficiency: nodal efficiency (mean inverse shortest path length to the
+  other nodes, breadth-first searches of scipy.sparse.csgraph) and global
+  efficiency (mean of the nodal efficiencies)
+- modularity: weighted Newman modularity of the partition found by the
+  leading eigenvector method with recursive bisections (Newman, 2006, PNAS),
+  the modularity matrix being applied as sparse plus rank one products
+  (scipy.sparse.linalg.eigsh) without being built
+"""
+import numpy as np
+
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import LinearOperator, eigsh
+
+threshold_types = ['proportional', 'absolute']
+
+global_metric_names = ['n_nodes', 'n_edges', 'density', 'mean_degree',
+                       'mean_strength', 'mean_clustering',
+                       'global_efficiency', 'modularity', 'n_modules']
+
+nodal_metric_names = ['degree', 'strength', 'clustering', 'efficiency',
+                      'module']
+
+# groups up to this size are split with a dense eigendecomposition
+_max_dense_split = 100
+
+
+def threshold_conmat(conmat, threshold, threshold_type='proportional'):
+    """
+    Sparse symmetric adjacency matrix (CSR) of the strongest edges of conmat
+
+    threshold_type: 'proportional' (threshold is the proportion of the
+    n_nodes * (n_nodes - 1) / 2 possible edges that are kept) or 'absolute'
+    (edges with a weight strictly above threshold are kept)
+    """
+    if threshold_type not in threshold_types:
+        raise ValueError('threshold_type should be one of {}, got {}'.format(
+            threshold_types, threshold_type))
+
+    abs_conmat = np.abs(np.asarray(conmat))
+
+    n_nodes = abs_conmat.shape[0]
+
+    rows, cols = np.triu_indices(n_nodes, 1)
+    weights = np.maximum(abs_conmat[rows, cols], abs_conmat[cols, rows])
+
+    if threshold_type == 'proportional':
+        n_edges = int(round(threshold * len(weights)))
+        n_edges = min(max(n_edges, 0), len(weights))
+        keep = np.argpartition(-weights, n_edges - 1)[:n_edges] \
+            if n_edges > 0 else np.array([], dtype=int)
+        keep = keep[weights[keep] > 0.]
+    else:
+        keep = np.where(weights > threshold)[0]
+
+    upper = sparse.coo_matrix((weights[keep], (rows[keep], cols[keep])),
+                              shape=(n_nodes, n_nodes))
+
+    return (upper + upper.T).tocsr()
+
+
+def compute_clustering(binary_adj):
+    """ Binary local clustering coefficients of a sparse adjacency """
+    degree = np.diff(binary_adj.indptr).astype(float)
+
+    triangles = np.asarray(binary_adj.dot(binary_adj).multiply(
+        binary_adj).sum(axis=1)).ravel() / 2.
+
+    n_pairs = degree * (degree - 1.) / 2.
+    n_pairs[n_pairs == 0.] = 1.
+
+    return triangles / n_pairs
+
+
+def compute_nodal_efficiency(binary_adj):
+    """ Mean inverse shortest path length of each node to the others """
+    n_nodes = binary_adj.shape[0]
+
+    if n_nodes < 2:
+        return np.zeros(n_nodes)
+
+    dist = csgraph.shortest_path(binary_adj, directed=False, unweighted=True)
+
+    with np.errstate(divide='ignore'):
+        inv_dist = 1. / dist
+
+    inv_dist[~np.isfinite(inv_dist)] = 0.
+    np.fill_diagonal(inv_dist, 0.)
+
+    return np.sum(inv_dist, axis=1) / (n_nodes - 1.)
+
+
+def _split_group(adj, strength, two_m, group):
+    """
+    Leading eigenvector bisection of the nodes of group, None if the
+    modularity cannot be increased
+    """
+    n_group = len(group)
+
+    if n_group < 2:
+        return None
+
+    adj_group = adj[group][:, group]
+    strength_group = strength[group]
+
+    # generalized modularity matrix of the group (Newman, 2006)
+    row_sums = np.asarray(adj_group.sum(axis=1)).ravel() - \
+        strength_group * strength_group.sum() / two_m
+
+    def matvec(x):
+        x = np.ravel(x)
+        return adj_group.dot(x) - strength_group * \
+            strength_group.dot(x) / two_m - row_sums * x
+
+    if n_group <= _max_dense_split:
+        mod_mat = adj_group.toarray() - \
+            np.outer(strength_group, strength_group) / two_m - \
+            np.diag(row_sums)
+        eigvals, eigvecs = np.linalg.eigh(mod_mat)
+        eigval, eigvec = eigvals[-1], eigvecs[:, -1]
+    else:
+        mod_op = LinearOperator((n_group, n_group), matvec=matvec,
+                                dtype=float)
+        eigvals, eigvecs = eigsh(mod_op, k=1, which='LA')
+        eigval, eigvec = eigvals[0], eigvecs[:, 0]
+
+    if eigval <= 1e-10:
+        return None
+
+    split = eigvec >= 0.
+
+    if np.all(split) or not np.any(split):
+        return None
+
+    signs = np.where(split, 1., -1.)
+
+    if signs.dot(matvec(signs)) <= 1e-10:
+        return None
+
+    return split
+
+
+def compute_modularity(adj, modules):
+    """ Weighted Newman modularity of the partition modules """
+    adj = adj.tocoo()
+
+    strength = np.asarray(adj.sum(axis=1)).ravel()
+    two_m = strength.sum()
+
+    if two_m == 0.:
+        return 0.
+
+    same = modules[adj.row] == modules[adj.col]
+
+    n_modules = modules.max() + 1
+
+    within = np.bincount(modules[adj.row[same]], adj.data[same],
+                         minlength=n_modules)
+    totals = np.bincount(modules, strength, minlength=n_modules)
+
+    return np.sum(within / two_m - (totals / two_m) ** 2)
+
+
+def detect_modules(adj):
+    """
+    Partition of the nodes of a sparse weighted adjacency (leading
+    eigenvector method), returns module indexes and modularity
+    """
+    n_nodes = adj.shape[0]
+
+    strength = np.asarray(adj.sum(axis=1)).ravel()
+    two_m = strength.sum()
+
+    modules = np.zeros(n_nodes, dtype=int)
+
+    if two_m == 0.:
+        return modules, 0.
+
+    to_split = [np.arange(n_nodes)]
+    groups = []
+
+    while len(to_split):
+
+        group = to_split.pop()
+
+        split = _split_group(adj, strength, two_m, group)
+
+        if split is None:
+            groups.append(group)
+        else:
+            to_split.extend([group[split], group[~split]])
+
+    # modules numbered by their first node
+    groups.sort(key=np.min)
+
+    for i, group in enumerate(groups):
+        modules[group] = i
+
+    return modules, compute_modularity(adj, modules)
+
+
+def compute_graph_metrics(conmat, threshold, threshold_type='proportional'):
+    """
+    Global metrics (dict, see global_metric_names) and nodal metrics (dict
+    of arrays (n_nodes, ), see nodal_metric_names) of a thresholded conmat
+    """
+    adj = threshold_conmat(conmat, threshold, threshold_type)
+
+    binary_adj = adj.copy()
+    binary_adj.data[:] = 1.
+
+    n_nodes = adj.shape[0]
+    n_edges = adj.nnz // 2
+
+    degree = np.diff(adj.indptr)
+    strength = np.asarray(adj.sum(axis=1)).ravel()
+    clustering = compute_clustering(binary_adj)
+    efficiency = compute_nodal_efficiency(binary_adj)
+    modules, modularity = detect_modules(adj)
+
+    nodal_metrics = {'degree': degree, 'strength': strength,
+                     'clustering': clustering, 'efficiency': efficiency,
+                     'module': modules}
+
+    global_metrics = {'n_nodes': n_nodes,
+                      'n_edges': n_edges,
+                      'density': n_edges / max(n_nodes * (n_nodes - 1) / 2.,
+                                               1.),
+                      'mean_degree': np.mean(degree),
+                      'mean_strength': np.mean(strength),
+                      'mean_clustering': np.mean(clustering),
+                      'global_efficiency': np.mean(efficiency),
+                      'modularity': modularity,
+                      'n_modules': modules.max() + 1}
+
+    return global_metrics, nodal_metrics
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Group-level cube of conmats and chunked reductions
+
+The conmats of all subjects, conditions and frequency bands are packed in
+one memory-mapped .npy cube (n_subjects, n_conditions, n_bands, n_edges),
+the edges being the lower triangular (i > j) values of the conmats, in the
+order of numpy.tril_indices(n_nodes, -1) (same as the packed conmats of
+neuropype_ephy.spectral). Missing conmats are NaN. A JSON index file stores
+the names of the subjects, conditions and bands, the number of nodes and
+the conmat file of each cell.
+
+Means, variances and paired t-tests over subjects are computed by chunks
+of edges (bounded by spectral_engine.max_block_bytes), so that the cube is
+never loaded as a whole.
+"""
+import os
+import json
+
+import numpy as np
+
+from neuropype_ephy import spectral_engine
+
+
+def _ordered_unique(values):
+    unique_values = []
+    for value in values:
+        if value not in unique_values:
+            unique_values.append(value)
+    return unique_values
+
+
+def build_conmat_cube(entries, cube_file, index_file=None, dtype='float32'):
+    """
+    Pack conmat files in a memory-mapped (subject, condition, band, edge)
+    cube
+
+    entries: list of (subject, condition, band, conmat_file); the conmat
+    files can be dense .npy, packed or pair list conmats (see
+    spectral.load_conmat), all with the same number of nodes
+    index_file: JSON index, cube_file with a .json extension by default
+
+    Returns cube_file and index_file
+    """
+    from neuropype_ephy.spectral import load_conmat
+
+    if len(entries) == 0:
+        raise ValueError('No conmat file to pack')
+
+    if index_file is None:
+        index_file = os.path.splitext(cube_file)[0] + '.json'
+
+    subjects = _ordered_unique([str(entry[0]) for entry in entries])
+    conditions = _ordered_unique([str(entry[1]) for entry in entries])
+    bands = _ordered_unique([str(entry[2]) for entry in entries])
+
+    n_nodes = load_conmat(entries[0][3]).shape[-1]
+    tril_rows, tril_cols = np.tril_indices(n_nodes, -1)
+
+    cube = np.lib.format.open_memmap(
+        cube_file, mode='w+', dtype=dtype,
+        shape=(len(subjects), len(conditions), len(bands), len(tril_rows)))
+
+    cube[:] = np.nan
+
+    files = []
+
+    for subject, condition, band, conmat_file in entries:
+
+        conmat = load_conmat(conmat_file)
+
+        if conmat.shape != (n_nodes, n_nodes):
+            raise ValueError('conmat of {} has shape {}, expected {}'.format(
+                conmat_file, conmat.shape, (n_nodes, n_nodes)))
+
+        cube[subjects.index(str(subject)), conditions.index(str(condition)),
+             bands.index(str(band))] = conmat[tril_rows, tril_cols]
+
+        files.append([str(subject), str(condition), str(band),
+                      os.path.abspath(conmat_file)])
+
+    cube.flush()
+    del cube
+
+    index = {'subjects': subjects, 'conditions': conditions, 'bands': bands,
+             'n_nodes': int(n_nodes), 'files': files}
+
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+
+    return cube_file, index_file
+
+
+def load_conmat_cube(cube_file, index_file=None):
+    """ Memory-mapped cube (read only) and its index (dict) """
+    if index_file is None:
+        index_file = os.path.splitext(cube_file)[0] + '.json'
+
+    with open(index_file) as f:
+        index = json.load(f)
+
+    return np.load(cube_file, mmap_mode='r'), index
+
+
+def edges_to_conmat(edges, n_nodes):
+    """ Lower triangular conmats (..., n_nodes, n_nodes) of edge values """
+    edges = np.asarray(edges)
+
+    conmat = np.zeros(edges.shape[:-1] + (n_nodes, n_nodes),
+                      dtype=edges.dtype)
+    conmat[..., np.tril_indices(n_nodes, -1)[0],
+           np.tril_indices(n_nodes, -1)[1]] = edges
+
+    return conmat
+
+
+def _iter_edge_chunks(cube):
+    """ slices of edges of the cube bounded by max_block_bytes """
+    edge_bytes = 8 * int(np.prod(cube.shape[:-1]))
+    chunk_size = int(max(1, spectral_engine.max_block_bytes // edge_bytes))
+
+    for start in range(0, cube.shape[-1], chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+def cube_mean_var(cube):
+    """
+    Mean and variance (ddof=1) over subjects, ignoring missing conmats
+
+    Returns two arrays (n_conditions, n_bands, n_edges)
+    """
+    mean = np.zeros(cube.shape[1:])
+    var = np.zeros(cube.shape[1:])
+
+    for edges in _iter_edge_chunks(cube):
+
+        values = np.asarray(cube[..., edges], dtype=np.float64)
+
+        n_values = np.sum(~np.isnan(values), axis=0)
+
+        chunk_mean = np.nansum(values, axis=0) / np.maximum(n_values, 1)
+
+        sq_dev = np.nansum((values - chunk_mean) ** 2, axis=0)
+
+        mean[..., edges] = np.where(n_values > 0, chunk_mean, np.nan)
+        var[..., edges] = np.where(n_values > 1,
+                                   sq_dev / np.maximum(n_values - 1, 1),
+                                   np.nan)
+
+    return mean, var
+
+
+def cube_paired_ttest(cube, condition_a, condition_b):
+    """
+    Paired t-test over subjects of condition_a against condition_b (indexes
+    along the condition axis), for each band and edge, subjects with a
+    missing conmat in one of the conditions being ignored
+
+    Returns t values and two-sided p values (n_bands, n_edges)
+    """
+    from scipy.stats import t as t_dist
+
+    t_values = np.zeros(cube.shape[2:])
+    p_values = np.zeros(cube.shape[2:])
+
+    for edges in _iter_edge_chunks(cube):
+
+        diff = np.asarray(cube[:, condition_a, :, edges], dtype=np.float64) - \
+            np.asarray(cube[:, condition_b, :, edges], dtype=np.float64)
+
+        n_values = np.sum(~np.isnan(diff), axis=0)
+
+        mean = np.nansum(diff, axis=0) / np.maximum(n_values, 1)
+
+        std = np.sqrt(np.nansum((diff - mean) ** 2, axis=0) /
+                      np.maximum(n_values - 1, 1))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk_t = mean / (std / np.sqrt(n_values))
+
+        chunk_t[n_values < 2] = np.nan
+
+        t_values[..., edges] = chunk_t
+        p_values[..., edges] = 2. * t_dist.sf(np.abs(chunk_t),
+                                              np.maximum(n_values - 1, 1))
+
+    return t_values, p_values
+
+
+def compute_group_conmat_stats(cube_file, condition_a=None, condition_b=None):
+    """
+    Means and variances over subjects of the conmat cube cube_file (see
+    build_conmat_cube) and, if two condition names are given, the paired
+    t-test of condition_a against condition_b
+
+    Saves group_conmat_stats.npz with mean and var (n_conditions, n_bands,
+    n_nodes, n_nodes), and t_values and p_values (n_bands, n_nodes, n_nodes)
+    as lower triangular conmats, with the names of conditions and bands
+    """
+    import os
+    import numpy as np
+
+    from neuropype_ephy.group_conmats import (load_conmat_cube,
+                                              cube_mean_var,
+                                              cube_paired_ttest,
+                                              edges_to_conmat)
+
+    cube, index = load_conmat_cube(cube_file)
+
+    n_nodes = index['n_nodes']
+
+    mean, var = cube_mean_var(cube)
+
+    stats = {'mean': edges_to_conmat(mean, n_nodes),
+             'var': edges_to_conmat(var, n_nodes),
+             'conditions': index['conditions'],
+             'bands': index['bands']}
+
+    if condition_a is not None and condition_b is not None:
+
+        t_values, p_values = cube_paired_ttest(
+            cube, index['conditions'].index(condition_a),
+            index['conditions'].index(condition_b))
+
+        stats['t_values'] = edges_to_conmat(t_values, n_nodes)
+        stats['p_values'] = edges_to_conmat(p_values, n_nodes)
+
+    stats_file = os.path.abspath('group_conmat_stats.npz')
+
+    np.savez(stats_file, **stats)
+
+    return stats_file
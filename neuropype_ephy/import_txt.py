@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
 
-def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";"):
+def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";", dtype = 'float'):
 
+    """
+    Split a Brain Vision ascii file in epochs of sample_size time points, saved as dtype 
+    ('float32' keeps ~7 significant digits, more than the ascii export precision, 
+    and halves the size of splitted_ts.npy)
+    """
     import os
 
     import numpy as np
@@ -102,7 +107,7 @@ def split_txt(sample_size,txt_file,sep_label_name, repair = True, sep = ";"):
 
     print splitted_ts[0]
 
-    np_splitted_ts = np.array(splitted_ts,dtype = 'float')
+    np_splitted_ts = np.array(splitted_ts,dtype = dtype)
 
     print np_splitted_ts.shape
 
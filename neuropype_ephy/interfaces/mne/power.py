@@ -17,6 +17,7 @@ class PowerInputSpec(BaseInterfaceInputSpec):
     fmin = traits.Float(desc='lower psd frequency', mandatory=False)
     fmax = traits.Float(desc='higher psd frequency', mandatory=False)
     method = traits.Enum('welch', 'multitaper', desc='power spectral density computation method')
+    dtype = traits.Enum('float64', 'float32', desc='precision of the saved psds', usedefault=True)
 
 
 class PowerOutputSpec(TraitedSpec):
@@ -35,7 +36,9 @@ class Power(BaseInterface):
         fmin = self.inputs.fmin
         fmax = self.inputs.fmax
         method = self.inputs.method
-        self.psds_file = compute_and_save_psd(epochs_file, fmin, fmax, method)
+        dtype = self.inputs.dtype
+        self.psds_file = compute_and_save_psd(epochs_file, fmin, fmax, method,
+                                              dtype=dtype)
         return runtime
 
     def _list_outputs(self):
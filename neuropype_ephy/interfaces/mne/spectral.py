@@ -5,7 +5,6 @@ Definition of nodes for computing and plotting spectral connectivity
 """
 import numpy as np
 import os
-import pickle
 
 from nipype.interfaces.base import BaseInterface, \
     BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
@@ -14,7 +13,7 @@ from nipype.utils.filemanip import split_filename as split_f
     
 ############################################################################################### SpectralConn #####################################################################################################
 
-from neuropype_ephy.spectral import compute_and_save_spectral_connectivity
+from neuropype_ephy.spectral import compute_and_save_spectral_connectivity, compute_and_save_streamed_spectral_connectivity, get_seed_target_indices, epoch_continuous_data
 
 class SpectralConnInputSpec(BaseInterfaceInputSpec):
     
@@ -22,26 +21,57 @@ class SpectralConnInputSpec(BaseInterfaceInputSpec):
     
     sfreq = traits.Float(desc='sampling frequency', mandatory=True)
     
-    freq_band = traits.List(traits.Float(exists=True), desc='frequency bands', mandatory=True)
+    freq_band = traits.List(traits.Float(exists=True), desc='frequency bands', mandatory=True, xor = ['freq_bands'])
     
-    con_method = traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased",desc='metric computed on time series for connectivity')
+    freq_bands = traits.List(traits.List(traits.Float(exists=True)), desc='list of frequency bands, all computed from the same spectral transform', mandatory=True, xor = ['freq_band'])
+    
+    freq_band_names = traits.List(traits.String, desc='names of the frequency bands, used in conmat file names', mandatory=False)
+    
+    con_method = traits.Either(traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased","aec","aec_orth"),
+                               traits.List(traits.Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased","aec","aec_orth")),
+                               desc='metric (or list of metrics) computed on time series for connectivity')
     
     epoch_window_length = traits.Float(desc='epoched data', mandatory=False)
     
+    epoch_overlap = traits.Float(0.0, desc='fraction of overlap between consecutive epochs of epoch_window_length', usedefault = True)
+    
     export_to_matlab = traits.Bool(False, desc='If conmat is exported to .mat format as well',usedefault = True)
     
     index = traits.String("0",desc = "What to add to the name of the file" ,usedefault = True)
     
+    backend = traits.Enum("mne","numpy",desc = "mne spectral_connectivity or batched numpy engine (multitaper only)" ,usedefault = True)
+    
+    n_jobs = traits.Int(1,desc = "number of processes the epochs are spread over" ,usedefault = True)
+    
+    seeds = traits.List(traits.Int, desc = "indexes of seed nodes, connectivity is only computed between seeds and all nodes", mandatory = False, xor = ['indices'])
+    
+    indices = traits.List(traits.List(traits.Int), desc = "two lists (seeds,targets) of node indexes, connectivity is only computed for these pairs", mandatory = False, xor = ['seeds'])
+    
+    conmat_format = traits.Enum("npy","packed",desc = "storage format of conmats: dense .npy or packed lower triangle in float32 with header",usedefault = True)
+    
+    streaming = traits.Bool(False, desc = "read epochs by chunks from the memory-mapped ts_file and accumulate cross-spectra incrementally (multitaper numpy engine)", usedefault = True)
+    
+    n_epochs_chunk = traits.Int(50, desc = "number of epochs read at once in streaming mode", usedefault = True)
+    
+    use_csd_cache = traits.Bool(False, desc = "read (or store) cross-spectral sums in the content-addressed cache of neuropype_ephy.csd_cache (streaming mode)", usedefault = True)
+    
+    csd_cache_dir = traits.String(desc = "directory of the CSD cache (default: NEUROPYPE_EPHY_CSD_CACHE_DIR environment variable)", mandatory = False)
+    
+    dtype = traits.Enum("float64","float32", desc = "precision of the time series, spectra and conmats", usedefault = True)
+    
 class SpectralConnOutputSpec(TraitedSpec):
     
-    conmat_file = File(exists=True, desc="spectral connectivty matrix in .npy format")
+    conmat_file = File(exists=True, desc="spectral connectivty matrix in .npy (or packed/pairs .npz) format")
+    
+    conmat_files = traits.List(File(exists=True), desc="spectral connectivty matrices in .npy format, one per metric and frequency band")
     
 class SpectralConn(BaseInterface):
     
     """
     Description:
     
-    Compute spectral connectivity in a given frequency bands
+    Compute spectral connectivity in a given frequency band, or in several frequency bands (freq_bands) 
+    from a single spectral transform of the time series
     
     Inputs:
     
@@ -52,25 +82,79 @@ class SpectralConn(BaseInterface):
         type = Float, desc='sampling frequency', mandatory=True
     
     freq_band 
-        type = List(Float) , exists=True, desc='frequency bands', mandatory=True
+        type = List(Float) , exists=True, desc='frequency bands', mandatory=True, xor = ['freq_bands']
+    
+    freq_bands 
+        type = List(List(Float)) , exists=True, desc='list of frequency bands, all computed from the same spectral transform', mandatory=True, xor = ['freq_band']
+    
+    freq_band_names 
+        type = List(String), desc='names of the frequency bands, used in conmat file names', mandatory=False
     
     con_method 
-        type = Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased") , desc='metric computed on time series for connectivity'
+        type = Enum("coh","imcoh","plv","pli","wpli","pli2_unbiased","ppc","cohy","wpli2_debiased","aec","aec_orth") or List of Enum, desc='metric (or list of metrics) computed on time series for connectivity'
+        if a list is given, all metrics are derived from the same cross-spectral densities and one conmat is saved per metric
+        aec and aec_orth are amplitude envelope correlations (plain and pairwise orthogonalized) computed from batched band-limited Hilbert transforms (see neuropype_ephy.envelope)
         
     epoch_window_length 
         type = Float, desc='epoched data', mandatory=False
     
+    epoch_overlap
+        type = Float, default = 0.0, desc='fraction of overlap between consecutive epochs of epoch_window_length', usedefault = True
+        
+        epochs are strided views of the memory-mapped ts_file (see neuropype_ephy.spectral.epoch_continuous_data): 
+        overlapping (e.g. Welch-style, epoch_overlap = 0.5) epochs are not copied nor written to disk
+        
     export_to_matlab 
         type = Bool, default = False, desc='If conmat is exported to .mat format as well',usedefault = True
    
     index
         type = String, default = "0", desc='What to add to the name of the file',usedefault = True
         
+    backend
+        type = Enum("mne","numpy"), default = "mne", desc='mne spectral_connectivity or batched numpy engine (multitaper only)',usedefault = True
+        
+    n_jobs
+        type = Int, default = 1, desc='number of processes the epochs are spread over',usedefault = True
+        
+    seeds
+        type = List(Int), desc='indexes of seed nodes, connectivity is only computed between seeds and all nodes', mandatory = False, xor = ['indices']
+        
+    indices
+        type = List(List(Int)), desc='two lists (seeds,targets) of node indexes, connectivity is only computed for these pairs', mandatory = False, xor = ['seeds']
+        
+        if seeds or indices are defined, conmats are saved as pair lists (conmat_*_pairs.npz, see neuropype_ephy.spectral.load_conmat_pairs)
+        
+    conmat_format
+        type = Enum("npy","packed"), default = "npy", desc='storage format of conmats: dense .npy or packed lower triangle in float32 with header (conmat_*_packed.npz, see neuropype_ephy.spectral.load_packed_conmat)', usedefault = True
+        
+    streaming
+        type = Bool, default = False, desc='read epochs by chunks from the memory-mapped ts_file and accumulate cross-spectra incrementally (multitaper numpy engine), peak memory is bounded by one chunk whatever the recording length', usedefault = True
+        
+        streaming always uses the multitaper numpy engine in one process (backend and n_jobs are ignored), 
+        and needs epochs (3D ts_file) or epoch_window_length
+        
+    n_epochs_chunk
+        type = Int, default = 50, desc='number of epochs read at once in streaming mode', usedefault = True
+        
+    use_csd_cache
+        type = Bool, default = False, desc='read (or store) cross-spectral sums in the content-addressed cache of neuropype_ephy.csd_cache, so that other metrics or narrower bands of the same ts_file need no new spectral transform (implies streaming)', usedefault = True
+        
+    csd_cache_dir
+        type = String, desc='directory of the CSD cache, needed by use_csd_cache when the NEUROPYPE_EPHY_CSD_CACHE_DIR environment variable is not set (the cache is off by default)', mandatory = False
+        
+    dtype
+        type = Enum("float64","float32"), default = "float64", desc='precision of the time series, spectra and conmats', usedefault = True
+        
+        float32 halves memory with the numpy backend, for a difference of ~1e-7 on coherence-type metrics 
+        (see neuropype_ephy.spectral.compute_and_save_spectral_connectivity)
+        
     Outputs:
     
     conmat_file 
         type = File, exists=True, desc="spectral connectivty matrix in .npy format"
     
+    conmat_files 
+        type = List(File), exists=True, desc="spectral connectivty matrices in .npy format, one per metric and frequency band"
     
     """
     input_spec = SpectralConnInputSpec
@@ -83,24 +167,98 @@ class SpectralConn(BaseInterface):
         ts_file = self.inputs.ts_file
         sfreq = self.inputs.sfreq
         freq_band = self.inputs.freq_band
+        freq_bands = self.inputs.freq_bands
+        freq_band_names = self.inputs.freq_band_names
         con_method = self.inputs.con_method
         epoch_window_length = self.inputs.epoch_window_length
+        epoch_overlap = self.inputs.epoch_overlap
         export_to_matlab = self.inputs.export_to_matlab
         index = self.inputs.index
+        backend = self.inputs.backend
+        n_jobs = self.inputs.n_jobs
+        seeds = self.inputs.seeds
+        indices = self.inputs.indices
+        conmat_format = self.inputs.conmat_format
+        streaming = self.inputs.streaming
+        n_epochs_chunk = self.inputs.n_epochs_chunk
+        use_csd_cache = self.inputs.use_csd_cache
+        csd_cache_dir = self.inputs.csd_cache_dir
+        dtype = self.inputs.dtype
         
-        if epoch_window_length == traits.Undefined:
+        if isdefined(freq_bands):
+            fmin = [band[0] for band in freq_bands]
+            fmax = [band[1] for band in freq_bands]
+            if not isdefined(freq_band_names):
+                freq_band_names = None
+        else:
+            fmin,fmax = freq_band[0],freq_band[1]
+            freq_band_names = None
+            
+        if streaming or use_csd_cache:
+            
+            from neuropype_ephy.spectral_engine import con_methods_numpy
+            
+            print "streaming epochs from memory-mapped {} by chunks of {} epochs".format(ts_file,n_epochs_chunk)
+            
+            if not isdefined(epoch_window_length):
+                epoch_window_length = None
+                
+            ts_shape = np.load(ts_file, mmap_mode = 'r').shape
+            
+            if len(ts_shape) == 2 and epoch_window_length is None:
+                raise ValueError("streaming mode needs epochs (3D ts_file) or epoch_window_length for continuous data, got shape {}".format(ts_shape))
+            
+            con_methods = con_method if isinstance(con_method,list) else [con_method]
+            
+            if any([method not in con_methods_numpy for method in con_methods]):
+                raise ValueError("streaming mode computes {} only (multitaper numpy engine), got {}".format(con_methods_numpy,con_method))
+            
+            ### streaming always uses the multitaper numpy engine, in a single process
+            if backend != 'numpy' or n_jobs != 1:
+                print "Warning, backend ({}) and n_jobs ({}) are ignored in streaming mode (multitaper numpy engine, one process)".format(backend,n_jobs)
+                
+            if use_csd_cache and not isdefined(csd_cache_dir):
+                csd_cache_dir = os.environ.get('NEUROPYPE_EPHY_CSD_CACHE_DIR')
+                
+                if csd_cache_dir is None:
+                    raise ValueError("use_csd_cache needs csd_cache_dir or the NEUROPYPE_EPHY_CSD_CACHE_DIR environment variable (the CSD cache is off by default)")
+                    
+            n_nodes = ts_shape[-2]
+            
+        elif epoch_window_length == traits.Undefined:
             print '*** NO epoch_window_length ***'
-            data = np.load(ts_file)
+            data = np.load(ts_file).astype(dtype, copy = False)
+            n_nodes = data.shape[-2]
         else:
-            raw_data = np.load(ts_file)
-            nb_splits = raw_data.shape[1] // (epoch_window_length * sfreq)
-            reste = raw_data.shape[1] % int(epoch_window_length * sfreq)
-            if reste != 0:
-                raw_data = raw_data[:,:-reste]
-            print "epoching data with {}s by window, resulting in {} epochs (rest = {})".format(epoch_window_length,nb_splits,reste)
-            data = np.array(np.array_split(raw_data,nb_splits,axis = 1))
+            raw_data = np.load(ts_file, mmap_mode = 'r')
+            data = epoch_continuous_data(raw_data, sfreq, epoch_window_length, epoch_overlap)
+            print "epoching data with {}s by window (overlap = {}), resulting in {} epochs".format(epoch_window_length,epoch_overlap,data.shape[0])
+            n_nodes = data.shape[-2]
         
-        self.conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,index = index, sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],export_to_matlab = export_to_matlab)
+        if isdefined(seeds):
+            indices = get_seed_target_indices(seeds, n_nodes)
+        elif isdefined(indices):
+            indices = (np.array(indices[0]),np.array(indices[1]))
+        else:
+            indices = None
+            
+        if streaming or use_csd_cache:
+            conmat_files = compute_and_save_streamed_spectral_connectivity(ts_file = ts_file,con_method = con_method,sfreq = sfreq,fmin = fmin,fmax = fmax,
+                                                                           epoch_window_length = epoch_window_length,epoch_overlap = epoch_overlap,n_epochs_chunk = n_epochs_chunk,index = index,
+                                                                           export_to_matlab = export_to_matlab,freq_band_names = freq_band_names,indices = indices,conmat_format = conmat_format,
+                                                                           use_csd_cache = use_csd_cache,dtype = dtype,
+                                                                           csd_cache_dir = csd_cache_dir if use_csd_cache else None)
+        else:
+            conmat_files = compute_and_save_spectral_connectivity(data = data,con_method = con_method,index = index, sfreq=sfreq, fmin = fmin, fmax = fmax,
+                                                                  export_to_matlab = export_to_matlab, freq_band_names = freq_band_names, backend = backend, n_jobs = n_jobs, indices = indices, conmat_format = conmat_format, dtype = dtype)
+            
+        ### several bands or methods: list of conmat files
+        if isinstance(conmat_files,list):
+            self.conmat_files = conmat_files
+            self.conmat_file = traits.Undefined
+        else:
+            self.conmat_file = conmat_files
+            self.conmat_files = [self.conmat_file]
         
         return runtime
         
@@ -110,11 +268,44 @@ class SpectralConn(BaseInterface):
         
         outputs["conmat_file"] = self.conmat_file
         
+        outputs["conmat_files"] = self.conmat_files
+        
         return outputs
         
 ############################################################################################### PlotSpectralConn #####################################################################################################
 
-from neuropype_ephy.spectral import plot_circular_connectivity
+from neuropype_ephy.spectral import plot_circular_connectivity, plot_circular_connectivity_batch, load_conmat, get_plot_labels
+
+def _read_plot_labels(labels_file, is_sensor_space, n_nodes):
+    
+    """
+    Label names, colors and circular plot order of the nodes (see PlotSpectralConn)
+    """
+    if isdefined(labels_file):
+        
+        if is_sensor_space:
+            label_names = [line.strip() for line in open(labels_file)]
+            node_order  = label_names
+            node_colors = None
+        
+        else:
+            ### order, colors and centroids parsed once per labels_file
+            plot_labels = get_plot_labels(labels_file)
+            
+            label_names = plot_labels["label_names"]
+            node_colors = [tuple(color) for color in plot_labels["node_colors"]]
+            node_order = plot_labels["node_order"]
+            
+            print '\n ********************** \n'  
+            print len(label_names)
+            print node_order
+            print '\n ********************** \n'  
+    else:
+        label_names = range(n_nodes)
+        node_order  = label_names
+        node_colors = None
+        
+    return label_names, node_colors, node_order
 
 class PlotSpectralConnInputSpec(BaseInterfaceInputSpec):
     
@@ -130,6 +321,8 @@ class PlotSpectralConnInputSpec(BaseInterfaceInputSpec):
     
     labels_file = traits.File(desc='list of labels associated with nodes')
     
+    plot_format = traits.Enum("eps","png","pdf","svg", desc='format of the plot file (png is a raster format)', usedefault = True)
+    
 class PlotSpectralConnOutputSpec(TraitedSpec):
     
     plot_conmat_file = File(exists=True, desc="plot spectral connectivity matrix in .eps format")
@@ -161,6 +354,9 @@ class PlotSpectralConn(BaseInterface):
     labels_file 
         type = File, desc='list of labels associated with nodes'
     
+    plot_format
+        type = Enum("eps","png","pdf","svg"), default = "eps", desc='format of the plot file (png is a raster format)', usedefault = True
+        
     Outputs:
     
     plot_conmat_file
@@ -188,80 +384,19 @@ class PlotSpectralConn(BaseInterface):
         path,fname,ext = split_f(conmat_file)    
         print fname
         
-        conmat = np.load(conmat_file)
+        conmat = load_conmat(conmat_file)
         print conmat.shape
         
         assert conmat.ndim == 2, "Warning, conmat should be 2D matrix , ndim = {}".format(conmat.ndim)
         assert conmat.shape[0] == conmat.shape[1], "Warning, conmat should be a squared matrix , {} != {}".format(conmat.shape[0],conmat.shape[1])
         
-            
-        if isdefined(labels_file):
-            
-            if is_sensor_space:
-                label_names = [line.strip() for line in open(labels_file)]
-                node_order  = label_names
-                node_colors = None
-            
-            else:
-                labels = []
-                with open(labels_file, "rb") as f:
-                    for _ in range(pickle.load(f)):
-                        labels.append(pickle.load(f))
-                
-                print '\n ********************** \n' 
-                print len(labels)
-                print '\n ********************** \n' 
-#                0/0
-                # read colors
-                node_colors = [label.color for label in labels]    
-                
-                # reorder the labels based on their location in the left hemi
-                label_names = [label.name for label in labels]
-                lh_labels = [name for name in label_names if name.endswith('lh')]
-                rh_labels = [name for name in label_names if name.endswith('rh')]
-                
-                # Get the y-location of the label
-                label_ypos_lh = list()
-                for name in lh_labels:
-                    idx = label_names.index(name)
-                    ypos = np.mean(labels[idx].pos[:, 1])
-                    label_ypos_lh.append(ypos)
-                    
-                try:
-                    idx = label_names.index('Brain-Stem')
-                    ypos = np.mean(labels[idx].pos[:, 1])
-                    lh_labels.append('Brain-Stem')
-                    label_ypos_lh.append(ypos)
-                except ValueError:
-                    pass
-                        
-                # Reorder the labels based on their location
-                lh_labels = [label for (yp, label) in sorted(zip(label_ypos_lh, lh_labels))]
-#                rh_labels = [label for (yp, label) in sorted(zip(label_ypos_rh, rh_labels))]
-                
-                # For the right hemi
-                rh_labels = [label[:-2] + 'rh' for label in lh_labels
-                            if label != 'Brain-Stem' and label[:-2]+ 'rh' in rh_labels]
-
-                # Save the plot order 
-                node_order = list()
-                node_order.extend(lh_labels[::-1])  # reverse the order
-                node_order.extend(rh_labels)    
-                print '\n ********************** \n'  
-                print lh_labels
-                print rh_labels
-                print '\n ********************** \n'  
-        else:
-            label_names = range(conmat.shape[0])
-            node_order  = label_names
-            node_colors = None
+        label_names, node_colors, node_order = _read_plot_labels(labels_file, is_sensor_space, conmat.shape[0])
            
         print '\n ********************** \n'   
         print len(label_names)
         print len(node_order)
         print '\n ********************** \n'   
-#        0/0
-        self.plot_conmat_file = plot_circular_connectivity(conmat,label_names,node_colors,node_order, vmin,vmax ,nb_lines, fname)
+        self.plot_conmat_file = plot_circular_connectivity(conmat,label_names,node_colors,node_order, vmin,vmax ,nb_lines, fname, plot_format = self.inputs.plot_format)
 
         return runtime
         
@@ -272,4 +407,103 @@ class PlotSpectralConn(BaseInterface):
         outputs["plot_conmat_file"] = self.plot_conmat_file
         
         return outputs
+
+############################################################################################### PlotSpectralConnBatch #####################################################################################################
+
+class PlotSpectralConnBatchInputSpec(BaseInterfaceInputSpec):
+    
+    conmat_files = traits.List(traits.File(exists=True), desc='connectivity matrices (same nodes) in .npy, packed or pairs format', mandatory=True)
+    
+    is_sensor_space = traits.Bool(True, desc = 'if True uses labels as returned from mne', usedefault = True)
+    
+    vmin = traits.Float(0.3, desc='min scale value', usedefault = True)
+    
+    vmax = traits.Float(1.0, desc='max scale value', usedefault = True)
+    
+    nb_lines = traits.Int(200, desc='nb lines kept in the representation', usedefault = True)
+    
+    labels_file = traits.File(desc='list of labels associated with nodes')
+    
+    plot_format = traits.Enum("png","eps","pdf","svg", desc='format of the plot files (png is a raster format)', usedefault = True)
+    
+    dpi = traits.Int(150, desc='resolution of raster plots', usedefault = True)
+    
+    n_jobs = traits.Int(1, desc='number of processes the conmats are spread over', usedefault = True)
+    
+class PlotSpectralConnBatchOutputSpec(TraitedSpec):
+    
+    plot_conmat_files = traits.List(File(exists=True), desc="plots of the connectivity matrices, in the order of conmat_files")
+    
+class PlotSpectralConnBatch(BaseInterface):
+    
+    """
+    Description:
+    
+    Plot many connectivity matrices with the same nodes (see PlotSpectralConn): labels and circular layout are 
+    read once, the nb_lines strongest edges are selected with argpartition before plotting, and conmats are 
+    spread over n_jobs processes, each reusing a single figure
+    
+    Inputs:
+    
+    conmat_files 
+        type = List of File, exists=True, desc='connectivity matrices (same nodes) in .npy, packed or pairs format', mandatory=True
+    
+    is_sensor_space 
+        type = Bool, default = True, desc = 'if True uses labels as returned from mne', usedefault = True
+    
+    vmin 
+        type = Float, default = 0.3, desc='min scale value', usedefault = True
+    
+    vmax
+        type = Float, default = 1.0, desc='max scale value', usedefault = True
+    
+    nb_lines 
+        type = Int, default = 200, desc='nb lines kept in the representation', usedefault = True
+    
+    labels_file 
+        type = File, desc='list of labels associated with nodes'
+    
+    plot_format
+        type = Enum("png","eps","pdf","svg"), default = "png", desc='format of the plot files (png is a raster format)', usedefault = True
+        
+    dpi
+        type = Int, default = 150, desc='resolution of raster plots', usedefault = True
         
+    n_jobs
+        type = Int, default = 1, desc='number of processes the conmats are spread over', usedefault = True
+        
+    Outputs:
+    
+    plot_conmat_files
+        type = List of File, exists=True, desc="plots of the connectivity matrices, in the order of conmat_files"
+        
+    """
+    
+    input_spec = PlotSpectralConnBatchInputSpec
+    output_spec = PlotSpectralConnBatchOutputSpec
+
+    def _run_interface(self, runtime):
+                
+        print 'in PlotSpectralConnBatch'
+        
+        conmat_files = self.inputs.conmat_files
+        
+        n_nodes = load_conmat(conmat_files[0]).shape[0]
+        
+        label_names, node_colors, node_order = _read_plot_labels(self.inputs.labels_file, self.inputs.is_sensor_space, n_nodes)
+        
+        self.plot_conmat_files = plot_circular_connectivity_batch(conmat_files, label_names, node_colors, node_order, 
+                                                                  vmin = self.inputs.vmin, vmax = self.inputs.vmax, nb_lines = self.inputs.nb_lines, 
+                                                                  plot_format = self.inputs.plot_format, dpi = self.inputs.dpi, n_jobs = self.inputs.n_jobs)
+        
+        print "Plotted {} conmats".format(len(self.plot_conmat_files))
+
+        return runtime
+        
+    def _list_outputs(self):
+        
+        outputs = self._outputs().get()
+        
+        outputs["plot_conmat_files"] = self.plot_conmat_files
+        
+        return outputs
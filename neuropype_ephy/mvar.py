@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Directed connectivity from multivariate autoregressive (MVAR) models
+
+MVAR models x(t) = sum_k A_k x(t - k) + e(t) are fitted by least squares,
+the normal equations of all the models (e.g. one per trial and window)
+being built with matrix products and solved at once with a batched
+numpy.linalg.solve. The epochs of a model are pooled in its normal
+equations.
+
+From the coefficients, A(f) = I - sum_k A_k exp(-2i pi f k / sfreq) and
+the transfer function H(f) = A(f)^-1 are computed for all frequencies and
+models at once, and give:
+
+- 'pdc': partial directed coherence |A_ij(f)| / sqrt(sum_m |A_mj(f)|^2)
+- 'dtf': directed transfer function |H_ij(f)| / sqrt(sum_m |H_im(f)|^2)
+- 'gc': spectral Granger causality (Geweke), computed for each pair from
+  the entries of the multivariate model (pairwise formula, no bivariate
+  model is fitted):
+  ln(S_ii(f) / (S_ii(f) - (Sigma_jj - Sigma_ij^2 / Sigma_ii)|H_ij(f)|^2)),
+  S(f) being the spectral matrix H(f) Sigma H(f)^H and Sigma the noise
+  covariance
+
+Directed connectivity con[i, j] is the influence of signal j on signal i
+(full n_signals * n_signals matrices, 0 on the diagonal), averaged over
+the frequencies of each band.
+"""
+import numpy as np
+
+from neuropype_ephy.spectral_engine import get_band_freq_mask
+
+directed_methods = ['gc', 'pdc', 'dtf']
+
+
+def fit_mvar(data, order):
+    """
+    Least squares fit of MVAR models
+
+    data: array (..., n_epochs, n_signals, n_times), one model being fitted
+    on the n_epochs epochs of each leading index
+
+    Returns coefs (..., order, n_signals, n_signals) and the noise
+    covariance (..., n_signals, n_signals)
+    """
+    data = np.asarray(data, dtype=np.float64)
+
+    n_signals, n_times = data.shape[-2:]
+
+    if n_times <= order:
+        raise ValueError('The epochs ({} samples) should be longer than the '
+                         'model order ({})'.format(n_times, order))
+
+    data = data - np.mean(data, axis=-1)[..., np.newaxis]
+
+    # (..., n_epochs, order * n_signals, n_times - order), lag by lag
+    past = np.concatenate([data[..., order - k:n_times - k]
+                           for k in range(1, order + 1)], axis=-2)
+    present = data[..., order:]
+
+    past_t = np.swapaxes(past, -1, -2)
+
+    # normal equations summed over epochs
+    r_past = np.sum(np.matmul(past, past_t), axis=-3)
+    r_present = np.sum(np.matmul(present, past_t), axis=-3)
+
+    # coefs (..., n_signals, order * n_signals), r_past being symmetric
+    coefs = np.swapaxes(np.linalg.solve(r_past,
+                                        np.swapaxes(r_present, -1, -2)),
+                        -1, -2)
+
+    residuals = present - np.matmul(coefs[..., np.newaxis, :, :], past)
+
+    n_samples = residuals.shape[-3] * residuals.shape[-1]
+
+    noise_cov = np.sum(np.matmul(residuals, np.swapaxes(residuals, -1, -2)),
+                       axis=-3) / n_samples
+
+    # columns of coefs are ordered by lag, then by signal
+    coefs = coefs.reshape(coefs.shape[:-1] + (order, n_signals))
+
+    return np.swapaxes(coefs, -2, -3), noise_cov
+
+
+def compute_mvar_spectra(coefs, freqs, sfreq):
+    """
+    A(f) and transfer function H(f) (..., n_freqs, n_signals, n_signals) of
+    MVAR coefficients (..., order, n_signals, n_signals)
+    """
+    order, n_signals = coefs.shape[-3:-1]
+
+    lags = np.arange(1, order + 1)
+
+    # (n_freqs, order)
+    phases = np.exp(-2j * np.pi * np.outer(freqs, lags) / sfreq)
+
+    a_f = np.eye(n_signals) - np.einsum('fk,...kij->...fij', phases, coefs)
+
+    return a_f, np.linalg.inv(a_f)
+
+
+def _directed_con(method, a_f, h_f, noise_cov):
+    """ Directed connectivity (..., n_freqs, n_signals, n_signals) """
+    if method == 'pdc':
+        abs_a = np.abs(a_f)
+        return abs_a / np.sqrt(np.sum(abs_a ** 2, axis=-2))[..., np.newaxis,
+                                                             :]
+
+    abs_h = np.abs(h_f)
+
+    if method == 'dtf':
+        return abs_h / np.sqrt(np.sum(abs_h ** 2, axis=-1))[..., np.newaxis]
+
+    cov = noise_cov[..., np.newaxis, :, :]
+
+    spectral_matrix = np.matmul(np.matmul(h_f, cov.astype(h_f.dtype)),
+                                np.conj(np.swapaxes(h_f, -1, -2)))
+
+    auto_spectra = np.real(np.diagonal(spectral_matrix, axis1=-2, axis2=-1))
+
+    cov_diag = np.diagonal(cov, axis1=-2, axis2=-1)
+
+    # partial noise variance of the source j given the target i
+    partial_cov = cov_diag[..., np.newaxis, :] - \
+        cov ** 2 / cov_diag[..., :, np.newaxis]
+
+    s_ii = auto_spectra[..., :, np.newaxis]
+
+    denom = s_ii - partial_cov * abs_h ** 2
+
+    tiny = np.finfo(np.float64).tiny
+
+    return np.log(s_ii / np.maximum(denom, tiny))
+
+
+def directed_connectivity(data, method, sfreq, fmin, fmax, order=10,
+                          indices=None):
+    """
+    Directed connectivity of MVAR models fitted on data in frequency bands
+
+    data: array (..., n_epochs, n_signals, n_times), one model being fitted
+    per leading index (a 2D array is a single epoch)
+    method: 'gc', 'pdc' or 'dtf', or a list of them
+    order: order of the MVAR models (in samples)
+    indices: (seeds, targets) to return only the influence of seeds[p] on
+    targets[p]
+
+    Returns con (array (..., n_signals, n_signals, n_bands) with con[i, j]
+    the influence of j on i, or (..., n_pairs, n_bands) with indices; list
+    of arrays if method is a list) and the frequencies used
+    """
+    data = np.asarray(data)
+
+    if data.ndim == 2:
+        data = data[np.newaxis]
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in directed_methods:
+            raise ValueError('con_method {} is not a directed method '
+                             '({})'.format(met, directed_methods))
+
+    n_signals, n_times = data.shape[-2:]
+
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+
+    coefs, noise_cov = fit_mvar(data, order)
+
+    a_f, h_f = compute_mvar_spectra(coefs, freqs[freq_mask], sfreq)
+
+    diag = np.eye(n_signals, dtype=bool)
+
+    cons = []
+
+    for met in methods:
+
+        con_freqs = _directed_con(met, a_f, h_f, noise_cov)
+
+        con = np.stack([np.mean(con_freqs[..., freq_idx, :, :], axis=-3)
+                        for freq_idx in freq_idx_bands], axis=-1)
+
+        con[..., diag, :] = 0.
+
+        if indices is not None:
+            con = con[..., np.asarray(indices[1], dtype=int),
+                      np.asarray(indices[0], dtype=int), :]
+
+        cons.append(con.astype(data.dtype
+                               if data.dtype == np.float32 else np.float64))
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs[freq_mask]
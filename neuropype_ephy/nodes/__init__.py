@@ -1,2 +1,4 @@
 from .import_data import (ImportMat,ImportBrainVisionAscii)
 from .ts_tools import (SplitWindows)
+from .pac import (PAC)
+from .graph_metrics import (GraphMetrics)
\ No newline at end of file
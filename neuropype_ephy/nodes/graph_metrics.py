@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+
+Description:
+
+Graph metrics node, computed on thresholded conmats with sparse algorithms
+"""
+import numpy as np
+import os
+
+from nipype.interfaces.base import BaseInterface, \
+    BaseInterfaceInputSpec, traits, TraitedSpec, isdefined
+
+from neuropype_ephy.graph_metrics import compute_graph_metrics, global_metric_names, nodal_metric_names
+
+############################################################################################### GraphMetrics #####################################################################################################
+
+class GraphMetricsInputSpec(BaseInterfaceInputSpec):
+
+    conmat_files = traits.List(traits.File(exists=True), desc='conmat files (.npy, packed or pairs .npz), each with one conmat or a stack of conmats', mandatory=True)
+
+    threshold = traits.Float(0.1, desc='proportion of edges kept (proportional) or minimal weight of the edges kept (absolute)', usedefault = True)
+
+    threshold_type = traits.Enum("proportional","absolute", desc='type of threshold', usedefault = True)
+
+    labels_file = traits.File(exists=True, desc='list of labels associated with nodes, saved with the nodal metrics')
+
+    is_sensor_space = traits.Bool(True, desc = 'if True labels_file is a text file of label names, otherwise pickled mne labels', usedefault = True)
+
+class GraphMetricsOutputSpec(TraitedSpec):
+
+    metrics_file = traits.File(exists=True, desc="table of global graph metrics, one row per conmat, in .csv format")
+
+    nodal_metrics_file = traits.File(exists=True, desc="nodal graph metrics (one array conmats * nodes per metric) in .npz format")
+
+class GraphMetrics(BaseInterface):
+
+    """
+    Description:
+
+    Threshold conmats into scipy sparse graphs and compute their graph metrics (see neuropype_ephy.graph_metrics):
+    degree, strength, clustering, efficiency and modularity, written as one table per subject
+
+    Inputs:
+
+    conmat_files:
+        type = List of File, exists=True, desc='conmat files (.npy, packed or pairs .npz), each with one conmat or a stack of conmats', mandatory=True
+
+    threshold
+        type = Float, default = 0.1, desc='proportion of edges kept (proportional) or minimal weight of the edges kept (absolute)', usedefault = True
+
+    threshold_type
+        type = Enum("proportional","absolute"), default = "proportional", desc='type of threshold', usedefault = True
+
+    labels_file
+        type = File, exists=True, desc='list of labels associated with nodes, saved with the nodal metrics'
+
+    is_sensor_space
+        type = Bool, default = True, desc = 'if True labels_file is a text file of label names, otherwise pickled mne labels
+        (label names and centroids are then read from the parsed labels sidecar, see neuropype_ephy.spectral.get_plot_labels)'
+
+    Outputs:
+
+    metrics_file
+        type = File, exists=True, desc="table of global graph metrics, one row per conmat, in .csv format"
+        columns are conmat_file, conmat_index (position in a stack of conmats) and the global metrics
+
+    nodal_metrics_file
+        type = File, exists=True, desc="nodal graph metrics (one array conmats * nodes per metric) in .npz format"
+
+    """
+    input_spec = GraphMetricsInputSpec
+    output_spec = GraphMetricsOutputSpec
+
+    def _run_interface(self, runtime):
+
+        import csv
+
+        from neuropype_ephy.spectral import load_conmat, get_plot_labels
+
+        print 'in GraphMetrics'
+
+        rows = []
+
+        nodal_metrics = dict([(metric_name,[]) for metric_name in nodal_metric_names])
+
+        for conmat_file in self.inputs.conmat_files:
+
+            conmats = load_conmat(conmat_file)
+
+            print conmats.shape
+
+            ### stacks of conmats (e.g. trials * windows) are flattened
+            conmats = conmats.reshape((-1,) + conmats.shape[-2:])
+
+            for conmat_index,conmat in enumerate(conmats):
+
+                conmat_global_metrics, conmat_nodal_metrics = compute_graph_metrics(conmat, self.inputs.threshold, self.inputs.threshold_type)
+
+                rows.append([conmat_file, conmat_index] + [conmat_global_metrics[metric_name] for metric_name in global_metric_names])
+
+                for metric_name in nodal_metric_names:
+                    nodal_metrics[metric_name].append(conmat_nodal_metrics[metric_name])
+
+        print "Computed graph metrics of {} conmats".format(len(rows))
+
+        self.metrics_file = os.path.abspath("graph_metrics.csv")
+
+        with open(self.metrics_file, 'wb') as f:
+
+            writer = csv.writer(f)
+
+            writer.writerow(['conmat_file','conmat_index'] + global_metric_names)
+
+            writer.writerows(rows)
+
+        self.nodal_metrics_file = os.path.abspath("nodal_graph_metrics.npz")
+
+        nodal_arrays = dict([(metric_name,np.array(values)) for metric_name,values in nodal_metrics.items()])
+
+        if isdefined(self.inputs.labels_file):
+
+            if self.inputs.is_sensor_space:
+                nodal_arrays['label_names'] = [line.strip() for line in open(self.inputs.labels_file)]
+            else:
+                plot_labels = get_plot_labels(self.inputs.labels_file)
+                nodal_arrays['label_names'] = plot_labels['label_names']
+                nodal_arrays['centroids'] = plot_labels['centroids']
+
+        np.savez(self.nodal_metrics_file, **nodal_arrays)
+
+        return runtime
+
+    def _list_outputs(self):
+
+        outputs = self._outputs().get()
+
+        outputs["metrics_file"] = self.metrics_file
+
+        outputs["nodal_metrics_file"] = self.nodal_metrics_file
+
+        return outputs
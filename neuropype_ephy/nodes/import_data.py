@@ -112,6 +112,10 @@ class ImportBrainVisionAsciiInputSpec(BaseInterfaceInputSpec):
 
     sep = traits.Str(";", desc="Separator between time points", usedefault=True)
 
+    dtype = traits.Enum("float64", "float32",
+                        desc="precision of the splitted time series",
+                        usedefault=True)
+
 class ImportBrainVisionAsciiOutputSpec(TraitedSpec):
     ''' Output specification for ImportBrainVisionAscii '''
 
@@ -146,6 +150,10 @@ class ImportBrainVisionAscii(BaseInterface):
     sep
         type = String, default = ";","Separator between time points",usedefault = True)
 
+    dtype
+        type = Enum("float64","float32"), default = "float64", desc="precision of
+        the splitted time series", usedefault = True
+
     Outputs:
 
     splitted_ts_file
@@ -174,8 +182,11 @@ class ImportBrainVisionAscii(BaseInterface):
 
         sep = self.inputs.sep
 
+        dtype = self.inputs.dtype
+
         split_txt(txt_file=txt_file, sample_size=sample_size,
-                  sep_label_name=sep_label_name, repair=repair, sep=sep)
+                  sep_label_name=sep_label_name, repair=repair, sep=sep,
+                  dtype=dtype)
 
         return runtime
 
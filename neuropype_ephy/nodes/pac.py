@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+
+Description:
+
+Phase-amplitude coupling (PAC) node, computed on time series in .npy format
+"""
+import numpy as np
+import os
+
+from nipype.interfaces.base import BaseInterface, \
+    BaseInterfaceInputSpec, traits, TraitedSpec
+
+from neuropype_ephy.pac import compute_pac
+
+############################################################################################### PAC #####################################################################################################
+
+class PACInputSpec(BaseInterfaceInputSpec):
+
+    ts_file = traits.File(exists=True, desc='trials * nodes * time series (or nodes * time series) in .npy format', mandatory=True)
+
+    sfreq = traits.Float(desc='sampling frequency', mandatory=True)
+
+    phase_freq_bands = traits.List(traits.List(traits.Float, minlen = 2, maxlen = 2), desc='frequency bands of the phase, list of [fmin,fmax]', mandatory=True)
+
+    amp_freq_bands = traits.List(traits.List(traits.Float, minlen = 2, maxlen = 2), desc='frequency bands of the amplitude, list of [fmin,fmax]', mandatory=True)
+
+    pac_method = traits.Enum("mi","mvl", desc='modulation index (Tort) or mean vector length (Canolty)', usedefault = True)
+
+    n_bins = traits.Int(18, desc='number of phase bins of the modulation index', usedefault = True)
+
+class PACOutputSpec(TraitedSpec):
+
+    pac_file = traits.File(exists=True, desc="nodes * nodes * phase bands * amplitude bands PAC array in .npy format")
+
+class PAC(BaseInterface):
+
+    """
+    Description:
+
+    Compute phase-amplitude coupling between all pairs of nodes (phase of a node, amplitude of another or the same node),
+    for all pairs of phase and amplitude frequency bands (see neuropype_ephy.pac)
+
+    Band-limited Hilbert transforms of all bands are computed from a single FFT of each chunk of trials, and the
+    coupling is reduced over time samples with matrix products; trials are read by chunks from the memory-mapped
+    ts_file, so that memory stays bounded
+
+    Inputs:
+
+    ts_file:
+        type = File, exists=True, desc='trials * nodes * time series (or nodes * time series) in .npy format', mandatory=True
+
+    sfreq
+        type = Float, desc='sampling frequency', mandatory=True
+
+    phase_freq_bands
+        type = List of List of 2 Float, desc='frequency bands of the phase, list of [fmin,fmax]', mandatory=True
+
+    amp_freq_bands
+        type = List of List of 2 Float, desc='frequency bands of the amplitude, list of [fmin,fmax]', mandatory=True
+
+    pac_method
+        type = Enum("mi","mvl"), default = "mi", desc='modulation index (Tort) or mean vector length (Canolty)', usedefault = True
+
+    n_bins
+        type = Int, default = 18, desc='number of phase bins of the modulation index', usedefault = True
+
+    Outputs:
+
+    pac_file
+        type = File, exists=True, desc="nodes * nodes * phase bands * amplitude bands PAC array in .npy format",
+        pac[i,j,p,a] being the coupling of the phase of node i in band p with the amplitude of node j in band a
+
+    """
+    input_spec = PACInputSpec
+    output_spec = PACOutputSpec
+
+    def _run_interface(self, runtime):
+
+        print 'in PAC'
+
+        ts = np.load(self.inputs.ts_file, mmap_mode = 'r')
+
+        print ts.shape
+
+        pac = compute_pac(ts, self.inputs.sfreq, self.inputs.phase_freq_bands, self.inputs.amp_freq_bands,
+                          method = self.inputs.pac_method, n_bins = self.inputs.n_bins)
+
+        print pac.shape
+
+        self.pac_file = os.path.abspath("pac_{}.npy".format(self.inputs.pac_method))
+
+        np.save(self.pac_file, pac)
+
+        return runtime
+
+    def _list_outputs(self):
+
+        outputs = self._outputs().get()
+
+        outputs["pac_file"] = self.pac_file
+
+        return outputs
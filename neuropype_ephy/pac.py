@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Phase-amplitude coupling (PAC) between all pairs of channels
+
+For each chunk of epochs (or block of time points of long epochs and
+continuous data), the analytic signals of the phase and amplitude bands
+are computed band by band from a single FFT (see
+envelope.iter_band_analytic_signals), and the coupling of the phase of
+every channel with the amplitude of every channel is reduced over time
+samples:
+
+- 'mvl': mean vector length (Canolty et al., 2006, Science),
+  |mean_t a_j(t) exp(i phi_i(t))|, from the product of the phase vectors
+  (n_channels, n_samples) with the amplitudes (n_samples, n_channels)
+- 'mi': modulation index (Tort et al., 2010, J Neurophysiol), the
+  normalized entropy distance to uniform of the mean amplitude of a_j in
+  n_bins bins of phi_i, the sums of amplitude per bin being accumulated
+  with np.bincount on the (bin, amplitude) indices of each phase channel
+
+Sums over samples are accumulated block by block (blocks bounded by
+spectral_engine.max_block_bytes), so data can be a memory-mapped array,
+e.g. a continuous recording.
+"""
+import numpy as np
+
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.envelope import iter_band_analytic_signals
+
+pac_methods = ['mi', 'mvl']
+
+# padding of the blocks of time points, in cycles of the lowest frequency
+pad_cycles = 20.
+
+
+def _flatten_epochs(x):
+    """ (n_channels, n_samples) time courses, epochs put end to end """
+    return np.swapaxes(x, 0, 1).reshape(x.shape[1], -1)
+
+
+def _iter_blocks(data, block_times, pad):
+    """
+    Blocks (n_epochs_block, n_channels, n_block_times + padding) of data,
+    with the slice of their time points without the padding
+
+    Whole epochs by chunks of block_times // n_times epochs if an epoch fits
+    in block_times, otherwise blocks of block_times time points of each
+    epoch, extended by up to pad time points on both sides (inside the
+    epoch, circularly), so that the band filters are not affected by the
+    block edges
+    """
+    n_epochs, n_channels, n_times = data.shape
+
+    if n_times <= block_times:
+        n_epochs_chunk = block_times // n_times
+        for start in range(0, n_epochs, n_epochs_chunk):
+            yield data[start:start + n_epochs_chunk], slice(None)
+        return
+
+    pad = min(pad, n_times)
+
+    for i_epoch in range(n_epochs):
+        for start in range(0, n_times, block_times):
+            stop = min(start + block_times, n_times)
+            # the epoch is extended circularly, as by the FFT of the epoch
+            time_idx = np.arange(start - pad, stop + pad) % n_times
+            yield (np.take(data[i_epoch:i_epoch + 1], time_idx, axis=-1),
+                   slice(pad, pad + stop - start))
+
+
+def _add_phase_bin_sums(sums, counts, phase, amps_t, n_bins):
+    """
+    Add the sums of amplitude amps_t (n_samples, n_amps) in the n_bins phase
+    bins of each channel of phase (n_channels, n_samples) to sums
+    (n_channels * n_bins, n_amps), and the number of samples per bin to
+    counts (n_channels * n_bins)
+    """
+    n_channels, n_samples = phase.shape
+    n_amps = amps_t.shape[-1]
+
+    bins = np.floor((phase + np.pi) / (2. * np.pi) * n_bins).astype(int)
+    bins = np.clip(bins, 0, n_bins - 1)
+
+    counts += np.bincount(
+        (np.arange(n_channels)[:, np.newaxis] * n_bins + bins).ravel(),
+        minlength=n_channels * n_bins)
+
+    amp_idx = np.arange(n_amps)
+
+    for i in range(n_channels):
+        # (bin, amplitude) index of each value of amps_t
+        bin_amp_idx = bins[i][:, np.newaxis] * n_amps + amp_idx
+        sums[i * n_bins:(i + 1) * n_bins] += np.bincount(
+            bin_amp_idx.ravel(), weights=amps_t.ravel(),
+            minlength=n_bins * n_amps).reshape(n_bins, n_amps)
+
+
+def compute_pac(data, sfreq, phase_bands, amp_bands, method='mi', n_bins=18):
+    """
+    Phase-amplitude coupling of all pairs of channels
+
+    data: array (n_epochs, n_channels, n_times) or (n_channels, n_times),
+    possibly memory-mapped
+    phase_bands, amp_bands: lists of [fmin, fmax] bands
+    method: 'mi' (modulation index) or 'mvl' (mean vector length)
+    n_bins: number of phase bins of the modulation index
+
+    Epochs (or continuous data) longer than a block are processed by blocks
+    of time points padded by pad_cycles cycles of the lowest frequency: the
+    band filters then differ from the ones of the whole epoch by the part
+    of their (slowly decaying, ideal band-pass) response beyond the padding,
+    which changes PAC values by less than 1% of the largest ones
+
+    Returns pac (n_channels, n_channels, n_phase_bands, n_amp_bands),
+    pac[i, j, p, a] being the coupling of the phase of channel i in band p
+    with the amplitude of channel j in band a
+    """
+    if method not in pac_methods:
+        raise ValueError('method should be one of {}, got {}'.format(
+            pac_methods, method))
+
+    if not isinstance(data, np.ndarray):
+        data = np.asarray(data)
+
+    if data.ndim == 2:
+        data = data[np.newaxis]
+
+    n_epochs, n_channels, n_times = data.shape
+
+    n_phase, n_amp = len(phase_bands), len(amp_bands)
+
+    # amplitudes first, they are used with every phase band
+    bands = list(amp_bands) + list(phase_bands)
+    fmins = [float(band[0]) for band in bands]
+    fmaxs = [float(band[1]) for band in bands]
+
+    # memory of one time point: amplitudes (and their bin indices), data,
+    # spectrum and analytic signal of one band, phase
+    sample_bytes = 8 * n_channels * (2 * n_amp + 8)
+    pad = int(np.ceil(pad_cycles * sfreq / max(min(fmins), 1.)))
+
+    # padded blocks bounded by max_block_bytes, unless pad is longer
+    block_times = spectral_engine.max_block_bytes // sample_bytes
+    if block_times < n_times:
+        block_times -= 2 * pad
+    block_times = int(max(block_times, pad, 1))
+
+    if method == 'mvl':
+        sums = np.zeros((n_phase, n_channels, n_amp * n_channels),
+                        dtype=np.complex128)
+    else:
+        sums = np.zeros((n_phase, n_channels * n_bins, n_amp * n_channels))
+        counts = np.zeros((n_phase, n_channels * n_bins), dtype=int)
+
+    n_samples = 0
+
+    for block, keep in _iter_blocks(data, block_times, pad):
+
+        block = np.asarray(block, dtype=np.float64)
+
+        amps = []
+
+        for b, z in enumerate(iter_band_analytic_signals(block, sfreq, fmins,
+                                                         fmaxs)):
+
+            if b < n_amp:
+                amps.append(_flatten_epochs(np.abs(z[..., keep])))
+                continue
+
+            if b == n_amp:
+                amps_t = np.concatenate(amps).T
+                del amps
+
+            p = b - n_amp
+            phase = np.angle(_flatten_epochs(z[..., keep]))
+            del z
+
+            if method == 'mvl':
+                sums[p] += np.dot(np.exp(1j * phase), amps_t)
+            else:
+                _add_phase_bin_sums(sums[p], counts[p], phase, amps_t, n_bins)
+
+        n_samples += amps_t.shape[0]
+
+    if method == 'mvl':
+        pac = np.abs(sums) / n_samples
+    else:
+        counts[counts == 0] = 1
+        mean_amps = sums / counts[..., np.newaxis]
+
+        # (n_phase, n_channels, n_bins, n_amp * n_channels)
+        mean_amps = mean_amps.reshape(n_phase, n_channels, n_bins, -1)
+
+        total_amps = np.sum(mean_amps, axis=-2)[..., np.newaxis, :]
+        total_amps[total_amps == 0.] = 1.
+        amp_dist = mean_amps / total_amps
+
+        log_dist = np.log(np.where(amp_dist > 0., amp_dist, 1.))
+        entropy = -np.sum(amp_dist * log_dist, axis=-2)
+
+        pac = (np.log(n_bins) - entropy) / np.log(n_bins)
+
+    # (n_phase, n_channels, n_amp, n_channels) -> channels first
+    pac = pac.reshape(n_phase, n_channels, n_amp, n_channels)
+
+    return np.transpose(pac, (1, 3, 0, 2))
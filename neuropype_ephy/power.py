@@ -1,13 +1,19 @@
 def compute_and_save_psd(epochs_fname, fmin=0, fmax=120,
                          method='welch', n_fft=256, n_overlap=0, 
-                         picks=None, proj=False, n_jobs=1, verbose=None):
+                         picks=None, proj=False, n_jobs=1, verbose=None,
+                         dtype='float64'):
     """
     Load epochs from file,
     compute psd and save the result in numpy arrays
+    (multitaper tapers are read from the window cache, see
+    neuropype_ephy.window_cache)
+    psds are computed by mne in float64 and saved as dtype ('float32': relative
+    error ~1e-7, i.e. ~1e-6 dB, half the size)
     """
     import numpy as np
     import os
     from mne import read_epochs
+    from neuropype_ephy.window_cache import cached_spectral_windows
     epochs = read_epochs(epochs_fname)
     epochs_meg = epochs.pick_types(meg=True, eeg=False, eog=False, ecg=False)
     if method == 'welch':
@@ -15,7 +21,8 @@ def compute_and_save_psd(epochs_fname, fmin=0, fmax=120,
         psds, freqs = psd_welch(epochs_meg)
     elif method == 'multitaper':
         from mne.time_frequency import psd_multitaper
-        psds, freqs = psd_multitaper(epochs_meg)
+        with cached_spectral_windows():
+            psds, freqs = psd_multitaper(epochs_meg)
     else:
         raise Exception('nonexistent method for psd computation')
     path, name = os.path.split(epochs_fname)
@@ -24,6 +31,6 @@ def compute_and_save_psd(epochs_fname, fmin=0, fmax=120,
     # freqs_fname = base + '-freqs.npy'
     psds_fname = os.path.abspath(psds_fname)
     # print(psds.shape)
-    np.savez(psds_fname, psds=psds, freqs=freqs)
+    np.savez(psds_fname, psds=psds.astype(dtype), freqs=freqs)
     # np.save(freqs_file, freqs)
     return psds_fname
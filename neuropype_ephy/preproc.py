@@ -1,7 +1,21 @@
 # -*- coding: utf-8 -*-
 
-def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space):
+def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space, dtype = 'float64', streaming = False, resample_method = 'fft'):
 
+    """
+    Filter and downsample MEG channels of a raw fif file, and save them in a 
+    .npy ts_file of dtype ('float32' keeps ~7 significant digits, i.e. a relative 
+    error ~1e-7, far below the sensor noise, and halves disk use and RAM downstream)
+    
+    If streaming is True, the fif file is not preloaded: channels are read by overlapping 
+    blocks, low-pass filtered and resampled (polyphase) block by block, and written 
+    directly in the memory-mapped ts_file (see neuropype_ephy.chunked_preproc), peak 
+    memory being a few blocks whatever the length of the recording (sensor space only)
+    
+    resample_method = 'polyphase' replaces the low-pass filter and the FFT resampling of mne 
+    by a single rational polyphase filter, the low-pass at h_freq being fused with the 
+    anti-alias filter (see neuropype_ephy.chunked_preproc.resample_polyphase)
+    """
     import os
     import numpy as np
 
@@ -14,7 +28,11 @@ def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space):
     print data_path
 
     print fif_file
-    raw = Raw(fif_file,preload = True)
+    
+    if streaming and not is_sensor_space:
+        raise ValueError("streaming preprocessing only saves sensor time series (is_sensor_space = True)")
+        
+    raw = Raw(fif_file,preload = not streaming)
     print raw
     print len(raw.ch_names)
 
@@ -41,13 +59,29 @@ def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space):
     
     	### filtering + downsampling
     
-    data,times = raw[select_sensors,:]
-    print data.shape
-    print raw.info['sfreq']
+    ts_file = os.path.abspath(basename +'.npy')
     
-    raw.filter(l_freq = None, h_freq = h_freq,picks = select_sensors)
+    if streaming:
+        
+        from neuropype_ephy.chunked_preproc import filter_resample_raw_to_npy
+        
+        ts_file,sfreq = filter_resample_raw_to_npy(raw, select_sensors, ts_file, h_freq = h_freq, down_sfreq = down_sfreq, dtype = dtype)
+        
+        print "streamed {} channels at {} Hz in {}".format(len(select_sensors),sfreq,ts_file)
+        
+        return ts_file,channel_coords_file,channel_names_file,sfreq
     
-    raw.resample(sfreq = down_sfreq,npad = 0,stim_picks = select_sensors)
+    if resample_method == 'polyphase':
+        
+        from neuropype_ephy.chunked_preproc import resample_raw_polyphase
+        
+        raw = resample_raw_polyphase(raw, down_sfreq, h_freq = h_freq)
+        
+    else:
+        
+        raw.filter(l_freq = None, h_freq = h_freq,picks = select_sensors)
+        
+        raw.resample(sfreq = down_sfreq,npad = 0,stim_picks = select_sensors)
     
     
     ### save data
@@ -56,9 +90,7 @@ def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space):
     print raw.info['sfreq']
     	#0/0
     
-    ts_file = os.path.abspath(basename +'.npy')
-    
-    np.save(ts_file,data)    
+    np.save(ts_file,data.astype(dtype))    
     
     if is_sensor_space:
         return ts_file,channel_coords_file,channel_names_file,raw.info['sfreq']
@@ -68,7 +100,13 @@ def preprocess_fif_to_ts(fif_file, l_freq, h_freq, down_sfreq, is_sensor_space):
 
 def preprocess_ICA_fif_to_ts(fif_file, subject_id, ECG_ch_name, EoG_ch_name,
                              reject, l_freq, h_freq, down_sfreq, variance,
-                             is_sensor_space, data_type):
+                             is_sensor_space, data_type, resample_method='fft'):
+    """
+    resample_method = 'polyphase' downsamples the ICA cleaned data with a
+    rational polyphase filter (see neuropype_ephy.chunked_preproc) instead of
+    the FFT resampling of mne; the band-pass filter applied before fitting
+    the ICA is kept
+    """
     import os
     import numpy as np
 
@@ -317,7 +355,12 @@ def preprocess_ICA_fif_to_ts(fif_file, subject_id, ECG_ch_name, EoG_ch_name,
     raw_cleaned_file = os.path.join(subj_path, basename + '-cleaned-raw.fif')
     raw_ica = ica.apply(raw)
 
-    raw_ica.resample(sfreq=down_sfreq, npad=0)
+    if resample_method == 'polyphase':
+        from neuropype_ephy.chunked_preproc import resample_raw_polyphase
+
+        raw = raw_ica = resample_raw_polyphase(raw_ica, down_sfreq)
+    else:
+        raw_ica.resample(sfreq=down_sfreq, npad=0)
     raw_ica.save(raw_cleaned_file, overwrite=True)
 
     # save ICA solution
@@ -344,7 +387,11 @@ def preprocess_ICA_fif_to_ts(fif_file, subject_id, ECG_ch_name, EoG_ch_name,
 
 def preprocess_set_ICA_comp_fif_to_ts(fif_file, subject_id, n_comp_exclude,
                                       l_freq, h_freq, down_sfreq,
-                                      is_sensor_space):
+                                      is_sensor_space, resample_method='fft'):
+    """
+    resample_method: 'fft' (mne resample) or 'polyphase', as in
+    preprocess_ICA_fif_to_ts
+    """
     import os
     import numpy as np
     import sys
@@ -449,7 +496,12 @@ def preprocess_set_ICA_comp_fif_to_ts(fif_file, subject_id, n_comp_exclude,
     raw_cleaned_file = os.path.join(subj_path, basename + '-cleaned-raw.fif')
     raw_ica = ica.apply(raw)
 
-    raw_ica.resample(sfreq=down_sfreq, npad=0)
+    if resample_method == 'polyphase':
+        from neuropype_ephy.chunked_preproc import resample_raw_polyphase
+
+        raw = raw_ica = resample_raw_polyphase(raw_ica, down_sfreq)
+    else:
+        raw_ica.resample(sfreq=down_sfreq, npad=0)
 
     raw_ica.save(raw_cleaned_file, overwrite=True)
 
@@ -475,8 +527,15 @@ def preprocess_set_ICA_comp_fif_to_ts(fif_file, subject_id, n_comp_exclude,
         return raw_cleaned_file, channel_coords_file, channel_names_file, raw.info['sfreq']
 
 
-def preprocess_ts(ts_file,orig_channel_names_file,orig_channel_coords_file, h_freq, orig_sfreq, down_sfreq ,prefiltered = False):
+def preprocess_ts(ts_file,orig_channel_names_file,orig_channel_coords_file, h_freq, orig_sfreq, down_sfreq ,prefiltered = False, resample_method = 'fft'):
+    
+    """
+    Downsample the time series of ts_file from orig_sfreq to down_sfreq
     
+    resample_method = 'polyphase' uses a single rational polyphase filter (anti-alias filter, 
+    fused with a low-pass at h_freq if the data are not prefiltered) instead of the mne 
+    low-pass filter and FFT resampling (see neuropype_ephy.chunked_preproc.resample_polyphase)
+    """
     from mne.io import RawArray	
 	
     from mne import create_info
@@ -517,6 +576,19 @@ def preprocess_ts(ts_file,orig_channel_names_file,orig_channel_coords_file, h_fr
         
         print ts.shape
         
+        if resample_method == 'polyphase':
+            
+            from neuropype_ephy.chunked_preproc import resample_polyphase
+            
+            downsampled_ts,sfreq = resample_polyphase(ts, orig_sfreq, down_sfreq, h_freq = None if prefiltered else h_freq)
+            
+            downsampled_ts_file = os.path.abspath('downsampled_ts.npy')
+            
+            np.save(downsampled_ts_file,downsampled_ts)
+            
+            print downsampled_ts.shape
+            
+            return downsampled_ts_file,channel_coords_file,channel_names_file,sfreq
         
         raw = RawArray(ts, info = create_info(ch_names = elec_names, sfreq = orig_sfreq))
         
@@ -548,36 +620,58 @@ def preprocess_ts(ts_file,orig_channel_names_file,orig_channel_coords_file, h_fr
         return ts_file,channel_coords_file,channel_names_file,orig_sfreq
 
 
+_fif_info_cache = {}
+
+
+def read_fif_info(fif_fname):
+    """
+    Measurement info of a raw or epochs fif file, read from its header only
+    (mne.io.read_info, no data is loaded)
+
+    Infos are kept in memory by path, modification time and size of the
+    file, so that the nodes (and connect-time functions) of a pipeline share
+    one parsed info; each call returns a copy, which can be modified
+    """
+    import os
+
+    from mne.io import read_info
+
+    stat = os.stat(fif_fname)
+    key = (os.path.abspath(fif_fname), stat.st_mtime, stat.st_size)
+
+    if key not in _fif_info_cache:
+        _fif_info_cache[key] = read_info(fif_fname)
+
+    return _fif_info_cache[key].copy()
+
+
 def get_raw_info(raw_fname):
-    from mne.io import read_raw_fif
+    from neuropype_ephy.preproc import read_fif_info
 
-    raw = read_raw_fif(raw_fname, preload=True)
+    info = read_fif_info(raw_fname)
 
-    try:
-        raw.info['filename']
-    except:
-        raw.info['filename'] = raw_fname
+    if info.get('filename') is None:
+        info['filename'] = raw_fname
 
-    return raw.info
+    return info
 
 
 def get_epochs_info(raw_fname):
-    from mne import read_epochs
+    from neuropype_ephy.preproc import read_fif_info
 
-    epochs = read_epochs(raw_fname)
-    return epochs.info
+    return read_fif_info(raw_fname)
 
 
 def get_fif_info(fif_fname):
-    from mne.io import read_info
+    from neuropype_ephy.preproc import read_fif_info
 
-    return read_info(fif_fname)
+    return read_fif_info(fif_fname)
 
 
 def get_raw_sfreq(raw_fname):
-    from mne.io import read_info
+    from neuropype_ephy.preproc import read_fif_info
 
-    info = read_info(raw_fname)
+    info = read_fif_info(raw_fname)
     return info['sfreq']
 
 
@@ -599,8 +693,15 @@ def create_reject_dict(raw_info):
     return reject
 
 
-def create_ts(raw_fname):
+def create_ts(raw_fname, dtype = 'float64', streaming = False):
     
+    """
+    Save MEG channels of a raw fif file in a .npy ts_file of dtype
+    ('float32': relative error ~1e-7, half the size)
+    
+    If streaming is True, the fif file is not preloaded and channels are copied 
+    block by block in the memory-mapped ts_file (see neuropype_ephy.chunked_preproc)
+    """
     import os
     import numpy as np
 
@@ -609,7 +710,7 @@ def create_ts(raw_fname):
 
     from nipype.utils.filemanip import split_filename as split_f
 
-    raw = Raw(raw_fname, preload=True)
+    raw = Raw(raw_fname, preload=not streaming)
 
     subj_path, basename, ext = split_f(raw_fname)
 
@@ -630,12 +731,18 @@ def create_ts(raw_fname):
     channel_names_file = os.path.abspath('correct_channel_names.txt')
     np.savetxt(channel_names_file, sens_names, fmt='%s')
 
-    data, times = raw[select_sensors, :]
+    ts_file = os.path.abspath(basename + '.npy')
 
-    print data.shape
+    if streaming:
+        from neuropype_ephy.chunked_preproc import filter_resample_raw_to_npy
 
-    ts_file = os.path.abspath(basename + '.npy')
-    np.save(ts_file, data)
+        filter_resample_raw_to_npy(raw, select_sensors, ts_file, dtype=dtype)
+    else:
+        data, times = raw[select_sensors, :]
+
+        print data.shape
+
+        np.save(ts_file, data.astype(dtype))
     print '\n *** TS FILE ' + ts_file + '*** \n'
 
     return ts_file, channel_coords_file, channel_names_file, raw.info['sfreq']
\ No newline at end of file
@@ -2,41 +2,200 @@
 
 import numpy as np
 
+### metrics with con(j,i) = -con(i,j): negated (instead of conjugated) when moved across the diagonal
+antisymmetric_con_methods = ['imcoh']
+
+def swap_con_direction(con, con_method):
+    
+    """
+    Values of con for the transposed pairs (j,i): negated for antisymmetric metrics 
+    (imcoh), conjugated otherwise (no change for real symmetric metrics, conjugate 
+    for cohy)
+    """
+    import numpy as np
+    
+    if con_method in antisymmetric_con_methods:
+        return -con
+    
+    return np.conj(con)
 
-################################################### compute spectral connectivity #############################################################################"
 
-def compute_and_save_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index = 0,mode = 'multitaper',export_to_matlab = False):
+################################################### compute spectral connectivity #############################################################################"
 
+def compute_and_save_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index = 0,mode = 'multitaper',export_to_matlab = False, freq_band_names = None, backend = 'mne', n_jobs = 1, indices = None, conmat_format = 'npy', dtype = 'float64'):
+
+    """
+    Compute spectral connectivity and save one conmat file per frequency band
+
+    fmin and fmax are either floats (one band, one conmat file returned) or
+    lists of the same length (several bands, list of conmat files returned).
+    In the latter case all bands are computed from a single spectral
+    transform of the data: the tapered FFT (or wavelet transform) is done
+    once and only the averaging over frequency bins differs between bands.
+
+    con_method can also be a list of metrics: they are all derived from the
+    same cross-spectral densities (only the final reduction differs), and
+    one conmat file is saved per metric and per band.
+
+    backend = 'numpy' uses the batched engine of neuropype_ephy.spectral_engine
+    instead of mne spectral_connectivity; in cwt_morlet mode, the time average is
+    accumulated by chunks of frequencies and node pairs, so that the
+    n_nodes * n_nodes * n_times connectivity is never allocated
+
+    n_jobs is the number of processes the epochs are spread over
+
+    indices = (seeds,targets) (see get_seed_target_indices) restricts the
+    computation to these node pairs: the result is then saved as a pair
+    list (conmat_*_pairs.npz, see load_conmat_pairs) instead of a dense
+    n_nodes * n_nodes matrix
+
+    conmat_format = 'packed' saves only the n_nodes*(n_nodes-1)/2 lower
+    triangular values as float32, with a header (method, band, sfreq, number
+    of labels), in conmat_*_packed.npz files (see save_packed_conmat and
+    load_packed_conmat), instead of dense .npy files
+
+    DPSS tapers and Morlet wavelets are read from the window cache when they 
+    were already computed with the same parameters (see neuropype_ephy.window_cache)
+
+    dtype = 'float32' keeps data, spectra and cross-spectral sums in float32/complex64 
+    with the numpy backend, and saves float32 (complex64 for cohy) conmats. FFTs are 
+    computed in single precision (scipy.fftpack); the difference with float64 is of the order 
+    of 1e-7 on coherence-type metrics, sign-based metrics (pli) may differ more 
+    (up to ~1e-5) for pairs whose imaginary cross-spectrum is close to 0. With the 
+    mne backend, computations are in float64 and only the conmats are cast.
+
+    con_method can also be 'aec' (amplitude envelope correlation) or 'aec_orth' 
+    (envelope correlation of pairwise orthogonalized signals), computed from batched 
+    band-limited Hilbert transforms (see neuropype_ephy.envelope) whatever the mode 
+    and backend, and saved in the same conmat files
+    """
     import sys,os
     from mne.connectivity import spectral_connectivity
+    
+    from neuropype_ephy.window_cache import cached_spectral_windows
+    from neuropype_ephy.envelope import envelope_methods, envelope_connectivity
 
     import numpy as np
-    from scipy.io import savemat
+    
+    data = np.asarray(data).astype(dtype, copy = False)
     
     print data.shape
 
+    is_multi_band = isinstance(fmin,(list,tuple,np.ndarray))
+
+    is_multi_method = isinstance(con_method,(list,tuple))
+
+    if is_multi_method:
+        con_methods = list(con_method)
+    else:
+        con_methods = [con_method]
+
+    if is_multi_band:
+        fmins = [float(f) for f in fmin]
+        fmaxs = [float(f) for f in fmax]
+    else:
+        fmins = [float(fmin)]
+        fmaxs = [float(fmax)]
+
+    assert len(fmins) == len(fmaxs), "Error, fmin and fmax should have the same length ({} != {})".format(len(fmins),len(fmaxs))
+
+    if freq_band_names is None:
+        if is_multi_band:
+            freq_band_names = ["{}-{}Hz".format(f_lo,f_hi) for f_lo,f_hi in zip(fmins,fmaxs)]
+    else:
+        assert len(freq_band_names) == len(fmins), "Error, one name should be given for each frequency band"
+
     if len(data.shape) < 3:
-        if con_method in ['coh','cohy','imcoh']:
+        if all([method in ['coh','cohy','imcoh'] + envelope_methods for method in con_methods]):
             data = data.reshape(1,data.shape[0],data.shape[1])
 
-        elif con_method in ['pli','plv','ppc' ,'pli','pli2_unbiased' ,'wpli' ,'wpli2_debiased']:
+        elif any([method in ['pli','plv','ppc' ,'pli','pli2_unbiased' ,'wpli' ,'wpli2_debiased'] for method in con_methods]):
             print "warning, only work with epoched time series"
             sys.exit()
         
-    if mode == 'multitaper':
+    ### envelope methods do not depend on the spectral transform
+    env_con_methods = [method for method in con_methods if method in envelope_methods]
+    spectral_con_methods = [method for method in con_methods if method not in envelope_methods]
+    
+    if len(env_con_methods):
         
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, sfreq=sfreq, fmin= fmin, fmax=fmax, faverage=True, tmin=None, mode = 'multitaper',   mt_adaptive=False, n_jobs=1)
+        env_con_matrix, env_freqs = envelope_connectivity(data, env_con_methods, sfreq, fmin = fmins, fmax = fmaxs, indices = indices)
         
-        con_matrix = np.array(con_matrix[:,:,0])
-
-    elif mode == 'cwt_morlet':
+        env_con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in env_con_matrix]
+        
+    if len(spectral_con_methods) == 0:
+        
+        con_matrices = []
+        
+    elif backend == 'numpy' and mode not in ['multitaper','cwt_morlet']:
+        
+        print "Error, mode = %s not implemented with numpy backend"%(mode)
+        
+        return []
+        
+    if mode == 'cwt_morlet' and len(spectral_con_methods):
+        
+        ### all bands share the same wavelet transform, on the 1 Hz grid np.arange(fmin, fmax) of each band; 
+        ### frequencies below 5 cycles are discarded as mne does by default (band limits are only clipped 
+        ### so that mne does not warn, the grid is unchanged)
+        five_cycle_freq = 5. * sfreq / data.shape[-1]
         
-        frequencies = np.arange(fmin, fmax, 1)
+        band_grids = [np.arange(f_lo, f_hi, 1) for f_lo,f_hi in zip(fmins,fmaxs)]
+        
+        frequencies = np.unique(np.concatenate(band_grids))
+        frequencies = frequencies[frequencies >= five_cycle_freq]
         n_cycles = frequencies / 7.
+        
+        ### each band averages the frequencies of its own grid only (the inclusive fmin <= f <= fmax 
+        ### selection would add the lower edge of the next band), as if it was computed alone
+        band_freq_idx = [np.where(np.in1d(frequencies, band_grid))[0] for band_grid in band_grids]
+        
+        fmins = [max(f_lo,five_cycle_freq) for f_lo in fmins]
+        
+    if len(spectral_con_methods) == 0:
+        
+        pass
+        
+    elif mode == 'multitaper' and backend == 'numpy':
+        
+        from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+        
+        con_matrix, freqs = spectral_connectivity_numpy(data, spectral_con_methods, sfreq, fmin = fmins, fmax = fmaxs, n_jobs = n_jobs, indices = indices)
+        
+        con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in con_matrix]
+        
+    elif mode == 'multitaper':
+        
+        with cached_spectral_windows():
+            con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=spectral_con_methods, sfreq=sfreq, fmin= tuple(fmins), fmax=tuple(fmaxs), faverage=True, tmin=None, mode = 'multitaper',   mt_adaptive=False, n_jobs=n_jobs, indices = indices)
+        
+        if len(spectral_con_methods) == 1:
+            con_matrix = [con_matrix]
+        
+        con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in con_matrix]
 
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, sfreq=sfreq, faverage=True, tmin=None, mode='cwt_morlet',   cwt_frequencies= frequencies, cwt_n_cycles= n_cycles, n_jobs=1)
+    elif mode == 'cwt_morlet' and backend == 'numpy':
+        
+        from neuropype_ephy.spectral_engine import spectral_connectivity_morlet
+        
+        ### time average accumulated by chunks of frequencies and pairs, without the n_nodes * n_nodes * n_times connectivity
+        con_matrix, freqs = spectral_connectivity_morlet(data, spectral_con_methods, sfreq, fmin = fmins, fmax = fmaxs, 
+                                                         freqs = frequencies, n_cycles = n_cycles, indices = indices, freq_idx_bands = band_freq_idx)
         
-        con_matrix = np.mean(np.array(con_matrix[:,:,0,:]),axis = 2)
+        con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in con_matrix]
+        
+    elif mode == 'cwt_morlet':
+        
+        with cached_spectral_windows():
+            con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=spectral_con_methods, sfreq=sfreq, fmin= tuple(fmins), fmax=tuple(fmaxs), faverage=False, tmin=None, mode='cwt_morlet',   cwt_frequencies= frequencies, cwt_n_cycles= n_cycles, n_jobs=n_jobs, indices = indices)
+        
+        if len(spectral_con_methods) == 1:
+            con_matrix = [con_matrix]
+        
+        ### average over the frequencies of each band grid (instead of mne faverage) and over time
+        band_freq_idx = [np.where(np.in1d(freqs, frequencies[freq_idx]))[0] for freq_idx in band_freq_idx]
+        
+        con_matrices = [[np.mean(np.mean(np.array(method_con_matrix[...,freq_idx,:]),axis = -1),axis = -1) for freq_idx in band_freq_idx] for method_con_matrix in con_matrix]
     
     else:
         
@@ -44,37 +203,675 @@ def compute_and_save_spectral_connectivity(data,con_method,sfreq,fmin,fmax,index
         
         return []
 
-    print con_matrix.shape
-    print np.min(con_matrix),np.max(con_matrix)
+    if len(env_con_methods):
+        
+        ### back to the order of con_methods
+        con_matrices = [env_con_matrices[env_con_methods.index(method)] if method in envelope_methods 
+                        else con_matrices[spectral_con_methods.index(method)] for method in con_methods]
+        
+    if np.dtype(dtype) == np.float32:
+        con_matrices = [[con_matrix.astype(np.complex64 if np.iscomplexobj(con_matrix) else np.float32) for con_matrix in method_con_matrices] 
+                        for method_con_matrices in con_matrices]
+        
+    ### band names are only added to file names for multi-band computations
+    if not is_multi_band:
+        freq_band_names = None
+        
+    conmat_files = _save_conmats(con_matrices, con_methods, fmins, fmaxs, sfreq, index = index, freq_band_names = freq_band_names, 
+                                 indices = indices, n_nodes = data.shape[-2], export_to_matlab = export_to_matlab, conmat_format = conmat_format)
+        
+    if is_multi_band or is_multi_method:
+        return conmat_files
+    else:
+        return conmat_files[0]
 
-    conmat_file = os.path.abspath("conmat_" + str(index) + "_" + con_method + ".npy")
+def _save_conmats(con_matrices, con_methods, fmins, fmaxs, sfreq, index = 0, freq_band_names = None, indices = None, n_nodes = None, export_to_matlab = False, conmat_format = 'npy', directed = False):
+    
+    """
+    Save the conmats con_matrices[method][band] in the format chosen in 
+    compute_and_save_spectral_connectivity (the band name is added to the file name 
+    if freq_band_names is given), returns the list of conmat files
+    
+    directed conmats are full (non symmetric) matrices: they are exported as is to matlab
+    """
+    import os
+    import numpy as np
+    from scipy.io import savemat
+    
+    conmat_files = []
     
-    np.save(conmat_file,con_matrix)
+    for method,method_con_matrices in zip(con_methods,con_matrices):
+        
+        for i,con_matrix in enumerate(method_con_matrices):
+            
+            print method
+            print con_matrix.shape
+            print np.min(con_matrix),np.max(con_matrix)
+
+            if freq_band_names is not None:
+                conmat_basename = "conmat_" + str(index) + "_" + method + "_" + freq_band_names[i]
+            else:
+                conmat_basename = "conmat_" + str(index) + "_" + method
+                
+            if indices is not None:
+                
+                ### compact pair list: only the computed (seed,target) pairs are stored
+                conmat_file = os.path.abspath(conmat_basename + "_pairs.npz")
+                
+                np.savez(conmat_file, indices = np.array(indices), con = con_matrix, n_nodes = n_nodes, 
+                         con_method = method, directed = directed)
+                
+                if export_to_matlab == True:
+                    
+                    conmat_matfile = os.path.abspath(conmat_basename + "_pairs.mat")
+                    
+                    ### indices are 1-based in matlab
+                    savemat(conmat_matfile,{"indices":np.array(indices) + 1, "conmat_pairs":con_matrix})
+                    
+            elif conmat_format == 'packed':
+                
+                conmat_file = os.path.abspath(conmat_basename + "_packed.npz")
+                
+                save_packed_conmat(conmat_file, con_matrix, method, [fmins[i],fmaxs[i]], sfreq)
+                
+                if export_to_matlab == True:
+                    
+                    conmat_matfile = os.path.abspath(conmat_basename + "_packed.mat")
+                    
+                    savemat(conmat_matfile,dict(np.load(conmat_file)))
+                    
+            else:
+                
+                conmat_file = os.path.abspath(conmat_basename + ".npy")
+                
+                np.save(conmat_file,con_matrix)
 
-    if export_to_matlab == True:
+                if export_to_matlab == True:
+                    
+                    conmat_matfile = os.path.abspath(conmat_basename + ".mat")
+                    
+                    if directed:
+                        savemat(conmat_matfile,{"conmat":con_matrix})
+                    else:
+                        savemat(conmat_matfile,{"conmat":con_matrix + np.transpose(con_matrix)})
+                
+            conmat_files.append(conmat_file)
         
-        conmat_matfile = os.path.abspath("conmat_" + str(index) + "_" + con_method + ".mat")
+    return conmat_files
+
+def epoch_continuous_data(data, sfreq, epoch_window_length, epoch_overlap = 0.):
+    
+    """
+    Epochs (nb_epochs * nb_nodes * epoch_length) of a continuous recording data 
+    (nb_nodes * nb_timepoints), as a view built with stride tricks: no data is copied, 
+    and data can be a memory-mapped array (np.load(ts_file, mmap_mode = 'r'))
+    
+    epochs are windows of epoch_window_length seconds, consecutive windows overlapping 
+    by a fraction epoch_overlap of their length (0 for contiguous windows, 0.5 for 
+    Welch-style half-overlapping windows); the rest at the end of the recording is discarded
+    
+    The returned view is read-only, as overlapping epochs share their memory
+    """
+    import numpy as np
+    
+    if not 0. <= epoch_overlap < 1.:
+        raise ValueError("epoch_overlap should be in [0, 1), got {}".format(epoch_overlap))
+    
+    data = np.asarray(data)
+    
+    epoch_length = int(epoch_window_length * sfreq)
+    
+    step = max(int(round(epoch_length * (1. - epoch_overlap))), 1)
+    
+    if epoch_length < 1 or data.shape[1] < epoch_length:
+        raise ValueError("recording of {} time points is shorter than one epoch ({} time points)".format(data.shape[1],epoch_length))
+    
+    nb_epochs = (data.shape[1] - epoch_length) // step + 1
+    
+    return np.lib.stride_tricks.as_strided(data, shape = (nb_epochs,data.shape[0],epoch_length), 
+                                           strides = (step * data.strides[1],data.strides[0],data.strides[1]), 
+                                           writeable = False)
+    
+def iter_epoch_chunks(ts_file, sfreq = None, epoch_window_length = None, n_epochs_chunk = 50, dtype = None, epoch_overlap = 0.):
+    
+    """
+    Read the epochs of ts_file chunk by chunk from a memory-mapped array, 
+    without loading the whole file
+    
+    ts_file contains either epochs (nb_epochs * nb_nodes * nb_timepoints), or a continuous 
+    recording (nb_nodes * nb_timepoints) cut in windows of epoch_window_length seconds, 
+    overlapping by a fraction epoch_overlap of their length (see epoch_continuous_data; 
+    the rest is discarded, as in SpectralConn)
+    
+    yields arrays of at most n_epochs_chunk epochs (n_epochs_chunk * nb_nodes * epoch_length), 
+    cast to dtype if given (dtype of ts_file otherwise)
+    """
+    import numpy as np
+    
+    data = np.load(ts_file, mmap_mode = 'r')
+    
+    if data.ndim == 2 and epoch_window_length is not None:
+        
+        data = epoch_continuous_data(data, sfreq, epoch_window_length, epoch_overlap)
         
-        savemat(conmat_matfile,{"conmat":con_matrix + np.transpose(con_matrix)})
+    elif data.ndim != 3:
         
+        raise ValueError("ts_file should contain epochs (3D), or continuous data (2D) with epoch_window_length, got shape {}".format(data.shape))
+        
+    for start in range(0,data.shape[0],n_epochs_chunk):
+        yield np.array(data[start:start + n_epochs_chunk],dtype = dtype)
+        
+def compute_and_save_streamed_spectral_connectivity(ts_file,con_method,sfreq,fmin,fmax,epoch_window_length = None,epoch_overlap = 0.,n_epochs_chunk = 50,index = 0,export_to_matlab = False, freq_band_names = None, indices = None, conmat_format = 'npy', use_csd_cache = False, dtype = 'float64', csd_cache_dir = None):
+    
+    """
+    Same as compute_and_save_spectral_connectivity (numpy backend, multitaper mode), 
+    but epochs are read from the memory-mapped ts_file by chunks of n_epochs_chunk 
+    (see iter_epoch_chunks, continuous recordings being cut in windows of epoch_window_length 
+    seconds overlapping by a fraction epoch_overlap) and the cross-spectral sums are accumulated 
+    chunk by chunk: peak memory is bounded by one chunk, whatever the length of the recording
+    
+    If use_csd_cache is True, the cross-spectral sums are read from (or stored in) the 
+    cache of neuropype_ephy.csd_cache, keyed by the contents of ts_file and the epoching: 
+    other metrics or bands inside the cached frequency range are then computed without 
+    any new spectral transform. The cache is stored in csd_cache_dir (by default, the directory 
+    set by the NEUROPYPE_EPHY_CSD_CACHE_DIR environment variable, a ValueError being raised 
+    if neither is given)
+    
+    dtype is the precision of the computation (see compute_and_save_spectral_connectivity), 
+    epochs being cast chunk by chunk
+    """
+    import numpy as np
+    
+    from neuropype_ephy.spectral_engine import spectral_connectivity_stream
+    from neuropype_ephy.csd_cache import cached_spectral_connectivity
+    
+    is_multi_band = isinstance(fmin,(list,tuple,np.ndarray))
+    
+    is_multi_method = isinstance(con_method,(list,tuple))
+
+    if is_multi_method:
+        con_methods = list(con_method)
+    else:
+        con_methods = [con_method]
+        
+    if is_multi_band:
+        fmins = [float(f) for f in fmin]
+        fmaxs = [float(f) for f in fmax]
+        
+        if freq_band_names is None:
+            freq_band_names = ["{}-{}Hz".format(f_lo,f_hi) for f_lo,f_hi in zip(fmins,fmaxs)]
+    else:
+        fmins = [float(fmin)]
+        fmaxs = [float(fmax)]
+        freq_band_names = None
+        
+    ts_shape = np.load(ts_file, mmap_mode = 'r').shape
+    
+    if len(ts_shape) == 2 and epoch_window_length is None:
+        raise ValueError("continuous data (2D ts_file {}) need epoch_window_length to be streamed".format(ts_file))
+    
+    n_nodes = ts_shape[-2]
+        
+    if use_csd_cache:
+        
+        epoch_chunks_fun = lambda : iter_epoch_chunks(ts_file, sfreq, epoch_window_length = epoch_window_length, n_epochs_chunk = n_epochs_chunk, dtype = dtype, epoch_overlap = epoch_overlap)
+        
+        con_matrix, freqs = cached_spectral_connectivity(ts_file, epoch_chunks_fun, con_methods, sfreq, fmin = fmins, fmax = fmaxs, 
+                                                         epoch_window_length = epoch_window_length, indices = indices, dtype = dtype, epoch_overlap = epoch_overlap,
+                                                         csd_cache_dir = csd_cache_dir)
+        
+    else:
+        
+        epoch_chunks = iter_epoch_chunks(ts_file, sfreq, epoch_window_length = epoch_window_length, n_epochs_chunk = n_epochs_chunk, dtype = dtype, epoch_overlap = epoch_overlap)
+        
+        con_matrix, freqs = spectral_connectivity_stream(epoch_chunks, con_methods, sfreq, fmin = fmins, fmax = fmaxs, indices = indices)
+    
+    con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in con_matrix]
+    
+    conmat_files = _save_conmats(con_matrices, con_methods, fmins, fmaxs, sfreq, index = index, freq_band_names = freq_band_names, 
+                                 indices = indices, n_nodes = n_nodes, export_to_matlab = export_to_matlab, conmat_format = conmat_format)
+    
+    if is_multi_band or is_multi_method:
+        return conmat_files
+    else:
+        return conmat_files[0]
+    
+def compute_and_save_directed_connectivity(data,con_method,sfreq,fmin,fmax,order = 10,index = 0,export_to_matlab = False, freq_band_names = None, indices = None, dtype = 'float64'):
+    
+    """
+    Directed connectivity ('gc', 'pdc' or 'dtf', or a list of them) of a MVAR model of 
+    the given order fitted on all the epochs of data (see neuropype_ephy.mvar), saved 
+    with the conventions of compute_and_save_spectral_connectivity (one conmat file 
+    per method and per band)
+    
+    Conmats are full n_nodes * n_nodes .npy matrices, conmat[i,j] being the influence 
+    of node j on node i; with indices = (seeds,targets), the influence of each seed on 
+    its target is saved as a pair list (see load_conmat_pairs)
+    """
+    import numpy as np
+    
+    from neuropype_ephy.mvar import directed_connectivity
+    
+    data = np.asarray(data).astype(dtype, copy = False)
+    
+    print data.shape
+    
+    is_multi_band = isinstance(fmin,(list,tuple,np.ndarray))
+    
+    is_multi_method = isinstance(con_method,(list,tuple))
+
+    if is_multi_method:
+        con_methods = list(con_method)
+    else:
+        con_methods = [con_method]
+        
+    if is_multi_band:
+        fmins = [float(f) for f in fmin]
+        fmaxs = [float(f) for f in fmax]
+        
+        if freq_band_names is None:
+            freq_band_names = ["{}-{}Hz".format(f_lo,f_hi) for f_lo,f_hi in zip(fmins,fmaxs)]
+    else:
+        fmins = [float(fmin)]
+        fmaxs = [float(fmax)]
+        freq_band_names = None
+        
+    con_matrix, freqs = directed_connectivity(data, con_methods, sfreq, fmin = fmins, fmax = fmaxs, order = order, indices = indices)
+    
+    con_matrices = [[np.array(method_con_matrix[...,i]) for i in range(len(fmins))] for method_con_matrix in con_matrix]
+    
+    conmat_files = _save_conmats(con_matrices, con_methods, fmins, fmaxs, sfreq, index = index, freq_band_names = freq_band_names, 
+                                 indices = indices, n_nodes = data.shape[-2], export_to_matlab = export_to_matlab, directed = True)
+    
+    if is_multi_band or is_multi_method:
+        return conmat_files
+    else:
+        return conmat_files[0]
+    
+def compute_and_save_surrogate_connectivity(data,con_method,sfreq,fmin,fmax,n_surrogates = 1000,surrogate_type = 'phase',percentiles = (95.,99.),random_state = None,index = 0,freq_band_names = None, n_jobs = 1, indices = None, dtype = 'float64'):
+    
+    """
+    Connectivity of data (numpy backend, multitaper mode) with per-edge statistics 
+    against a null distribution of n_surrogates surrogates (see neuropype_ephy.surrogates): 
+    the tapered spectra are computed once, and surrogates are computed by batches 
+    spread over n_jobs processes
+    
+    surrogate_type: 'phase' (phase randomization of each signal, epoch by epoch) or 
+    'time_shift' (circular shifts of the epochs of each signal)
+    
+    Values are compared in absolute value; for each method and band, a file 
+    "conmat_{index}_{method}[_{band}]_surrogates.npz" is saved with the connectivity 
+    (con, same layout as compute_and_save_spectral_connectivity), the p-values (p_values, 
+    (1 + number of surrogates at least as strong)/(n_surrogates + 1)) and the null 
+    percentiles (null_percentiles, first axis along percentiles)
+    """
+    import os
+    import numpy as np
+    
+    from neuropype_ephy.surrogates import surrogate_connectivity_numpy, compute_surrogate_stats
+    
+    data = np.asarray(data).astype(dtype, copy = False)
+    
+    is_multi_band = isinstance(fmin,(list,tuple,np.ndarray))
+    
+    is_multi_method = isinstance(con_method,(list,tuple))
+
+    if is_multi_method:
+        con_methods = list(con_method)
+    else:
+        con_methods = [con_method]
+        
+    if is_multi_band:
+        fmins = [float(f) for f in fmin]
+        fmaxs = [float(f) for f in fmax]
+        
+        if freq_band_names is None:
+            freq_band_names = ["{}-{}Hz".format(f_lo,f_hi) for f_lo,f_hi in zip(fmins,fmaxs)]
+    else:
+        fmins = [float(fmin)]
+        fmaxs = [float(fmax)]
+        freq_band_names = None
+        
+    con_matrix, null_con_matrix, freqs = surrogate_connectivity_numpy(data, con_methods, sfreq, fmins, fmaxs, n_surrogates = n_surrogates, 
+                                                                      surrogate_type = surrogate_type, random_state = random_state, 
+                                                                      n_jobs = n_jobs, indices = indices)
+    
+    stats_files = []
+    
+    for method,method_con_matrix,method_null_con_matrix in zip(con_methods,con_matrix,null_con_matrix):
+        
+        for i in range(len(fmins)):
+            
+            con = method_con_matrix[...,i]
+            
+            p_values, null_percentiles = compute_surrogate_stats(con, method_null_con_matrix[...,i], percentiles = percentiles)
+            
+            print method
+            print "min p-value: {}".format(np.min(p_values))
+            
+            if freq_band_names is not None:
+                stats_basename = "conmat_" + str(index) + "_" + method + "_" + freq_band_names[i]
+            else:
+                stats_basename = "conmat_" + str(index) + "_" + method
+                
+            stats_file = os.path.abspath(stats_basename + "_surrogates.npz")
+            
+            stats = dict(con = con, p_values = p_values, percentiles = np.array(percentiles, dtype = float), 
+                         null_percentiles = null_percentiles, n_surrogates = n_surrogates, 
+                         surrogate_type = surrogate_type, freq_band = [fmins[i],fmaxs[i]], sfreq = sfreq)
+            
+            if indices is not None:
+                stats['indices'] = np.array(indices)
+            
+            np.savez(stats_file, **stats)
+            
+            stats_files.append(stats_file)
+    
+    if is_multi_band or is_multi_method:
+        return stats_files
+    else:
+        return stats_files[0]
+    
+def get_seed_target_indices(seeds, n_nodes):
+    
+    """
+    Indices (seeds,targets) of all the pairs between the seed nodes and the n_nodes nodes,
+    without self connections, and with pairs between two seeds counted only once
+    """
+    import numpy as np
+    
+    seeds = np.asarray(seeds,dtype = int)
+    
+    ### rank of each node in the seed list (len(seeds) for non seed nodes)
+    seed_rank = np.ones(n_nodes,dtype = int) * len(seeds)
+    seed_rank[seeds] = np.arange(len(seeds))
+    
+    rows = np.repeat(seeds,n_nodes)
+    cols = np.tile(np.arange(n_nodes),len(seeds))
+    
+    keep = seed_rank[cols] > np.repeat(np.arange(len(seeds)),n_nodes)
+    
+    return rows[keep],cols[keep]
+    
+def load_conmat_pairs(conmat_file, dense = False):
+    
+    """
+    Load a pair list conmat file (conmat_*_pairs.npz)
+    
+    Returns indices (seeds,targets), con values and number of nodes, or a dense 
+    n_nodes * n_nodes lower triangular matrix (zeros for pairs not computed), 
+    as the full conmats, if dense is True (full matrix of the influence of seeds on 
+    targets, con[target,seed], for directed metrics)
+    """
+    import numpy as np
+    
+    pairs = np.load(conmat_file)
+    
+    indices = tuple(pairs['indices'])
+    con = pairs['con']
+    n_nodes = int(pairs['n_nodes'])
+    
+    if not dense:
+        return indices,con,n_nodes
+    
+    seeds,targets = indices
+    
+    conmat = np.zeros((n_nodes,n_nodes),dtype = con.dtype)
+    
+    if 'directed' in pairs.files and bool(pairs['directed']):
+        conmat[targets,seeds] = con
+        return conmat
+    
+    ### files saved without the method are assumed symmetric (hermitian for complex con)
+    con_method = str(pairs['con_method']) if 'con_method' in pairs.files else None
+    
+    ### pairs with seed < target are moved to the lower triangle
+    upper = seeds < targets
+    con = np.where(upper,swap_con_direction(con,con_method),con)
+    
+    conmat[np.where(upper,targets,seeds),np.where(upper,seeds,targets)] = con
+    
+    return conmat
+    
+def save_packed_conmat(conmat_file, conmat, con_method, freq_band, sfreq):
+    
+    """
+    Save the lower triangular values (without diagonal) of conmat (... * n_nodes * n_nodes) 
+    as float32 (complex64 for complex methods), with a small header: method, freq band, 
+    sfreq and number of labels
+    """
+    import numpy as np
+    
+    n_labels = conmat.shape[-1]
+    
+    tril_rows,tril_cols = np.tril_indices(n_labels,k = -1)
+    
+    if np.iscomplexobj(conmat):
+        packed_dtype = np.complex64
+    else:
+        packed_dtype = np.float32
+        
+    np.savez(conmat_file, con = conmat[...,tril_rows,tril_cols].astype(packed_dtype),
+             con_method = con_method, freq_band = np.array(freq_band,dtype = float), sfreq = float(sfreq), n_labels = n_labels)
+    
     return conmat_file
 
+def load_packed_conmat_header(conmat_file):
+    
+    """
+    Header of a packed conmat file, as a dict (con_method, freq_band, sfreq, n_labels),
+    without reading the values
+    """
+    import numpy as np
+    
+    packed = np.load(conmat_file)
+    
+    return {"con_method":str(packed['con_method']), "freq_band":list(packed['freq_band']), 
+            "sfreq":float(packed['sfreq']), "n_labels":int(packed['n_labels'])}
+    
+def load_packed_conmat(conmat_file, symmetric = False):
+    
+    """
+    Expand a packed conmat file to a (... * n_labels * n_labels) lower triangular matrix, 
+    as the dense .npy conmats, or to a symmetric (hermitian for complex methods, 
+    antisymmetric for imcoh, see swap_con_direction) one if symmetric is True
+    """
+    import numpy as np
+    
+    packed = np.load(conmat_file)
+    
+    con = packed['con']
+    n_labels = int(packed['n_labels'])
+    
+    tril_rows,tril_cols = np.tril_indices(n_labels,k = -1)
+    
+    conmat = np.zeros(con.shape[:-1] + (n_labels,n_labels),dtype = con.dtype)
+    conmat[...,tril_rows,tril_cols] = con
+    
+    if symmetric:
+        conmat[...,tril_cols,tril_rows] = swap_con_direction(con,str(packed['con_method']))
+        
+    return conmat
+
+def load_conmat(conmat_file):
+    
+    """
+    Load a conmat as a dense matrix, whatever its storage format (.npy, packed or pair list)
+    """
+    import numpy as np
+    
+    if conmat_file.endswith("_packed.npz"):
+        return load_packed_conmat(conmat_file)
+    elif conmat_file.endswith("_pairs.npz"):
+        return load_conmat_pairs(conmat_file, dense = True)
+    else:
+        return np.load(conmat_file)
+    
 ########################################################### plot spectral connectivity #################################################################
 
-def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, fname = "_def"):
+### parsed labels, per (labels_file, modification time, size)
+_plot_labels_cache = {}
+
+def _parse_plot_labels(labels_file):
+    
+    """
+    Names, colors, plot order and centroids of the mne labels pickled in labels_file 
+    (number of labels, then the labels): left hemisphere labels (and Brain-Stem) are 
+    ordered by the y-position of their centroid, right hemisphere labels follow in the 
+    mirrored order
+    """
+    import pickle
+    import numpy as np
+    
+    labels = []
+    with open(labels_file, "rb") as f:
+        for _ in range(pickle.load(f)):
+            labels.append(pickle.load(f))
+    
+    label_names = [label.name for label in labels]
+    node_colors = np.array([label.color for label in labels], dtype = float)
+    centroids = np.array([np.mean(label.pos, axis = 0) for label in labels])
+    
+    label_indexes = dict((name,idx) for idx,name in enumerate(label_names))
+    
+    lh_labels = [name for name in label_names if name.endswith('lh')]
+    rh_labels = set(name for name in label_names if name.endswith('rh'))
+    
+    if 'Brain-Stem' in label_indexes:
+        lh_labels.append('Brain-Stem')
+    
+    # Reorder the labels based on the y-location of their centroid
+    label_ypos_lh = [centroids[label_indexes[name],1] for name in lh_labels]
+    lh_labels = [label for (yp, label) in sorted(zip(label_ypos_lh, lh_labels))]
+    
+    # For the right hemi
+    rh_order = [label[:-2] + 'rh' for label in lh_labels
+                if label != 'Brain-Stem' and label[:-2]+ 'rh' in rh_labels]
+    
+    node_order = lh_labels[::-1] + rh_order
+    
+    return {"label_names":label_names, "node_colors":node_colors, "node_order":node_order, "centroids":centroids}
+
+def get_plot_labels(labels_file):
+    
+    """
+    Parsed labels of labels_file (see _parse_plot_labels), as a dict with label_names, 
+    node_colors (n_labels * 4 array), node_order and centroids (n_labels * 3 array)
+    
+    Labels are parsed once per labels file: the result is kept in memory and in a compact 
+    sidecar file ({labels_file}.parsed.npz, when the directory is writable), which is used 
+    instead of the label vertex arrays until labels_file is modified
+    
+    The sidecar is written to a temporary file then renamed, so that concurrent jobs never 
+    read a partial file; labels are parsed again if the sidecar cannot be read
+    """
+    import os
+    import zipfile
+    import tempfile
+    import numpy as np
+    
+    stat = os.stat(labels_file)
+    key = (os.path.abspath(labels_file), stat.st_mtime, stat.st_size)
+    
+    if key in _plot_labels_cache:
+        return _plot_labels_cache[key]
+    
+    sidecar_file = labels_file + ".parsed.npz"
+    
+    plot_labels = None
+    
+    if os.path.exists(sidecar_file):
+        
+        try:
+            sidecar = np.load(sidecar_file)
+            
+            if float(sidecar['source_mtime']) == stat.st_mtime and int(sidecar['source_size']) == stat.st_size:
+                
+                plot_labels = {"label_names":[str(name) for name in sidecar['label_names']], 
+                               "node_colors":sidecar['node_colors'], 
+                               "node_order":[str(name) for name in sidecar['node_order']], 
+                               "centroids":sidecar['centroids']}
+                
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipfile):
+            ### corrupted sidecar, labels are parsed again
+            plot_labels = None
+            
+    if plot_labels is None:
+        
+        plot_labels = _parse_plot_labels(labels_file)
+        
+        tmp_file = None
+        
+        try:
+            fd, tmp_file = tempfile.mkstemp(suffix = '.npz', prefix = '.tmp_', dir = os.path.dirname(os.path.abspath(labels_file)))
+            
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, source_mtime = stat.st_mtime, source_size = stat.st_size, **plot_labels)
+                
+            os.rename(tmp_file, sidecar_file)
+            
+        except (IOError, OSError):
+            ### read-only directory or full disk, labels are only kept in memory
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        
+    _plot_labels_cache[key] = plot_labels
+    
+    return plot_labels
+    
+def select_top_edges(conmat, nb_lines):
+    
+    """
+    Indices (rows,cols) and values of the nb_lines strongest edges (absolute value) of the 
+    lower triangle of conmat, selected with argpartition instead of a full sort
+    """
+    import numpy as np
+    
+    rows,cols = np.tril_indices(conmat.shape[0],-1)
+    
+    values = conmat[rows,cols]
+    
+    if nb_lines is not None and nb_lines < len(values):
+        
+        keep = np.argpartition(np.abs(values),len(values) - nb_lines)[len(values) - nb_lines:]
+        
+        rows,cols,values = rows[keep],cols[keep],values[keep]
+        
+    return (rows,cols),values
+
+def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, fname = "_def", node_angles = None, fig = None, plot_format = 'eps', dpi = 150):
+    
+    """
+    Circular plot of the nb_lines strongest edges of conmat, saved in circle_{fname}.{plot_format} 
+    
+    The strongest edges are selected before being passed to mne plot_connectivity_circle; 
+    node_angles (circular layout) and fig (figure, cleared before plotting) can be given 
+    to be reused across conmats; plot_format can be a raster format ('png') with dpi
+    """
     import os
     import numpy as np
     from mne.viz import circular_layout, plot_connectivity_circle
     import matplotlib.pyplot as plt
 
     # Angles
-    node_angles = circular_layout(label_names, node_order, start_pos=90,
-                                group_boundaries=[0, len(label_names) / 2])
+    if node_angles is None:
+        node_angles = circular_layout(label_names, node_order, start_pos=90,
+                                    group_boundaries=[0, len(label_names) / 2])
+
+    indices,con = select_top_edges(conmat,nb_lines)
+    
+    new_fig = fig is None
+    
+    if new_fig:
+        fig = plt.figure(figsize = (8,8), facecolor = 'black')
+    else:
+        fig.clf()
 
     # Plot the graph using node colors from the FreeSurfer parcellation. We only
-    # show the 300 strongest connections.
-    fig,_ = plot_connectivity_circle(conmat, 
+    # show the nb_lines strongest connections.
+    fig,_ = plot_connectivity_circle(con, 
                                      label_names, 
+                                     indices = indices,
                                      n_lines=nb_lines,  
                                      node_angles=node_angles, 
                                      node_colors = node_colors,
@@ -82,22 +879,88 @@ def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmi
                                      title='All-to-All Connectivity' , 
                                      show = False, 
                                      vmin = vmin, 
-                                     vmax = vmax)
+                                     vmax = vmax,
+                                     fig = fig)
+    
+    
+    plot_conmat_file = os.path.abspath('circle_' + fname + '.' + plot_format)
+    fig.savefig(plot_conmat_file, facecolor='black', dpi = dpi)
+    
+    if new_fig:
+        plt.close(fig)
+        del fig
+    
+    return plot_conmat_file
     
+def _plot_circular_connectivity_files(conmat_files, file_positions, label_names, node_colors, node_order, node_angles, vmin, vmax, nb_lines, plot_format, dpi):
     
-    #plot_conmat_file = os.path.abspath('circle.png')
-    plot_conmat_file = os.path.abspath('circle_' + fname + '.eps')
-    fig.savefig(plot_conmat_file, facecolor='black')
+    """
+    Plot conmat_files one after the other in the same figure, the plot file names being 
+    prefixed by file_positions (positions of conmat_files in the whole batch)
+    """
+    import matplotlib.pyplot as plt
+    
+    from nipype.utils.filemanip import split_filename as split_f
     
+    fig = plt.figure(figsize = (8,8), facecolor = 'black')
     
+    plot_conmat_files = []
+    
+    for conmat_file,file_position in zip(conmat_files,file_positions):
+        
+        path,fname,ext = split_f(conmat_file)
+        
+        ### conmats of different directories (e.g. MapNode iterations) can have the same name
+        fname = "{}_{}".format(file_position,fname)
+        
+        plot_conmat_files.append(plot_circular_connectivity(load_conmat(conmat_file), label_names, node_colors, node_order, vmin, vmax, nb_lines, fname, 
+                                                            node_angles = node_angles, fig = fig, plot_format = plot_format, dpi = dpi))
+        
     plt.close(fig)
-    #fig1.close()
-    del fig
     
-    return plot_conmat_file
+    return plot_conmat_files
+    
+def plot_circular_connectivity_batch(conmat_files, label_names, node_colors, node_order, vmin = 0.3, vmax = 1.0, nb_lines = 200, plot_format = 'png', dpi = 150, n_jobs = 1):
+    
+    """
+    Batch version of plot_circular_connectivity: the circular layout is computed once, 
+    conmat_files are spread over n_jobs processes, each of them reusing a single figure 
+    for all its conmats; returns the list of plot files (circle_{position in conmat_files}_{conmat file name}.{plot_format}, 
+    raster png by default), unique even if several conmat_files have the same name
+    """
+    import numpy as np
+    
+    from mne.viz import circular_layout
+    from mne.parallel import parallel_func
+    
+    node_angles = circular_layout(label_names, node_order, start_pos=90,
+                                  group_boundaries=[0, len(label_names) / 2])
+    
+    chunks = [list(chunk) for chunk in np.array_split(np.arange(len(conmat_files)),max(1,min(n_jobs,len(conmat_files)))) if len(chunk)]
+    
+    parallel, my_plot_files, _ = parallel_func(_plot_circular_connectivity_files, n_jobs)
+    
+    chunk_plot_files = parallel(my_plot_files([conmat_files[i] for i in chunk], chunk, label_names, node_colors, node_order, node_angles, vmin, vmax, nb_lines, plot_format, dpi) 
+                                for chunk in chunks)
+    
+    return [plot_file for plot_files in chunk_plot_files for plot_file in plot_files]
     
 #################################################################################################################################################################"
 
+def _multitaper_band_con(data,con_method,sfreq,freq_band):
+    
+    """
+    mne multitaper connectivity of one trial (epochs * nodes * times) averaged in one frequency band,
+    used by the trials/windows loops (possibly run in parallel processes)
+    """
+    import numpy as np
+    from mne.connectivity import spectral_connectivity
+
+    con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, mode='multitaper', sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1], faverage=True, tmin=None,    mt_adaptive=False, n_jobs=1)
+
+    return np.array(con_matrix[:,:,0])
+    
+
 ################ laisser pour l'instant, a modifier dans brainvision_to_conmat
 #def spectral_proc(ts_file,sfreq,freq_band,con_method):
 
@@ -113,7 +976,7 @@ def plot_circular_connectivity(conmat, label_names, node_colors, node_order, vmi
     #return conmat_file
 
 
-def spectral_proc_label(ts_file,sfreq,freq_band,con_method,label,mode):
+def spectral_proc_label(ts_file,sfreq,freq_band,con_method,label,mode,backend = 'mne',n_jobs = 1):
 
     import numpy as np
     #import os
@@ -122,17 +985,19 @@ def spectral_proc_label(ts_file,sfreq,freq_band,con_method,label,mode):
 
     data = np.load(ts_file)
 
-    conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],index = label,mode = mode)
+    conmat_file = compute_and_save_spectral_connectivity(data = data,con_method = con_method,sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1],index = label,mode = mode,backend = backend,n_jobs = n_jobs)
 
     return conmat_file
 
 
-def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method):
+def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method,backend = 'mne',n_jobs = 1):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from mne.parallel import parallel_func
+
+    from neuropype_ephy.spectral import _multitaper_band_con
 
     all_data = np.load(ts_file)
 
@@ -149,17 +1014,25 @@ def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method):
     
     conmat_files = []
     
-    for i in range(all_data.shape[0]):
-
-        cur_data = all_data[i,:,:]
-
-        data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
-
-        print data.shape
+    if backend == 'numpy':
+        
+        from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+        
+        ### all trials at once, each trial being a single epoch
+        all_con_matrices, freqs = spectral_connectivity_numpy(all_data[:,np.newaxis,:,:], con_method, sfreq, fmin= freq_band[0], fmax=freq_band[1], n_jobs = n_jobs)
+        
+        all_con_matrices = all_con_matrices[:,:,:,0]
+        
+    else:
+        
+        ### trials spread over n_jobs processes, each trial being a single epoch
+        parallel, my_multitaper_band_con, _ = parallel_func(_multitaper_band_con, n_jobs)
+        
+        all_con_matrices = parallel(my_multitaper_band_con(all_data[i:i+1,:,:], con_method, sfreq, freq_band) for i in range(all_data.shape[0]))
         
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, mode='multitaper', sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1], faverage=True, tmin=None,    mt_adaptive=False, n_jobs=1)
+    for i in range(all_data.shape[0]):
 
-        con_matrix = np.array(con_matrix[:,:,0])
+        con_matrix = all_con_matrices[i]
 
         print con_matrix.shape
         print np.min(con_matrix),np.max(con_matrix)
@@ -172,12 +1045,14 @@ def multiple_spectral_proc(ts_file,sfreq,freq_band,con_method):
             
     return conmat_files
 
-def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_method,epoch_window_length):
+def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_method,epoch_window_length,backend = 'mne',n_jobs = 1):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from mne.parallel import parallel_func
+
+    from neuropype_ephy.spectral import _multitaper_band_con
 
     all_data = np.load(ts_file)
 
@@ -196,38 +1071,70 @@ def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_me
 
     conmat_files = []
 
-    for i in range(all_data.shape[0]):
-
-        cur_data = all_data[i,:,:]
-
-        print cur_data.shape
-            
+    if backend == 'numpy':
+        
+        from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+        
         if epoch_window_length == None :
             
-            data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
-
-        else: 
-                
-            nb_splits = cur_data.shape[1] // (epoch_window_length * sfreq)
+            epoched_data = all_data[:,np.newaxis,:,:]
             
-            print "epoching data with {}s by window, resulting in {} epochs".format(epoch_window_length,nb_splits)
+        else:
+            
+            nb_splits = int(all_data.shape[2] // (epoch_window_length * sfreq))
             
-            list_epoched_data = np.array_split(cur_data,nb_splits,axis = 1)
+            epoch_length = all_data.shape[2] // nb_splits
             
-            print len(list_epoched_data)
+            print "epoching data with {}s by window, resulting in {} epochs".format(epoch_window_length,nb_splits)
             
-            data = np.array(list_epoched_data)
+            ### trials * nodes * epochs * times -> trials * epochs * nodes * times
+            epoched_data = all_data[:,:,:nb_splits*epoch_length].reshape(all_data.shape[0],all_data.shape[1],nb_splits,epoch_length).transpose(0,2,1,3)
             
-            print data.shape
+        print epoched_data.shape
+        
+        ### all trials at once, connectivity computed over the epochs of each trial
+        all_con_matrices, freqs = spectral_connectivity_numpy(epoched_data, con_method, sfreq, fmin= freq_band[0], fmax=freq_band[1], n_jobs = n_jobs)
+        
+        all_con_matrices = all_con_matrices[:,:,:,0]
+        
+    else:
+        
+        all_trials_data = []
+        
+        for i in range(all_data.shape[0]):
 
-        con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, 
-                                                                              mode='multitaper', sfreq=sfreq, 
-                                                                              fmin= freq_band[0], fmax=freq_band[1], 
-                                                                              faverage=True, tmin=None,    
-                                                                              mt_adaptive=False, n_jobs=1)
+            cur_data = all_data[i,:,:]
 
-        print con_matrix.shape
-        con_matrix = np.array(con_matrix[:,:,0])
+            print cur_data.shape
+                
+            if epoch_window_length == None :
+                
+                data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
+
+            else: 
+                    
+                nb_splits = cur_data.shape[1] // (epoch_window_length * sfreq)
+                
+                print "epoching data with {}s by window, resulting in {} epochs".format(epoch_window_length,nb_splits)
+                
+                list_epoched_data = np.array_split(cur_data,nb_splits,axis = 1)
+                
+                print len(list_epoched_data)
+                
+                data = np.array(list_epoched_data)
+                
+                print data.shape
+                
+            all_trials_data.append(data)
+
+        ### trials spread over n_jobs processes
+        parallel, my_multitaper_band_con, _ = parallel_func(_multitaper_band_con, n_jobs)
+        
+        all_con_matrices = parallel(my_multitaper_band_con(data, con_method, sfreq, freq_band) for data in all_trials_data)
+        
+    for i in range(all_data.shape[0]):
+
+        con_matrix = all_con_matrices[i]
 
         print con_matrix.shape
         print np.min(con_matrix),np.max(con_matrix)
@@ -298,12 +1205,14 @@ def epoched_multiple_spectral_proc(ts_file,sfreq,freq_band_name,freq_band,con_me
 
         #return conmat_file
     
-def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
+def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method,backend = 'mne',n_jobs = 1,conmat_format = 'npy'):
 
     import numpy as np
     import os
 
-    from mne.connectivity import spectral_connectivity
+    from mne.parallel import parallel_func
+
+    from neuropype_ephy.spectral import _multitaper_band_con, save_packed_conmat
 
     all_data = np.load(ts_file)
 
@@ -319,34 +1228,73 @@ def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
         
         return []
 
-    all_con_matrices = []
+    if backend == 'numpy':
+        
+        from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+        
+        ### all trials and windows at once, each (trial,window) being a single epoch
+        np_all_con_matrices, freqs = spectral_connectivity_numpy(all_data[:,:,np.newaxis,:,:], con_method, sfreq, fmin= freq_band[0], fmax=freq_band[1], n_jobs = n_jobs)
+        
+        np_all_con_matrices = np_all_con_matrices[:,:,:,:,0]
+        
+    else:
+        
+        ### (trial,window) pairs spread over n_jobs processes, each (trial,window) being a single epoch
+        parallel, my_multitaper_band_con, _ = parallel_func(_multitaper_band_con, n_jobs)
+        
+        flat_con_matrices = parallel(my_multitaper_band_con(all_data[i,j:j+1,:,:], con_method, sfreq, freq_band) 
+                                     for i in range(all_data.shape[0]) for j in range(all_data.shape[1]))
+        
+        all_con_matrices = [flat_con_matrices[i*all_data.shape[1]:(i+1)*all_data.shape[1]] for i in range(all_data.shape[0])]
+            
+        np_all_con_matrices = np.array(all_con_matrices)
+    
+    print np_all_con_matrices.shape
+    
+    if conmat_format == 'packed':
+        
+        conmat_file = os.path.abspath("multiple_windowed_conmat_"+ con_method + "_packed.npz")
+        
+        save_packed_conmat(conmat_file, np_all_con_matrices, con_method, freq_band, sfreq)
+        
+    else:
+        
+        conmat_file = os.path.abspath("multiple_windowed_conmat_"+ con_method + ".npy")
 
-    for i in range(all_data.shape[0]):
+        np.save(conmat_file,np_all_con_matrices)
 
-        trial_con_matrices = []
-        
-        for j in range(all_data.shape[1]):
-                        
-            cur_data = all_data[i,j,:,:]
+    return conmat_file
 
-            print cur_data.shape
-                
-            data = cur_data.reshape(1,cur_data.shape[0],cur_data.shape[1])
+def multiple_windowed_directed_proc(ts_file,sfreq,freq_band,con_method,order = 10):
+    
+    """
+    Directed connectivity (see compute_and_save_directed_connectivity) of each 
+    (trial,window) of ts_file (nb_trials * nb_windows * nb_nodes * nb_timepoints): the 
+    MVAR models of all trials and windows are fitted at once with batched least squares
+    
+    Saves a (nb_trials,nb_windows,nb_nodes,nb_nodes) array
+    """
+    import numpy as np
+    import os
 
-            con_matrix, freqs, times, n_epochs, n_tapers  = spectral_connectivity(data, method=con_method, mode='multitaper', sfreq=sfreq, fmin= freq_band[0], fmax=freq_band[1], faverage=True, tmin=None,    mt_adaptive=False, n_jobs=1)
+    from neuropype_ephy.mvar import directed_connectivity
 
-            print con_matrix.shape
-            
-            con_matrix = np.array(con_matrix[:,:,0])
-            print con_matrix.shape
+    all_data = np.load(ts_file)
 
-            print np.min(con_matrix),np.max(con_matrix)
-    
-            trial_con_matrices.append(con_matrix)
-            
-        all_con_matrices.append(trial_con_matrices)
+    print all_data.shape
+
+    print freq_band
+
+    if len(all_data.shape) != 4:
+        
+        print "Warning, all_data should have 4 dimensions: nb_trials * nb_wondows * nb_nodes * nb_timepoints"
         
-    np_all_con_matrices = np.array(all_con_matrices)
+        return []
+
+    ### each (trial,window) being a single epoch
+    np_all_con_matrices, freqs = directed_connectivity(all_data[:,:,np.newaxis,:,:], con_method, sfreq, fmin = freq_band[0], fmax = freq_band[1], order = order)
+    
+    np_all_con_matrices = np_all_con_matrices[:,:,:,:,0]
     
     print np_all_con_matrices.shape
     
@@ -356,6 +1304,60 @@ def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
 
     return conmat_file
 
+def multiple_dynamic_spectral_proc(ts_file,sfreq,freq_band,con_method,win_length,win_step,conmat_format = 'npy'):
+
+    """
+    Dynamic connectivity in sliding windows of win_length seconds every win_step seconds,
+    for each trial of ts_file (nb_trials * nb_nodes * nb_timepoints)
+    
+    Contrary to multiple_windowed_spectral_proc (one connectivity computation per 
+    already cut window), short-time spectra are computed once per trial on segments 
+    shared by the overlapping windows, and the windowed sums are obtained by cumulative 
+    sums over time (see spectral_engine.sliding_window_connectivity_numpy): the connectivity 
+    of a window is estimated over its segments of gcd(win_length,win_step) taken as epochs, 
+    which is the single-epoch estimator of multiple_windowed_spectral_proc only if win_step 
+    is a multiple of win_length (segments shorter than 5 cycles of freq_band[0] raise a ValueError)
+    
+    The result has the same layout as multiple_windowed_spectral_proc: 
+    nb_trials * nb_windows * nb_nodes * nb_nodes
+    """
+    import numpy as np
+    import os
+
+    from neuropype_ephy.spectral_engine import sliding_window_connectivity_numpy
+    from neuropype_ephy.spectral import save_packed_conmat
+
+    all_data = np.load(ts_file)
+
+    print all_data.shape
+    
+    if len(all_data.shape) == 2:
+        all_data = all_data[np.newaxis]
+        
+    win_length_samples = int(round(win_length * sfreq))
+    win_step_samples = int(round(win_step * sfreq))
+    
+    np_all_con_matrices, freqs = sliding_window_connectivity_numpy(all_data, con_method, sfreq, fmin= freq_band[0], fmax=freq_band[1],
+                                                                   win_length = win_length_samples, win_step = win_step_samples)
+    
+    np_all_con_matrices = np_all_con_matrices[...,0]
+    
+    print np_all_con_matrices.shape
+    
+    if conmat_format == 'packed':
+        
+        conmat_file = os.path.abspath("multiple_dynamic_conmat_"+ con_method + "_packed.npz")
+        
+        save_packed_conmat(conmat_file, np_all_con_matrices, con_method, freq_band, sfreq)
+        
+    else:
+        
+        conmat_file = os.path.abspath("multiple_dynamic_conmat_"+ con_method + ".npy")
+
+        np.save(conmat_file,np_all_con_matrices)
+
+    return conmat_file
+
 ########################################################### splitting ts with temporal windows
 
 #def split_win_ts(splitted_ts_file,n_windows):
@@ -412,55 +1414,97 @@ def multiple_windowed_spectral_proc(ts_file,sfreq,freq_band,con_method):
     
     #return win_splitted_ts_files 
         
-def filter_adj_plot_mat(conmat_file,labels_file,sep_label_name,k_neigh):
+### contact adjacency masks, per (labels_file, modification time, separator, k_neigh)
+_adjacency_mask_cache = {}
 
-    import numpy as np
-    import os
+def parse_contact_labels(labels_file,sep_label_name):
     
-    from itertools import combinations
+    """
+    Parse the contact names of labels_file (one "electrode{sep_label_name}contact_number" 
+    per line) into integer arrays: electrode indexes and contact numbers
+    """
+    import numpy as np
     
     labels = [line.strip().split(sep_label_name) for line in open(labels_file)]
     
-    print labels
+    electrode_names, electrodes = np.unique([label[0] for label in labels], return_inverse = True)
     
-    triu_indices = np.triu_indices(len(labels),1)
+    contacts = np.array([int(label[1]) for label in labels])
     
-    print triu_indices
-            
-    adj_mat = np.zeros(shape = (len(labels),len(labels)),dtype = bool)
-                   
-    for i in range(k_neigh):               
-                    
-        adj_plots = [(a[0] == b[0]) and ((int(a[1]) + i + 1 )== int(b[1])) for a,b in combinations(labels,2)]
+    return electrodes, contacts
+
+def get_contact_adjacency_mask(labels_file,sep_label_name,k_neigh):
+    
+    """
+    Boolean mask (upper triangular, nb_contacts * nb_contacts) of the pairs of contacts 
+    (i < j in labels_file) of the same electrode whose contact number of j is the 
+    contact number of i plus 1 to k_neigh
+    
+    Labels are parsed once, the mask is built with vectorized comparisons and kept in 
+    memory for the next calls with the same labels_file (until it is modified)
+    """
+    import os
+    import numpy as np
+    
+    key = (os.path.abspath(labels_file), os.path.getmtime(labels_file), sep_label_name, k_neigh)
+    
+    if key not in _adjacency_mask_cache:
+        
+        electrodes, contacts = parse_contact_labels(labels_file,sep_label_name)
+        
+        contact_offsets = contacts[np.newaxis,:] - contacts[:,np.newaxis]
         
-        print len(adj_plots)
+        adj_mat = (electrodes[:,np.newaxis] == electrodes[np.newaxis,:]) & (contact_offsets >= 1) & (contact_offsets <= k_neigh)
         
-        adj_mat[triu_indices] =  adj_mat[triu_indices] + adj_plots
+        adj_mat &= np.triu(np.ones(adj_mat.shape, dtype = bool),1)
         
-        print np.sum(adj_mat == True)
+        _adjacency_mask_cache[key] = adj_mat
         
-    print adj_mat
+    return _adjacency_mask_cache[key]
+
+def apply_adjacency_mask(conmats,adj_mat):
     
-    ### loading ad filtering conmat_file
-    conmat = np.load(conmat_file)
+    """
+    Set to 0 the connectivity of adjacent contacts (adj_mat, see get_contact_adjacency_mask) 
+    in the lower triangular conmats (..., nb_contacts, nb_contacts), for a single conmat 
+    or a whole stack of conmats (e.g. trials * windows) at once
+    """
+    import numpy as np
+    
+    assert conmats.shape[-2:] == adj_mat.shape, "warning, wrong dimensions between labels and conmat"
+    
+    filtered_conmats = np.array(conmats)
+    
+    ### conmats are lower triangular: pair (i,j) with i < j is stored in [j,i]
+    filtered_conmats[...,np.transpose(adj_mat)] = 0.0
     
-    print conmat
+    return filtered_conmats
     
-    assert conmat.shape[0] == len(labels), "warning, wrong dimensions between labels and conmat"
+def filter_adj_plot_mat(conmat_file,labels_file,sep_label_name,k_neigh):
+
+    """
+    Remove the connectivity between neighbour contacts (up to k_neigh contacts apart on 
+    the same electrode) of the conmat (or stack of conmats) in conmat_file
+    """
+    import numpy as np
+    import os
     
-    filtered_conmat = np.transpose(conmat).copy()
+    from neuropype_ephy.spectral import get_contact_adjacency_mask, apply_adjacency_mask
     
-    #print np.transpose(adj_mat) == True
+    adj_mat = get_contact_adjacency_mask(labels_file,sep_label_name,k_neigh)
     
-    x,y = np.where(adj_mat == True)
+    print np.sum(adj_mat)
+    
+    ### loading ad filtering conmat_file
+    conmat = np.load(conmat_file)
     
-    filtered_conmat[x,y] = 0.0
+    print conmat.shape
     
-    print filtered_conmat
+    filtered_conmat = apply_adjacency_mask(conmat,adj_mat)
     
     filtered_conmat_file = os.path.abspath("filtered_conmat.npy")
     
-    np.save(filtered_conmat_file,np.transpose(filtered_conmat))
+    np.save(filtered_conmat_file,filtered_conmat)
     
     return filtered_conmat_file
   
@@ -0,0 +1,919 @@
+# -*- coding: utf-8 -*-
+"""
+Batched numpy engine for spectral connectivity
+
+Tapered FFTs are computed at once for all trials / windows / epochs, and
+the channel pairs are reduced with matrix products instead of one
+mne.connectivity.spectral_connectivity call per trial. Metrics follow the
+mne definitions (multitaper mode, non adaptive weights) and the
+connectivity matrices are returned in the same lower-triangular layout,
+so that both backends can be swapped in the spectral functions.
+
+If indices (seeds, targets) are given, only the cross-spectra of the
+requested pairs are computed (rows of the seeds against all signals), so
+that compute and memory scale with n_seeds * n_signals instead of
+n_signals ** 2.
+
+spectral_connectivity_stream accumulates the sums over epochs chunk by
+chunk, so that long recordings can be processed from a memory-mapped file
+with a peak memory bounded by the size of one chunk.
+
+sliding_window_connectivity_numpy computes dynamic connectivity in
+overlapping windows from short-time spectra computed once per trial.
+
+spectral_connectivity_morlet computes time-averaged Morlet wavelet
+connectivity by chunks of frequencies, time points and signal pairs.
+
+All functions follow the precision of the data: with float32 data, the
+spectra, cross-spectral sums and connectivity are complex64 / float32
+(the FFTs themselves are computed in single precision by scipy.fftpack),
+which halves memory and memory traffic for a relative error of the order
+of 1e-6 on the metrics.
+"""
+import numpy as np
+
+from scipy import fftpack
+
+con_methods_numpy = ['coh', 'cohy', 'imcoh', 'plv', 'ppc', 'pli',
+                     'pli2_unbiased', 'wpli', 'wpli2_debiased']
+
+# accumulators needed by each metric (sums over epochs)
+_method_accumulators = {'coh': ['csd'],
+                        'cohy': ['csd'],
+                        'imcoh': ['csd'],
+                        'plv': ['phase'],
+                        'ppc': ['phase'],
+                        'pli': ['sign_im'],
+                        'pli2_unbiased': ['sign_im'],
+                        'wpli': ['im', 'abs_im'],
+                        'wpli2_debiased': ['im', 'abs_im', 'sq_im']}
+
+# maximum size (in bytes) of the arrays computed for one block of groups
+max_block_bytes = 2 ** 28
+
+
+def compute_mt_tapers(n_times, sfreq, mt_bandwidth=None, mt_low_bias=True):
+    """
+    Compute DPSS tapers and their eigenvalues, with the same defaults as
+    mne spectral_connectivity (half bandwidth of 4 if mt_bandwidth is None)
+
+    Tapers are read from the window cache (see neuropype_ephy.window_cache)
+    when they were already computed with the same parameters
+    """
+    from neuropype_ephy.window_cache import get_dpss_windows
+
+    if mt_bandwidth is not None:
+        half_nbw = float(mt_bandwidth) * n_times / (2. * sfreq)
+    else:
+        half_nbw = 4.
+
+    if half_nbw < 0.5:
+        raise ValueError('mt_bandwidth {} yields a normalized bandwidth of {} '
+                         '< 0.5, use a value of at least {}'.format(
+                             mt_bandwidth, half_nbw, sfreq / n_times))
+
+    n_tapers_max = int(2 * half_nbw)
+
+    tapers, eigvals = get_dpss_windows(n_times, half_nbw, n_tapers_max,
+                                       low_bias=mt_low_bias)
+
+    return tapers, eigvals
+
+
+def get_band_freq_mask(freqs, fmin, fmax):
+    """
+    Return the mask of the frequencies used by at least one band, and for
+    each band the indexes of its frequencies among the masked ones
+    """
+    fmin = np.atleast_1d(np.asarray(fmin, dtype=float))
+    fmax = np.atleast_1d(np.asarray(fmax, dtype=float))
+
+    if len(fmin) != len(fmax):
+        raise ValueError('fmin and fmax must have the same length')
+
+    freq_mask = np.zeros(len(freqs), dtype=bool)
+    for f_lo, f_hi in zip(fmin, fmax):
+        freq_mask |= (freqs >= f_lo) & (freqs <= f_hi)
+
+    used_freqs = freqs[freq_mask]
+
+    freq_idx_bands = [np.where((used_freqs >= f_lo) & (used_freqs <= f_hi))[0]
+                      for f_lo, f_hi in zip(fmin, fmax)]
+
+    for f_lo, f_hi, freq_idx in zip(fmin, fmax, freq_idx_bands):
+        if len(freq_idx) == 0:
+            raise ValueError('There are no frequency points between {}Hz and '
+                             '{}Hz. Change the band specification (fmin, '
+                             'fmax) or the frequency resolution.'.format(
+                                 f_lo, f_hi))
+
+    return freq_mask, freq_idx_bands
+
+
+def get_complex_dtype(data):
+    """ complex64 for float32 data, complex128 otherwise """
+    if np.asarray(data).dtype in [np.float32, np.complex64]:
+        return np.complex64
+    return np.complex128
+
+
+def _rfft(data):
+    """
+    numpy.fft.rfft of data along the last axis, computed in single precision
+    (complex64) for float32 data by scipy.fftpack.rfft
+    """
+    if data.dtype != np.float32:
+        return np.fft.rfft(data, axis=-1)
+
+    n_times = data.shape[-1]
+    n_pairs = (n_times - 1) // 2
+
+    # packed real and imaginary parts (y0, Re(y1), Im(y1), ...)
+    packed = fftpack.rfft(data, axis=-1)
+
+    x_fft = np.zeros(data.shape[:-1] + (n_times // 2 + 1,), dtype=np.complex64)
+    x_fft.real[..., 0] = packed[..., 0]
+    x_fft.real[..., 1:n_pairs + 1] = packed[..., 1:2 * n_pairs:2]
+    x_fft.imag[..., 1:n_pairs + 1] = packed[..., 2:2 * n_pairs + 1:2]
+    if n_times % 2 == 0:
+        x_fft.real[..., -1] = packed[..., -1]
+
+    return x_fft
+
+
+def compute_mt_spectra(data, tapers, eigvals, freq_mask):
+    """
+    Tapered FFT of data (..., n_signals, n_times), restricted to freq_mask
+
+    Returns weighted spectra of shape (..., n_freqs, n_signals, n_tapers),
+    scaled such that the cross-spectral density of a pair of signals is
+    obtained by x_mt.dot(x_mt.conj().T), as in mne _csd_from_mt (complex64
+    for float32 data)
+    """
+    n_times = data.shape[-1]
+    complex_dtype = get_complex_dtype(data)
+
+    data = data - np.mean(data, axis=-1)[..., np.newaxis]
+
+    x_mt = _rfft(data[..., np.newaxis, :] * tapers.astype(data.dtype))
+
+    # Adjust DC and Nyquist for one-sided transform
+    x_mt[..., 0] /= np.sqrt(2.)
+    if n_times % 2 == 0:
+        x_mt[..., -1] /= np.sqrt(2.)
+
+    x_mt = x_mt[..., freq_mask].astype(complex_dtype)
+
+    weights = np.sqrt(eigvals) * np.sqrt(2. / np.sum(eigvals))
+    x_mt *= weights[:, np.newaxis].astype(x_mt.real.dtype)
+
+    # (..., n_signals, n_tapers, n_freqs) -> (..., n_freqs, n_signals, n_tapers)
+    return np.rollaxis(x_mt, -1, x_mt.ndim - 3)
+
+
+def init_con_accumulators(methods, shape, psd_shape, dtype=np.complex128):
+    """
+    Allocate the sums over epochs needed by the metrics, shape is
+    (..., n_freqs, n_signals, n_signals), or (..., n_freqs, n_pairs) if
+    indices are used, and psd_shape is (..., n_freqs, n_signals); dtype is
+    the complex dtype of the spectra (real sums use the matching precision)
+    """
+    acc_names = set()
+    for method in methods:
+        acc_names.update(_method_accumulators[method])
+
+    real_dtype = np.zeros(0, dtype=dtype).real.dtype
+
+    acc = {'n_epochs': 0,
+           'psd': np.zeros(psd_shape, dtype=real_dtype)}
+
+    for acc_name in acc_names:
+        if acc_name in ['csd', 'phase']:
+            acc[acc_name] = np.zeros(shape, dtype=dtype)
+        else:
+            acc[acc_name] = np.zeros(shape, dtype=real_dtype)
+
+    return acc
+
+
+def compute_pair_csd(x_mt, indices=None):
+    """
+    Cross-spectral densities from weighted spectra x_mt (..., n_signals, n_tapers)
+
+    Returns (..., n_signals, n_signals) if indices is None, otherwise
+    (..., n_pairs) for the pairs (indices[0][p], indices[1][p]); only the
+    rows of the seeds are computed
+    """
+    x_mt_h = np.conj(np.swapaxes(x_mt, -1, -2))
+
+    if indices is None:
+        return np.matmul(x_mt, x_mt_h)
+
+    seeds, row_pos = np.unique(indices[0], return_inverse=True)
+
+    csd = np.matmul(x_mt[..., seeds, :], x_mt_h)
+
+    return csd[..., row_pos, indices[1]]
+
+
+def accumulate_epoch_csd(acc, csd):
+    """
+    Add the per-epoch nonlinear terms of the cross-spectral densities csd of
+    one epoch (phase, sign and imaginary parts) to the accumulators
+    """
+    if 'phase' in acc:
+        abs_csd = np.abs(csd)
+        z_csd = abs_csd == 0.
+        abs_csd[z_csd] = 1.
+        phase = csd / abs_csd
+        phase[z_csd] = 0.
+        acc['phase'] += phase
+
+    im_csd = np.imag(csd)
+
+    if 'sign_im' in acc:
+        acc['sign_im'] += np.sign(im_csd)
+
+    if 'im' in acc:
+        acc['im'] += im_csd
+
+    if 'abs_im' in acc:
+        acc['abs_im'] += np.abs(im_csd)
+
+    if 'sq_im' in acc:
+        acc['sq_im'] += im_csd ** 2
+
+
+def accumulate_con(acc, x_mt, indices=None):
+    """
+    Add the contribution of epochs to the accumulators
+
+    x_mt: weighted spectra (..., n_epochs, n_freqs, n_signals, n_tapers)
+    """
+    n_epochs = x_mt.shape[-4]
+
+    if 'csd' in acc:
+        # sum over epochs and tapers in a single matrix product
+        x_all = np.rollaxis(x_mt, -4, x_mt.ndim - 1)
+        x_all = x_all.reshape(x_all.shape[:-2] + (-1,))
+        acc['csd'] += compute_pair_csd(x_all, indices)
+
+    acc['psd'] += np.sum(np.sum(np.abs(x_mt) ** 2, axis=-1), axis=-3)
+
+    per_epoch_names = [name for name in ['phase', 'sign_im', 'im', 'abs_im',
+                                         'sq_im'] if name in acc]
+
+    if len(per_epoch_names):
+
+        for i in range(n_epochs):
+
+            x_epo = x_mt[..., i, :, :, :]
+
+            accumulate_epoch_csd(acc, compute_pair_csd(x_epo, indices))
+
+    acc['n_epochs'] += n_epochs
+
+    return acc
+
+
+def combine_con_accumulators(acc, other):
+    """ Add the accumulators of other (computed on other epochs) to acc """
+    for acc_name in acc:
+        acc[acc_name] += other[acc_name]
+    return acc
+
+
+def _compute_block_accumulators(data, methods, tapers, eigvals, freq_mask,
+                                indices=None):
+    """ Accumulators of a block of groups (..., n_epochs, n_signals, n_times) """
+    x_mt = compute_mt_spectra(data, tapers, eigvals, freq_mask)
+
+    psd_shape = x_mt.shape[:-4] + x_mt.shape[-3:-1]
+
+    if indices is None:
+        con_shape = psd_shape + x_mt.shape[-2:-1]
+    else:
+        con_shape = psd_shape[:-1] + (len(indices[0]),)
+
+    acc = init_con_accumulators(methods, con_shape, psd_shape, x_mt.dtype)
+
+    return accumulate_con(acc, x_mt, indices)
+
+
+def _safe_divide(num, denom):
+    """ num / denom, set to 0 where denom is 0 (as in mne) """
+    denom = denom.copy()
+    z_denom = denom == 0.
+    denom[z_denom] = 1.
+    con = num / denom
+    con[z_denom] = 0.
+    return con
+
+
+def compute_con_from_accumulators(acc, method, indices=None):
+    """
+    Connectivity (..., n_freqs, n_signals, n_signals) from the accumulators,
+    or (..., n_freqs, n_pairs) if indices are used
+    """
+    n_epochs = float(acc['n_epochs'])
+
+    if method in ['coh', 'cohy', 'imcoh']:
+        csd_mean = acc['csd'] / n_epochs
+        psd = acc['psd'] / n_epochs
+        if indices is None:
+            norm = np.sqrt(psd[..., :, np.newaxis] * psd[..., np.newaxis, :])
+        else:
+            norm = np.sqrt(psd[..., indices[0]] * psd[..., indices[1]])
+        if method == 'coh':
+            con = np.abs(csd_mean) / norm
+        elif method == 'cohy':
+            con = csd_mean / norm
+        else:
+            con = np.imag(csd_mean) / norm
+
+    elif method == 'plv':
+        con = np.abs(acc['phase'] / n_epochs)
+
+    elif method == 'ppc':
+        con = np.real((acc['phase'] * np.conj(acc['phase']) - n_epochs) /
+                      (n_epochs * (n_epochs - 1.)))
+
+    elif method == 'pli':
+        con = np.abs(acc['sign_im'] / n_epochs)
+
+    elif method == 'pli2_unbiased':
+        pli_mean = acc['sign_im'] / n_epochs
+        con = (n_epochs * pli_mean ** 2 - 1) / (n_epochs - 1)
+
+    elif method == 'wpli':
+        con = _safe_divide(np.abs(acc['im']), acc['abs_im'])
+
+    elif method == 'wpli2_debiased':
+        con = _safe_divide(acc['im'] ** 2 - acc['sq_im'],
+                           acc['abs_im'] ** 2 - acc['sq_im'])
+
+    else:
+        raise ValueError('con_method {} is not available in the numpy '
+                         'backend ({})'.format(method, con_methods_numpy))
+
+    return con
+
+
+def average_con_bands(con, freq_idx_bands, indices=None):
+    """
+    Average connectivity (..., n_freqs, n_signals, n_signals) in each band
+    and return it in mne layout (..., n_signals, n_signals, n_bands), only
+    the lower triangular part (i > j) being filled
+
+    If indices are used, con is (..., n_freqs, n_pairs) and the result
+    (..., n_pairs, n_bands)
+    """
+    if indices is not None:
+        return np.stack([np.mean(con[..., freq_idx, :], axis=-2)
+                         for freq_idx in freq_idx_bands], axis=-1)
+
+    n_signals = con.shape[-1]
+
+    con_bands = np.stack([np.mean(con[..., freq_idx, :, :], axis=-3)
+                          for freq_idx in freq_idx_bands], axis=-1)
+
+    tril_mask = np.tril(np.ones((n_signals, n_signals), dtype=bool), -1)
+    con_bands[..., ~tril_mask, :] = 0.
+
+    return con_bands
+
+
+def spectral_connectivity_numpy(data, method, sfreq, fmin, fmax,
+                                mt_bandwidth=None, mt_low_bias=True, n_jobs=1,
+                                indices=None):
+    """
+    Compute multitaper spectral connectivity for groups of epochs at once
+
+    data: array (..., n_epochs, n_signals, n_times), the leading
+    dimensions being independent groups (trials, windows...); the metric is
+    computed over the epochs of each group
+
+    method: metric name, or list of metric names
+
+    fmin, fmax: float or lists of floats (one per band)
+
+    n_jobs: number of processes; blocks of groups are spread over the
+    processes, or blocks of epochs if there are less groups than processes
+    (the sums over epochs are then combined before computing the metric)
+
+    indices: None (all-to-all), or tuple of two arrays (seeds, targets) as
+    in mne spectral_connectivity; only these pairs are computed
+
+    Returns con, array (..., n_signals, n_signals, n_bands) with the same
+    values as mne spectral_connectivity(faverage=True) for each group (a
+    list of arrays if method is a list), or (..., n_pairs, n_bands) if
+    indices are given, and freqs, the frequencies used
+    """
+    data = np.asarray(data)
+
+    if data.ndim < 3:
+        raise ValueError('data should be at least 3D (n_epochs, n_signals, '
+                         'n_times), got shape {}'.format(data.shape))
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    group_shape = data.shape[:-3]
+    n_epochs, n_signals, n_times = data.shape[-3:]
+
+    tapers, eigvals = compute_mt_tapers(n_times, sfreq, mt_bandwidth,
+                                        mt_low_bias)
+
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+
+    n_freqs = np.sum(freq_mask)
+    n_tapers = len(eigvals)
+
+    if indices is None:
+        con_shape = (n_signals, n_signals)
+        n_rows = n_signals
+    else:
+        indices = (np.asarray(indices[0], dtype=int),
+                   np.asarray(indices[1], dtype=int))
+        con_shape = (len(indices[0]),)
+        n_rows = len(np.unique(indices[0]))
+
+    data = data.reshape((-1, n_epochs, n_signals, n_times))
+    n_groups = data.shape[0]
+
+    # split the groups in blocks to bound memory usage
+    group_bytes = 16 * (n_epochs * n_signals * n_tapers * n_times +
+                        (4 + len(methods)) * n_freqs * n_rows * n_signals)
+    block_size = int(max(1, max_block_bytes // group_bytes))
+
+    complex_dtype = get_complex_dtype(data)
+    real_dtype = np.zeros(0, dtype=complex_dtype).real.dtype
+
+    cons = [np.zeros((n_groups,) + con_shape + (len(freq_idx_bands),),
+                     dtype=complex_dtype if met == 'cohy' else real_dtype)
+            for met in methods]
+
+    if n_jobs > 1:
+        # at least one block of groups per process
+        block_size = int(min(block_size, np.ceil(n_groups / float(n_jobs))))
+
+    blocks = [slice(start, start + block_size)
+              for start in range(0, n_groups, block_size)]
+
+    if n_jobs > 1 and len(blocks) < n_jobs and n_epochs > 1:
+        epoch_splits = np.array_split(np.arange(n_epochs),
+                                      min(n_jobs, n_epochs))
+    else:
+        epoch_splits = [slice(None)]
+
+    # blocks processed together, one (block, epochs) task per process
+    n_blocks_wave = int(max(1, n_jobs // len(epoch_splits)))
+
+    if n_jobs > 1:
+        from mne.parallel import parallel_func
+        parallel, p_fun, _ = parallel_func(_compute_block_accumulators, n_jobs)
+    else:
+        parallel, p_fun = list, _compute_block_accumulators
+
+    for wave_start in range(0, len(blocks), n_blocks_wave):
+
+        wave = blocks[wave_start:wave_start + n_blocks_wave]
+
+        wave_accs = parallel(p_fun(data[block][:, epochs], methods, tapers,
+                                   eigvals, freq_mask, indices)
+                             for block in wave for epochs in epoch_splits)
+
+        for i, block in enumerate(wave):
+
+            block_accs = wave_accs[i * len(epoch_splits):
+                                   (i + 1) * len(epoch_splits)]
+
+            acc = block_accs[0]
+            for other in block_accs[1:]:
+                combine_con_accumulators(acc, other)
+
+            for met, con in zip(methods, cons):
+                con[block] = average_con_bands(
+                    compute_con_from_accumulators(acc, met, indices),
+                    freq_idx_bands, indices)
+
+    cons = [con.reshape(group_shape + con.shape[1:]) for con in cons]
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs[freq_mask]
+
+
+def compute_stream_accumulators(epoch_chunks, methods, sfreq, fmin, fmax,
+                                mt_bandwidth=None, mt_low_bias=True,
+                                indices=None):
+    """
+    Sums over epochs needed by methods, accumulated chunk by chunk
+
+    epoch_chunks: iterable of arrays (n_epochs_chunk, n_signals, n_times)
+
+    Returns acc (see init_con_accumulators), the frequencies of the
+    accumulators (frequencies of the bands defined by fmin and fmax) and
+    freq_idx_bands, the indexes of the frequencies of each band
+    """
+    acc = None
+
+    for chunk in epoch_chunks:
+
+        chunk = np.asarray(chunk)
+
+        if acc is None:
+            n_times = chunk.shape[-1]
+            tapers, eigvals = compute_mt_tapers(n_times, sfreq, mt_bandwidth,
+                                                mt_low_bias)
+            freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+            freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+
+            acc = _compute_block_accumulators(chunk, methods, tapers, eigvals,
+                                              freq_mask, indices)
+        else:
+            x_mt = compute_mt_spectra(chunk, tapers, eigvals, freq_mask)
+            accumulate_con(acc, x_mt, indices)
+
+    if acc is None:
+        raise ValueError('epoch_chunks should contain at least one chunk')
+
+    return acc, freqs[freq_mask], freq_idx_bands
+
+
+def spectral_connectivity_stream(epoch_chunks, method, sfreq, fmin, fmax,
+                                 mt_bandwidth=None, mt_low_bias=True,
+                                 indices=None):
+    """
+    Compute multitaper spectral connectivity over epochs read chunk by chunk
+
+    epoch_chunks: iterable of arrays (n_epochs_chunk, n_signals, n_times),
+    e.g. chunks read from a memory-mapped file; only one chunk (and its
+    spectra) is in memory at a time, the sums over epochs being accumulated
+    incrementally and the metrics computed once all chunks are read
+
+    Other parameters and returned values are the same as
+    spectral_connectivity_numpy for a single group of epochs
+    """
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    if indices is not None:
+        indices = (np.asarray(indices[0], dtype=int),
+                   np.asarray(indices[1], dtype=int))
+
+    acc, freqs, freq_idx_bands = compute_stream_accumulators(
+        epoch_chunks, methods, sfreq, fmin, fmax, mt_bandwidth, mt_low_bias,
+        indices)
+
+    cons = [average_con_bands(compute_con_from_accumulators(acc, met, indices),
+                              freq_idx_bands, indices)
+            for met in methods]
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs
+
+
+def sliding_window_connectivity_numpy(data, method, sfreq, fmin, fmax,
+                                      win_length, win_step, mt_bandwidth=None,
+                                      mt_low_bias=True, indices=None):
+    """
+    Compute dynamic (sliding window) connectivity from short-time spectra
+
+    data: array (..., n_signals, n_times), e.g. (n_trials, n_signals,
+    n_times); windows of win_length samples start every win_step samples
+
+    Each trial is cut in non-overlapping segments of gcd(win_length,
+    win_step) samples, whose multitaper spectra (and per-segment sums
+    needed by the metrics) are computed only once; the sums over the
+    segments of each window are then obtained from cumulative sums over
+    the segment axis, and the metric of a window is computed over its
+    segments taken as epochs. Overlapping windows therefore share the
+    spectral transform of their common samples.
+
+    The estimator of a window is thus spectral_connectivity_numpy on its
+    segments as epochs (frequency resolution sfreq / segment length): it
+    is the single-epoch estimator of each window (as in
+    spectral.multiple_windowed_spectral_proc) only when win_step is a
+    multiple of win_length. As mne spectral_connectivity does for epochs,
+    a ValueError is raised when the lowest frequency of the bands is
+    below 5 cycles of a segment (e.g. 200 samples windows every 70
+    samples give 10 samples segments); choose win_step so that
+    gcd(win_length, win_step) is long enough.
+
+    Returns con, array (..., n_windows, n_signals, n_signals, n_bands) (a
+    list if method is a list, (..., n_windows, n_pairs, n_bands) if indices
+    are given) and freqs, the frequencies of the segment spectra used
+    """
+    data = np.asarray(data)
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    win_length, win_step = int(win_length), int(win_step)
+    n_signals, n_times = data.shape[-2:]
+
+    if win_length > n_times:
+        raise ValueError('win_length ({}) should not be longer than the '
+                         'time series ({})'.format(win_length, n_times))
+
+    if indices is not None:
+        indices = (np.asarray(indices[0], dtype=int),
+                   np.asarray(indices[1], dtype=int))
+
+    seg_length = int(np.gcd(win_length, win_step))
+
+    five_cycle_freq = 5. * sfreq / seg_length
+
+    if np.min(fmin) < five_cycle_freq:
+        raise ValueError('segments of gcd(win_length, win_step) = {} samples '
+                         'are too short for fmin = {} Hz (less than 5 cycles, '
+                         'fmin should be at least {} Hz), choose a win_step '
+                         'sharing a longer divisor with win_length'.format(
+                             seg_length, np.min(fmin), five_cycle_freq))
+
+    n_seg_win = win_length // seg_length
+    n_seg_step = win_step // seg_length
+
+    n_windows = (n_times - win_length) // win_step + 1
+    n_segs = (n_windows - 1) * n_seg_step + n_seg_win
+
+    tapers, eigvals = compute_mt_tapers(seg_length, sfreq, mt_bandwidth,
+                                        mt_low_bias)
+    freqs = np.fft.rfftfreq(seg_length, 1. / sfreq)
+    freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+
+    group_shape = data.shape[:-2]
+    data = data.reshape((-1, n_signals, n_times))
+
+    # first and last (excluded) segment of each window
+    win_starts = np.arange(n_windows) * n_seg_step
+    win_stops = win_starts + n_seg_win
+
+    cons = []
+
+    for trial_data in data:
+
+        # (n_segs, 1 epoch, n_signals, seg_length)
+        segs = trial_data[:, :n_segs * seg_length].reshape(
+            n_signals, n_segs, 1, seg_length).transpose(1, 2, 0, 3)
+
+        acc = _compute_block_accumulators(segs, methods, tapers, eigvals,
+                                          freq_mask, indices)
+
+        win_acc = {'n_epochs': n_seg_win}
+
+        for acc_name in acc:
+            if acc_name == 'n_epochs':
+                continue
+            cum_acc = np.concatenate([np.zeros_like(acc[acc_name][:1]),
+                                      np.cumsum(acc[acc_name], axis=0)])
+            win_acc[acc_name] = cum_acc[win_stops] - cum_acc[win_starts]
+
+        cons.append([average_con_bands(
+            compute_con_from_accumulators(win_acc, met, indices),
+            freq_idx_bands, indices) for met in methods])
+
+    cons = [np.array([trial_cons[i] for trial_cons in cons])
+            for i in range(len(methods))]
+    cons = [con.reshape(group_shape + con.shape[1:]) for con in cons]
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs[freq_mask]
+
+
+def compute_morlet_coefs(data, wavelets, start, stop):
+    """
+    Morlet transform of the time points start to stop of data (n_epochs,
+    n_signals, n_times), same as mne cwt (mode='same'), by FFT convolution
+    of the time points these coefficients depend on; the FFTs are computed
+    for blocks of epochs (or of signals) bounded by max_block_bytes
+
+    wavelets: list of the wavelets of n_freqs frequencies
+
+    Returns coefficients (n_epochs, stop - start, n_freqs, n_signals)
+    """
+    n_epochs, n_signals, n_times = data.shape
+    n_block_times = stop - start
+
+    max_size = max(wavelet.size for wavelet in wavelets)
+
+    # part of the data covered by the largest wavelet
+    seg_start = max(start - max_size // 2, 0)
+    seg_stop = min(stop + (max_size - 1) // 2, n_times)
+
+    # no circular wrap of the full convolution
+    fft_size = 2 ** int(np.ceil(np.log2(seg_stop - seg_start + max_size - 1)))
+
+    complex_dtype = get_complex_dtype(data)
+
+    # in single precision for float32 data
+    fft_wavelets = [fftpack.fft(wavelet, fft_size).astype(complex_dtype)
+                    for wavelet in wavelets]
+
+    # FFT of the rows and product with a wavelet
+    n_rows = int(max(1, max_block_bytes // (32 * fft_size)))
+
+    if n_rows >= n_signals:
+        epoch_step = n_rows // n_signals
+        blocks = [(slice(e_start, e_start + epoch_step), slice(None))
+                  for e_start in range(0, n_epochs, epoch_step)]
+    else:
+        blocks = [(slice(i_epoch, i_epoch + 1),
+                   slice(s_start, s_start + n_rows))
+                  for i_epoch in range(n_epochs)
+                  for s_start in range(0, n_signals, n_rows)]
+
+    coefs = np.empty((n_epochs, n_block_times, len(wavelets), n_signals),
+                     dtype=complex_dtype)
+
+    for epoch_block, signal_block in blocks:
+
+        fft_data = fftpack.fft(data[epoch_block, signal_block,
+                                    seg_start:seg_stop], fft_size)
+
+        for i, (fft_wavelet, wavelet) in enumerate(zip(fft_wavelets,
+                                                       wavelets)):
+            conv = fftpack.ifft(fft_data * fft_wavelet)
+            # center of the full convolution (n_times + wavelet.size - 1)
+            conv_start = start + (wavelet.size - 1) // 2 - seg_start
+            coefs[epoch_block, :, i, signal_block] = np.swapaxes(
+                conv[..., conv_start:conv_start + n_block_times], -1, -2)
+
+    return coefs
+
+
+def spectral_connectivity_morlet(data, method, sfreq, fmin, fmax, freqs,
+                                 n_cycles=7., indices=None,
+                                 freq_idx_bands=None):
+    """
+    Time-averaged Morlet wavelet spectral connectivity
+
+    Same values as mne spectral_connectivity(mode='cwt_morlet',
+    faverage=True) averaged over time, without the n_signals * n_signals *
+    n_freqs * n_times arrays: the wavelet transform is computed by FFT
+    convolution for chunks of frequencies and blocks of time points, the
+    sums over epochs for blocks of signal pairs, and the metric is summed
+    over time block by block, so that all the intermediate arrays are
+    bounded by max_block_bytes (down to the coefficients of one frequency
+    and one time point of all the epochs and signals)
+
+    data: array (n_epochs, n_signals, n_times)
+
+    freqs, n_cycles: frequencies (and cycles) of the wavelets, only the
+    ones inside the bands defined by fmin and fmax are used
+
+    freq_idx_bands: indexes in freqs of the frequencies of each band, used
+    instead of the fmin <= freqs <= fmax selection (e.g. so that adjacent
+    bands do not share their common edge)
+
+    Returns con, array (n_signals, n_signals, n_bands) (a list if method is
+    a list, (n_pairs, n_bands) if indices are given) and the frequencies
+    used
+    """
+    from neuropype_ephy.window_cache import get_morlet_wavelets
+
+    data = np.asarray(data)
+
+    if data.ndim != 3:
+        raise ValueError('data should be 3D (n_epochs, n_signals, n_times), '
+                         'got shape {}'.format(data.shape))
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    n_epochs, n_signals, n_times = data.shape
+
+    freqs = np.asarray(freqs, dtype=float)
+
+    if freq_idx_bands is None:
+        freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+    else:
+        freq_mask = np.zeros(len(freqs), dtype=bool)
+        for freq_idx in freq_idx_bands:
+            if len(freq_idx) == 0:
+                raise ValueError('There are no frequency points in a band')
+            freq_mask[freq_idx] = True
+        # indexes among the masked frequencies
+        masked_idx = np.cumsum(freq_mask) - 1
+        freq_idx_bands = [masked_idx[freq_idx] for freq_idx in freq_idx_bands]
+
+    n_cycles = np.array((n_cycles,), dtype=float).ravel()
+    if len(n_cycles) > 1:
+        n_cycles = n_cycles[freq_mask]
+
+    freqs = freqs[freq_mask]
+    n_freqs = len(freqs)
+
+    wavelets = get_morlet_wavelets(sfreq, freqs, n_cycles=n_cycles,
+                                   zero_mean=True)
+
+    complex_dtype = get_complex_dtype(data)
+    real_dtype = np.zeros(0, dtype=complex_dtype).real.dtype
+
+    if indices is None:
+        pairs = np.tril_indices(n_signals, -1)
+    else:
+        pairs = (np.asarray(indices[0], dtype=int),
+                 np.asarray(indices[1], dtype=int))
+    n_pairs = len(pairs[0])
+
+    acc_names = set()
+    for met in methods:
+        acc_names.update(_method_accumulators[met])
+
+    # chunks of frequencies and blocks of time points for the coefficients
+    # of all epochs and signals (whole recording if a frequency fits),
+    # blocks of pairs for the accumulators of a chunk
+    coef_bytes = 16 * n_epochs * n_signals
+    freq_chunk = int(min(n_freqs, max(1, max_block_bytes //
+                                      (coef_bytes * n_times))))
+    time_block = int(min(n_times, max(1, max_block_bytes //
+                                      (coef_bytes * freq_chunk))))
+    pair_block = int(max(1, max_block_bytes //
+                         (16 * (len(acc_names) + 2) * freq_chunk *
+                          time_block)))
+
+    # sums over time of the metrics
+    cons = [np.zeros((n_freqs, n_pairs),
+                     dtype=complex_dtype if met == 'cohy' else real_dtype)
+            for met in methods]
+
+    for f_start in range(0, n_freqs, freq_chunk):
+
+        f_chunk = slice(f_start, f_start + freq_chunk)
+
+        for t_start in range(0, n_times, time_block):
+
+            # (n_epochs, n_block_times, n_freqs_chunk, n_signals)
+            coefs = compute_morlet_coefs(data, wavelets[f_chunk], t_start,
+                                         min(t_start + time_block, n_times))
+
+            psd = np.sum(np.abs(coefs) ** 2, axis=0)
+
+            for p_start in range(0, n_pairs, pair_block):
+
+                p_block = slice(p_start, p_start + pair_block)
+                block_pairs = (pairs[0][p_block], pairs[1][p_block])
+
+                acc = init_con_accumulators(
+                    methods, psd.shape[:-1] + (len(block_pairs[0]),),
+                    psd.shape, complex_dtype)
+                acc['psd'] = psd
+                acc['n_epochs'] = n_epochs
+
+                for coef in coefs:
+
+                    csd = coef[..., block_pairs[0]] * \
+                        np.conj(coef[..., block_pairs[1]])
+
+                    if 'csd' in acc:
+                        acc['csd'] += csd
+
+                    accumulate_epoch_csd(acc, csd)
+
+                for met, con in zip(methods, cons):
+                    con[f_chunk, p_block] += np.sum(
+                        compute_con_from_accumulators(acc, met, block_pairs),
+                        axis=0)
+
+    cons = [con / n_times for con in cons]
+
+    cons = [average_con_bands(con, freq_idx_bands, pairs) for con in cons]
+
+    if indices is None:
+        # lower triangular matrices as in mne
+        dense_cons = []
+        for con in cons:
+            dense_con = np.zeros((n_signals, n_signals, con.shape[-1]),
+                                 dtype=con.dtype)
+            dense_con[pairs] = con
+            dense_cons.append(dense_con)
+        cons = dense_cons
+
+    if not isinstance(method, (list, tuple)):
+        cons = cons[0]
+
+    return cons, freqs
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Batched surrogate null distributions for multitaper spectral connectivity
+
+Surrogates are built from the tapered spectra of the original epochs, so
+that no FFT is computed again:
+
+- 'phase': phase randomization, the spectrum of each signal is rotated by
+  a random phase for each epoch and frequency; the cross-spectrum of a pair
+  of an epoch is then the original one rotated by the difference of the
+  random phases of the two signals (powers are unchanged)
+- 'time_shift': the epochs of each signal are circularly shifted by a
+  random number of epochs (distinct for all the signals if there are at
+  least as many epochs as signals), i.e. each signal is shifted in time by a
+  multiple of the epoch length (epochs of continuous data) and the
+  coupling between signals is destroyed
+
+Surrogates are computed by batches (of at most max_batch_size surrogates,
+bounded by spectral_engine.max_block_bytes), batches being spread over
+n_jobs processes; each batch has its own random seed, drawn from
+random_state, so that results do not depend on n_jobs.
+"""
+import numpy as np
+
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.spectral_engine import (_method_accumulators,
+                                            accumulate_con,
+                                            accumulate_epoch_csd,
+                                            average_con_bands,
+                                            compute_con_from_accumulators,
+                                            compute_mt_spectra,
+                                            compute_mt_tapers,
+                                            compute_pair_csd,
+                                            con_methods_numpy,
+                                            get_band_freq_mask,
+                                            init_con_accumulators)
+
+surrogate_types = ['phase', 'time_shift']
+
+# number of surrogates per batch (also limited by max_block_bytes), batches
+# being the unit of work of the parallel jobs
+max_batch_size = 100
+
+
+def _con_from_acc(acc, methods, freq_idx_bands, indices):
+    return [average_con_bands(compute_con_from_accumulators(acc, met, indices),
+                              freq_idx_bands, indices)
+            for met in methods]
+
+
+def _phase_surrogate_batch(x_mt, psd, methods, n_surrogates, seed,
+                           freq_idx_bands, indices=None):
+    """
+    Null connectivity of n_surrogates phase randomized surrogates
+
+    x_mt: tapered spectra (n_epochs, n_freqs, n_signals, n_tapers), the
+    cross-spectra being computed epoch by epoch, so that only those of one
+    epoch are in memory
+    psd: sum of the power over epochs (n_freqs, n_signals)
+    """
+    rng = np.random.RandomState(seed)
+
+    n_epochs, n_freqs, n_signals = x_mt.shape[:3]
+
+    if indices is None:
+        con_shape = (n_freqs, n_signals, n_signals)
+    else:
+        con_shape = (n_freqs, len(indices[0]))
+
+    acc = init_con_accumulators(methods, (n_surrogates,) + con_shape,
+                                psd.shape, x_mt.dtype)
+    acc['psd'] = psd
+    acc['n_epochs'] = n_epochs
+
+    for i in range(n_epochs):
+
+        epoch_csd = compute_pair_csd(x_mt[i], indices)
+
+        phases = rng.uniform(0., 2. * np.pi, (n_surrogates, n_freqs,
+                                              n_signals))
+
+        if indices is None:
+            phase_diff = phases[..., :, np.newaxis] - \
+                phases[..., np.newaxis, :]
+        else:
+            phase_diff = phases[..., indices[0]] - phases[..., indices[1]]
+
+        csd = epoch_csd * np.exp(1j * phase_diff).astype(epoch_csd.dtype)
+
+        if 'csd' in acc:
+            acc['csd'] += csd
+
+        accumulate_epoch_csd(acc, csd)
+
+    return _con_from_acc(acc, methods, freq_idx_bands, indices)
+
+
+def _time_shift_surrogate_batch(x_mt, methods, n_surrogates, seed,
+                                freq_idx_bands, indices=None):
+    """
+    Null connectivity of n_surrogates surrogates whose epochs are
+    circularly shifted signal by signal
+
+    x_mt: tapered spectra (n_epochs, n_freqs, n_signals, n_tapers), the
+    shifted spectra of several surrogates being gathered at once and their
+    cross-spectra computed together
+    """
+    rng = np.random.RandomState(seed)
+
+    n_epochs, n_freqs, n_signals = x_mt.shape[:3]
+
+    if n_signals <= n_epochs:
+        # distinct shifts, so that no pair of signals stays aligned
+        shifts = np.array([rng.permutation(n_epochs)[:n_signals]
+                           for i in range(n_surrogates)])
+    else:
+        shifts = rng.randint(0, n_epochs, (n_surrogates, n_signals))
+
+    if indices is None:
+        con_shape = (n_freqs, n_signals, n_signals)
+    else:
+        con_shape = (n_freqs, len(indices[0]))
+
+    # surrogates whose shifted spectra are gathered together, bounded by
+    # max_block_bytes
+    sub_size = int(max(1, spectral_engine.max_block_bytes // x_mt.nbytes))
+
+    epoch_range = np.arange(n_epochs)[np.newaxis, :, np.newaxis]
+    signal_idx = np.arange(n_signals)[np.newaxis, np.newaxis, :]
+
+    null_cons = [[] for met in methods]
+
+    for start in range(0, n_surrogates, sub_size):
+
+        sub_shifts = shifts[start:start + sub_size]
+
+        # (n_sub, n_epochs, n_signals) epoch of each signal in each surrogate
+        epoch_idx = (epoch_range + sub_shifts[:, np.newaxis, :]) % n_epochs
+
+        # (n_sub, n_epochs, n_signals, n_freqs, n_tapers) -> x_mt layout
+        x_sur = x_mt[epoch_idx, :, signal_idx, :].transpose(0, 1, 3, 2, 4)
+
+        acc = init_con_accumulators(methods, (len(sub_shifts),) + con_shape,
+                                    (len(sub_shifts), n_freqs, n_signals),
+                                    x_mt.dtype)
+        accumulate_con(acc, x_sur, indices)
+
+        for null_con, con in zip(null_cons,
+                                 _con_from_acc(acc, methods, freq_idx_bands,
+                                               indices)):
+            null_con.append(con)
+
+    return [np.concatenate(null_con) for null_con in null_cons]
+
+
+def surrogate_connectivity_numpy(data, method, sfreq, fmin, fmax,
+                                 n_surrogates=1000, surrogate_type='phase',
+                                 random_state=None, mt_bandwidth=None,
+                                 mt_low_bias=True, n_jobs=1, indices=None):
+    """
+    Connectivity of the epochs of data and its surrogate null distribution
+
+    data: array (n_epochs, n_signals, n_times)
+
+    surrogate_type: 'phase' (phase randomization) or 'time_shift'
+    (circular shifts of the epochs of each signal, at least 2 epochs)
+
+    random_state: seed of the surrogates (int or None)
+
+    Other parameters are the same as spectral_engine.spectral_connectivity_numpy
+
+    Returns con (list, one array (n_signals, n_signals, n_bands), or
+    (n_pairs, n_bands) with indices, per method), null_con (list of arrays
+    (n_surrogates, ...) with the surrogate connectivity) and the
+    frequencies used
+    """
+    data = np.asarray(data)
+
+    if data.ndim != 3:
+        raise ValueError('data should be 3D (n_epochs, n_signals, n_times), '
+                         'got shape {}'.format(data.shape))
+
+    if surrogate_type not in surrogate_types:
+        raise ValueError('surrogate_type should be one of {}, got {}'.format(
+            surrogate_types, surrogate_type))
+
+    methods = method if isinstance(method, (list, tuple)) else [method]
+
+    for met in methods:
+        if met not in con_methods_numpy:
+            raise ValueError('con_method {} is not available in the numpy '
+                             'backend ({})'.format(met, con_methods_numpy))
+
+    n_epochs, n_signals, n_times = data.shape
+
+    if surrogate_type == 'time_shift' and n_epochs < 2:
+        raise ValueError('time_shift surrogates need at least 2 epochs')
+
+    if indices is not None:
+        indices = (np.asarray(indices[0], dtype=int),
+                   np.asarray(indices[1], dtype=int))
+
+    tapers, eigvals = compute_mt_tapers(n_times, sfreq, mt_bandwidth,
+                                        mt_low_bias)
+    freqs = np.fft.rfftfreq(n_times, 1. / sfreq)
+    freq_mask, freq_idx_bands = get_band_freq_mask(freqs, fmin, fmax)
+
+    # tapered spectra, computed once for the data and all the surrogates
+    x_mt = compute_mt_spectra(data, tapers, eigvals, freq_mask)
+    n_freqs = x_mt.shape[1]
+
+    if indices is None:
+        con_shape = (n_freqs, n_signals, n_signals)
+    else:
+        con_shape = (n_freqs, len(indices[0]))
+
+    acc = init_con_accumulators(methods, con_shape, (n_freqs, n_signals),
+                                x_mt.dtype)
+    accumulate_con(acc, x_mt, indices)
+
+    cons = _con_from_acc(acc, methods, freq_idx_bands, indices)
+
+    # batches of surrogates bounded in memory
+    acc_names = set()
+    for met in methods:
+        acc_names.update(_method_accumulators[met])
+
+    surrogate_bytes = 16 * (len(acc_names) + 3) * int(np.prod(con_shape))
+    batch_size = int(max(1, spectral_engine.max_block_bytes //
+                         surrogate_bytes))
+
+    batch_size = min(batch_size, max_batch_size)
+
+    batch_sizes = [min(batch_size, n_surrogates - start)
+                   for start in range(0, n_surrogates, batch_size)]
+
+    seeds = np.random.RandomState(random_state).randint(
+        0, 2 ** 31 - 1, len(batch_sizes))
+
+    if surrogate_type == 'phase':
+        batch_fun = _phase_surrogate_batch
+        batch_data = (x_mt, acc['psd'])
+    else:
+        batch_fun = _time_shift_surrogate_batch
+        batch_data = (x_mt, )
+
+    if n_jobs > 1:
+        from mne.parallel import parallel_func
+        parallel, p_fun, _ = parallel_func(batch_fun, n_jobs)
+    else:
+        parallel, p_fun = list, batch_fun
+
+    batch_null_cons = parallel(
+        p_fun(*(batch_data + (methods, size, seed, freq_idx_bands, indices)))
+        for size, seed in zip(batch_sizes, seeds))
+
+    null_cons = [np.concatenate([null_con[i] for null_con in batch_null_cons])
+                 for i in range(len(methods))]
+
+    if not isinstance(method, (list, tuple)):
+        cons, null_cons = cons[0], null_cons[0]
+
+    return cons, null_cons, freqs[freq_mask]
+
+
+def compute_surrogate_stats(con, null_con, percentiles=(95., 99.)):
+    """
+    Per-edge p-values and null percentiles
+
+    Connectivity values are compared in absolute value (two-sided test for
+    signed or complex metrics such as imcoh and cohy)
+
+    Returns p_values, with the same shape as con ((1 + number of surrogates
+    at least as strong) / (n_surrogates + 1)), and null_percentiles
+    (n_percentiles, ...)
+    """
+    abs_con = np.abs(con)
+    abs_null = np.abs(null_con)
+
+    n_surrogates = abs_null.shape[0]
+
+    p_values = (1. + np.sum(abs_null >= abs_con, axis=0)) / (n_surrogates + 1.)
+
+    null_percentiles = np.percentile(abs_null, percentiles, axis=0)
+
+    return p_values, null_percentiles
@@ -0,0 +1,130 @@
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.chunked_preproc import (_filter_block, _get_block_padding,
+                                            design_filter, design_lowpass_fir,
+                                            filter_resample_to_npy,
+                                            get_resample_factors,
+                                            resample_polyphase,
+                                            resample_raw_polyphase)
+from neuropype_ephy.preproc import (create_ts, preprocess_fif_to_ts,
+                                    preprocess_ts)
+import mne
+import numpy as np
+import os
+import pytest
+
+
+def _save_raw(fname, n_times=12000, sfreq=1000.):
+    rng = np.random.RandomState(0)
+    times = np.arange(n_times) / sfreq
+    data = 1e-12 * (np.sin(2 * np.pi * 7. * times) +
+                    np.sin(2 * np.pi * 11. * times)[::-1] +
+                    0.1 * rng.randn(4, n_times))
+    info = mne.create_info(['MEG0111', 'MEG0121', 'MEG0131', 'MEG0141'],
+                           sfreq, 'mag')
+    mne.io.RawArray(data, info, verbose=False).save(fname, verbose=False)
+    return fname
+
+
+@pytest.mark.parametrize('sfreq,down_sfreq,h_freq', [(1000., 250., 40.),
+                                                     (600., 250., 100.),
+                                                     (1000., None, 30.),
+                                                     (1000., 300., None)])
+def test_filter_resample_to_npy(tmpdir, monkeypatch, sfreq, down_sfreq,
+                                h_freq):
+    os.chdir(str(tmpdir))
+    data = np.random.RandomState(0).randn(3, 10007)
+    up, down = get_resample_factors(sfreq, down_sfreq)
+    # blocks of ~1000 input time points
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes', 8 * 3 * up * 1000)
+    ts_file, new_sfreq = filter_resample_to_npy(
+        lambda start, stop: data[:, start:stop], 3, data.shape[1], sfreq,
+        'ts.npy', h_freq, down_sfreq)
+    assert new_sfreq == (sfreq if down_sfreq is None else down_sfreq)
+    # whole recording at once, with the same edge padding
+    fir_coefs = design_filter(sfreq, h_freq, up, down)
+    pad = _get_block_padding(fir_coefs, up, down)
+    ref = _filter_block(np.pad(data, ((0, 0), (pad, pad)), mode='reflect',
+                               reflect_type='odd'), fir_coefs, up, down)
+    n_times = -(-data.shape[1] * up // down)
+    ref = ref[:, pad * up // down:pad * up // down + n_times]
+    np.testing.assert_allclose(np.load(ts_file), ref, atol=1e-12)
+    if down_sfreq is not None:
+        np.testing.assert_allclose(
+            resample_polyphase(data, sfreq, down_sfreq, h_freq)[0], ref,
+            atol=1e-12)
+
+
+def test_lowpass_matches_mne():
+    data = np.random.RandomState(0).randn(3, 5000)
+    ref = mne.filter.filter_data(data, 1000., None, 40., fir_design='firwin',
+                                 verbose=False)
+    ts = _filter_block(data, design_lowpass_fir(40., 1000.), 1, 1)
+    np.testing.assert_allclose(ts[:, 1000:-1000], ref[:, 1000:-1000],
+                               atol=1e-12)
+
+
+def test_streamed_preprocess_fif_to_ts(tmpdir, monkeypatch):
+    os.chdir(str(tmpdir))
+    fif_file = _save_raw(os.path.abspath('sub_raw.fif'))
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes', 8 * 4 * 1000)
+    ts_file, _, names_file, sfreq = preprocess_fif_to_ts(
+        fif_file, None, 40., 250., True, streaming=True)
+    assert sfreq == 250.
+    ts = np.load(ts_file)
+    assert ts.shape == (4, 3000)
+    assert list(np.loadtxt(names_file, dtype='str')) == [
+        'MEG0111', 'MEG0121', 'MEG0131', 'MEG0141']
+    os.rename(ts_file, 'streamed_ts.npy')
+    ref_file = preprocess_fif_to_ts(fif_file, None, 40., 250., True)[0]
+    ref = np.load(ref_file)
+    # polyphase and FFT resampling agree away from the edges
+    np.testing.assert_allclose(ts[:, 250:-250], ref[:, 250:-250],
+                               atol=5e-3 * np.abs(ref).max())
+    create_ts(fif_file, streaming=True)
+    ts = np.load(ts_file)
+    os.rename(ts_file, 'streamed_ts.npy')
+    np.testing.assert_array_equal(ts, np.load(create_ts(fif_file)[0]))
+
+
+def test_polyphase_preprocessing(tmpdir):
+    os.chdir(str(tmpdir))
+    fif_file = _save_raw(os.path.abspath('sub_raw.fif'))
+    streamed = np.array(np.load(preprocess_fif_to_ts(
+        fif_file, None, 40., 250., True, streaming=True)[0]))
+    atol = 1e-10 * np.abs(streamed).max()
+    ts_file, coords_file, names_file, sfreq = preprocess_fif_to_ts(
+        fif_file, None, 40., 250., True, resample_method='polyphase')
+    assert sfreq == 250.
+    # same fused filter in memory and by blocks
+    np.testing.assert_allclose(np.load(ts_file), streamed, atol=atol)
+    raw_ts_file = create_ts(fif_file)[0]
+    downsampled_file, _, _, sfreq = preprocess_ts(
+        raw_ts_file, names_file, coords_file, 40., 1000., 250.,
+        resample_method='polyphase')
+    assert sfreq == 250.
+    np.testing.assert_allclose(np.load(downsampled_file), streamed,
+                               atol=atol)
+
+
+def test_resample_raw_polyphase():
+    info = mne.create_info(['MEG0111', 'MEG0121', 'STI014'], 1000.,
+                           ['mag', 'mag', 'stim'])
+    data = 1e-12 * np.random.RandomState(0).randn(3, 10000)
+    data[2] = 0.
+    data[2, 2003:2010] = 5.
+    data[2, 6001] = 5.
+    raw = mne.io.RawArray(data, info, first_samp=500, verbose=False)
+    raw.set_annotations(mne.Annotations([1., 3.5], [0.5, 1.],
+                                        ['bad_segment', 'stim']))
+    new_raw = resample_raw_polyphase(raw, 250., 40.)
+    assert new_raw.info['sfreq'] == 250.
+    np.testing.assert_allclose(new_raw.get_data(picks=[0, 1]),
+                               resample_polyphase(data[:2], 1000., 250.,
+                                                  40.)[0])
+    # stim channels decimated as by mne, without filter ringing
+    assert set(np.unique(new_raw.get_data(picks=[2]))) == set([0., 5.])
+    ref_raw = raw.copy().resample(250., npad=0, verbose=False)
+    np.testing.assert_array_equal(mne.find_events(new_raw, verbose=False),
+                                  mne.find_events(ref_raw, verbose=False))
+    np.testing.assert_array_equal(new_raw.annotations.onset, [1., 3.5])
+    assert list(new_raw.annotations.description) == ['bad_segment', 'stim']
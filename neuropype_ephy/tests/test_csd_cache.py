@@ -0,0 +1,122 @@
+from neuropype_ephy import csd_cache
+from neuropype_ephy.spectral import (compute_and_save_streamed_spectral_connectivity,
+                                     iter_epoch_chunks)
+from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+import numpy as np
+import os
+import pytest
+
+
+@pytest.fixture
+def ts_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(csd_cache, 'cache_dir',
+                        str(tmpdir.join('csd_cache')))
+    rng = np.random.RandomState(0)
+    data = rng.randn(8, 4, 300)
+    data[:, 1] += 0.5 * data[:, 0]
+    ts_file = str(tmpdir.join('ts.npy'))
+    np.save(ts_file, data)
+    return ts_file
+
+
+def _cached_con(ts_file, method, fmin, fmax, n_calls):
+    def epoch_chunks_fun():
+        n_calls.append(1)
+        return iter_epoch_chunks(ts_file, n_epochs_chunk=3)
+    return csd_cache.cached_spectral_connectivity(
+        ts_file, epoch_chunks_fun, method, 100., fmin, fmax)[0]
+
+
+def test_csd_cache_reduction(ts_file):
+    data = np.load(ts_file)
+    n_calls = []
+    for method, fmin, fmax in [('coh', [8.], [30.]),
+                               ('imcoh', [10.], [20.]),  # from cache
+                               ('wpli', [10.], [20.]),  # new sums
+                               ('coh', [30.], [40.])]:  # new band
+        con = _cached_con(ts_file, method, fmin, fmax, n_calls)
+        ref_con = spectral_connectivity_numpy(data, method, 100., fmin,
+                                              fmax)[0]
+        np.testing.assert_allclose(con, ref_con, atol=1e-10)
+    assert len(n_calls) == 3
+    # the last entry covers both bands and all the sums
+    con = _cached_con(ts_file, ['coh', 'wpli'], [8., 35.], [12., 40.],
+                      n_calls)
+    assert len(n_calls) == 3
+    ref_con = spectral_connectivity_numpy(data, 'wpli', 100., [8., 35.],
+                                          [12., 40.])[0]
+    np.testing.assert_allclose(con[1], ref_con, atol=1e-10)
+
+
+def test_csd_cache_eviction(ts_file, monkeypatch, tmpdir):
+    os.chdir(str(tmpdir))
+    monkeypatch.setattr(csd_cache, 'max_cache_bytes', 1)
+    conmat_file = compute_and_save_streamed_spectral_connectivity(
+        ts_file, 'coh', 100., 8., 12., use_csd_cache=True)
+    np.save(ts_file, np.load(ts_file)[:4])
+    compute_and_save_streamed_spectral_connectivity(
+        ts_file, 'coh', 100., 8., 12., use_csd_cache=True)
+    # only the entry being used is kept
+    assert len(os.listdir(csd_cache.cache_dir)) == 1
+    assert os.path.exists(conmat_file)
+
+
+def test_csd_cache_dir(ts_file, monkeypatch, tmpdir):
+    from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+    os.chdir(str(tmpdir))
+    monkeypatch.setattr(csd_cache, 'cache_dir', None)
+    monkeypatch.delenv('NEUROPYPE_EPHY_CSD_CACHE_DIR', raising=False)
+    # the cache is off by default
+    with pytest.raises(ValueError):
+        compute_and_save_streamed_spectral_connectivity(
+            ts_file, 'coh', 100., 8., 12., use_csd_cache=True)
+    spectral_node = SpectralConn()
+    spectral_node.inputs.ts_file = ts_file
+    spectral_node.inputs.sfreq = 100.
+    spectral_node.inputs.freq_band = [8., 12.]
+    spectral_node.inputs.con_method = 'coh'
+    spectral_node.inputs.use_csd_cache = True
+    with pytest.raises(ValueError):
+        spectral_node._run_interface(None)
+    cache_dir = str(tmpdir.join('node_cache'))
+    spectral_node.inputs.csd_cache_dir = cache_dir
+    spectral_node._run_interface(None)
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_csd_cache_concurrent_writes(ts_file, monkeypatch):
+    data = np.load(ts_file)
+    ref_con = spectral_connectivity_numpy(data, 'coh', 100., [8.], [12.])[0]
+    n_calls = []
+    # entry being written by another process, never evicted
+    tmp_entry = os.path.join(csd_cache.cache_dir, '.tmp_other')
+    os.makedirs(tmp_entry)
+    with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+        f.write('{}')
+    monkeypatch.setattr(csd_cache, 'max_cache_bytes', 1)
+    con = _cached_con(ts_file, 'coh', [8.], [12.], n_calls)
+    np.testing.assert_allclose(con, ref_con, atol=1e-10)
+    assert os.path.exists(tmp_entry)
+    (entry_dir, ) = [os.path.join(csd_cache.cache_dir, key)
+                     for key in os.listdir(csd_cache.cache_dir)
+                     if not key.startswith('.tmp_')]
+    # accumulators removed under a reader: computed again
+    os.remove(os.path.join(entry_dir, 'csd.npy'))
+    con = _cached_con(ts_file, 'coh', [8.], [12.], n_calls)
+    np.testing.assert_allclose(con, ref_con, atol=1e-10)
+    assert len(n_calls) == 2
+    assert os.path.exists(os.path.join(entry_dir, 'csd.npy'))
+    # entry written by another process first: the computed sums are used
+    rename = os.rename
+
+    def losing_rename(src, dst):
+        if dst == entry_dir:
+            raise OSError('entry written by another process')
+        rename(src, dst)
+
+    monkeypatch.setattr(csd_cache.os, 'rename', losing_rename)
+    con = _cached_con(ts_file, 'wpli', [8.], [12.], n_calls)
+    ref_con = spectral_connectivity_numpy(data, 'wpli', 100., [8.], [12.])[0]
+    np.testing.assert_allclose(con, ref_con, atol=1e-10)
+    # no directory left behind
+    assert os.listdir(csd_cache.cache_dir) == ['.tmp_other']
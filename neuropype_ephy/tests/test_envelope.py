@@ -0,0 +1,92 @@
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.envelope import envelope_connectivity
+from neuropype_ephy.spectral import (compute_and_save_spectral_connectivity,
+                                     load_conmat_pairs)
+from scipy.signal import hilbert
+import numpy as np
+import os
+
+
+def _band_hilbert(data, sfreq, fmin, fmax):
+    """ Hilbert transform of the ideal band-passed data """
+    freqs = np.abs(np.fft.fftfreq(data.shape[-1], 1. / sfreq))
+    data_fft = np.fft.fft(data - data.mean(axis=-1)[..., None], axis=-1)
+    data_fft[..., (freqs < fmin) | (freqs > fmax)] = 0.
+    return hilbert(np.real(np.fft.ifft(data_fft, axis=-1)), axis=-1)
+
+
+def _naive_aec(z, orth):
+    n_epochs, n_signals = z.shape[:2]
+    con = np.zeros((n_signals, n_signals))
+    for i in range(n_signals):
+        for j in range(i):
+            corrs = []
+            for e in range(n_epochs):
+                if orth:
+                    y_ji = np.imag(z[e, j] * np.conj(z[e, i]) /
+                                   np.abs(z[e, i]))
+                    y_ij = np.imag(z[e, i] * np.conj(z[e, j]) /
+                                   np.abs(z[e, j]))
+                    c_1 = np.corrcoef(np.abs(z[e, i]), np.abs(y_ji))[0, 1]
+                    c_2 = np.corrcoef(np.abs(z[e, j]), np.abs(y_ij))[0, 1]
+                    corrs.append((np.abs(c_1) + np.abs(c_2)) / 2.)
+                else:
+                    corrs.append(np.corrcoef(np.abs(z[e, i]),
+                                             np.abs(z[e, j]))[0, 1])
+            con[i, j] = np.mean(corrs)
+    return con
+
+
+def test_envelope_connectivity(monkeypatch):
+    rng = np.random.RandomState(0)
+    data = rng.randn(3, 5, 301)
+    data[:, 1] += data[:, 0]
+    # several blocks of pairs
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes', 3 * 6 * 301 * 16)
+    cons, freqs = envelope_connectivity(data, ['aec', 'aec_orth'], 100.,
+                                        [8., 20.], [13., 30.])
+    assert np.all((freqs >= 8.) & (freqs <= 30.))
+    for con, orth in zip(cons, [False, True]):
+        assert con.shape == (5, 5, 2)
+        for i, (f_lo, f_hi) in enumerate([(8., 13.), (20., 30.)]):
+            z = _band_hilbert(data, 100., f_lo, f_hi)
+            np.testing.assert_allclose(con[..., i], _naive_aec(z, orth),
+                                       atol=1e-10)
+    # pairs
+    indices = (np.array([1, 4]), np.array([0, 2]))
+    pair_con, _ = envelope_connectivity(data, 'aec_orth', 100., 8., 13.,
+                                        indices=indices)
+    np.testing.assert_allclose(pair_con, cons[1][indices[0], indices[1],
+                                                 :1])
+
+
+def test_aec_conmats(tmpdir):
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(1)
+    data = rng.randn(4, 3, 200)
+    conmat_files = compute_and_save_spectral_connectivity(
+        data, ['aec', 'coh', 'aec_orth'], 100., 8., 13., backend='numpy',
+        indices=([1, 2], [0, 0]))
+    assert [os.path.basename(f) for f in conmat_files] == [
+        'conmat_0_aec_pairs.npz', 'conmat_0_coh_pairs.npz',
+        'conmat_0_aec_orth_pairs.npz']
+    con = load_conmat_pairs(conmat_files[0], dense=True)
+    ref_con, _ = envelope_connectivity(data, 'aec', 100., 8., 13.)
+    np.testing.assert_allclose(con[[1, 2], [0, 0]], ref_con[[1, 2], [0, 0],
+                                                           0])
+
+
+def test_float32_envelope():
+    from neuropype_ephy.envelope import iter_band_analytic_signals
+    rng = np.random.RandomState(2)
+    data = rng.randn(3, 4, 300)
+    data[:, 1] += data[:, 0]
+    for z in iter_band_analytic_signals(data.astype(np.float32), 100.,
+                                        [8., 20.], [13., 30.]):
+        assert z.dtype == np.complex64
+    cons, _ = envelope_connectivity(data, ['aec', 'aec_orth'], 100., 8., 13.)
+    f32_cons, _ = envelope_connectivity(data.astype(np.float32),
+                                        ['aec', 'aec_orth'], 100., 8., 13.)
+    for con, f32_con in zip(cons, f32_cons):
+        assert f32_con.dtype == np.float32
+        np.testing.assert_allclose(f32_con, con, atol=1e-5)
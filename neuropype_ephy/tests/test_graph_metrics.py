@@ -0,0 +1,72 @@
+from neuropype_ephy import graph_metrics
+from neuropype_ephy.graph_metrics import (compute_graph_metrics,
+                                          threshold_conmat)
+from neuropype_ephy.nodes.graph_metrics import GraphMetrics
+from neuropype_ephy.spectral import save_packed_conmat
+from scipy.sparse import csgraph
+import csv
+import numpy as np
+import os
+import pytest
+
+
+def _two_cliques():
+    """ two 5-node cliques joined by the edge (4, 5), lower triangular """
+    adj = np.zeros((10, 10))
+    adj[:5, :5] = 1.
+    adj[5:, 5:] = 1.
+    adj[5, 4] = 1.
+    return np.tril(adj, -1)
+
+
+def test_threshold_conmat():
+    conmat = np.tril(np.random.RandomState(0).rand(20, 20), -1)
+    adj = threshold_conmat(conmat, 0.1)
+    assert adj.nnz == 2 * 19
+    assert (adj != adj.T).nnz == 0
+    assert adj.data.min() == np.sort(conmat[conmat > 0])[-19]
+    adj = threshold_conmat(conmat, 0.9, 'absolute')
+    assert adj.nnz == 2 * np.sum(conmat > 0.9)
+
+
+@pytest.mark.parametrize('max_dense_split', [100, 1])
+def test_graph_metrics(max_dense_split, monkeypatch):
+    # sparse eigensolver for all the splits
+    monkeypatch.setattr(graph_metrics, '_max_dense_split', max_dense_split)
+    global_metrics, nodal_metrics = compute_graph_metrics(_two_cliques(), 0.,
+                                                          'absolute')
+    assert global_metrics['n_edges'] == 21
+    np.testing.assert_array_equal(nodal_metrics['module'], [0] * 5 + [1] * 5)
+    # two modules of 10 edges, 21 edges in total
+    np.testing.assert_allclose(global_metrics['modularity'],
+                               2 * (10. / 21 - 0.25))
+    clustering = np.ones(10)
+    clustering[[4, 5]] = 6. / 10
+    np.testing.assert_allclose(nodal_metrics['clustering'], clustering)
+    adj = _two_cliques() + _two_cliques().T
+    dist = csgraph.shortest_path(adj, unweighted=True)
+    np.fill_diagonal(dist, np.inf)
+    np.testing.assert_allclose(nodal_metrics['efficiency'],
+                               np.sum(1. / dist, axis=1) / 9.)
+
+
+def test_graph_metrics_node(tmpdir):
+    os.chdir(str(tmpdir))
+    conmat = _two_cliques()
+    np.save('conmat.npy', np.array([conmat, 0.5 * conmat]))
+    save_packed_conmat('conmat_packed.npz', conmat, 'coh', [8., 12.], 100.)
+    graph_node = GraphMetrics()
+    graph_node.inputs.conmat_files = [os.path.abspath('conmat.npy'),
+                                      os.path.abspath('conmat_packed.npz')]
+    graph_node.inputs.threshold = 0.
+    graph_node.inputs.threshold_type = 'absolute'
+    outputs = graph_node.run().outputs
+    with open(outputs.metrics_file) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 3
+    assert [row['conmat_index'] for row in rows] == ['0', '1', '0']
+    assert all(int(row['n_modules']) == 2 for row in rows)
+    nodal_metrics = np.load(outputs.nodal_metrics_file)
+    assert nodal_metrics['strength'].shape == (3, 10)
+    np.testing.assert_allclose(nodal_metrics['strength'][1],
+                               0.5 * nodal_metrics['strength'][0])
@@ -0,0 +1,58 @@
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.group_conmats import (build_conmat_cube,
+                                          compute_group_conmat_stats,
+                                          cube_mean_var, cube_paired_ttest,
+                                          load_conmat_cube)
+from neuropype_ephy.spectral import save_packed_conmat
+from scipy.stats import ttest_rel
+import numpy as np
+import os
+
+
+def test_conmat_cube(tmpdir, monkeypatch):
+    os.chdir(str(tmpdir))
+    # chunks of 2 edges
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes', 2 * 8 * 5 * 2 * 2)
+    rng = np.random.RandomState(0)
+    n_nodes = 6
+    conmats = np.tril(rng.rand(5, 2, 2, n_nodes, n_nodes), -1)
+    conmats[:, 1] += 0.1
+    entries = []
+    for s in range(5):
+        for c, condition in enumerate(['rest', 'task']):
+            for b, band in enumerate(['alpha', 'beta']):
+                if (s, c, b) == (4, 1, 0):
+                    continue  # missing conmat
+                conmat_file = 'conmat_{}_{}_{}.npy'.format(s, c, b)
+                if b == 1:
+                    conmat_file = save_packed_conmat(
+                        conmat_file.replace('.npy', '_packed.npz'),
+                        conmats[s, c, b], 'coh', [15., 30.], 100.)
+                else:
+                    np.save(conmat_file, conmats[s, c, b])
+                entries.append(('subj{}'.format(s), condition, band,
+                                conmat_file))
+    cube_file, index_file = build_conmat_cube(entries, 'cube.npy')
+    cube, index = load_conmat_cube(cube_file)
+    assert index['conditions'] == ['rest', 'task']
+    assert index['bands'] == ['alpha', 'beta']
+    assert cube.shape == (5, 2, 2, n_nodes * (n_nodes - 1) / 2)
+    rows, cols = np.tril_indices(n_nodes, -1)
+    edges = conmats[..., rows, cols].astype(np.float32)
+    edges[4, 1, 0] = np.nan
+    np.testing.assert_array_equal(cube, edges)
+    mean, var = cube_mean_var(cube)
+    np.testing.assert_allclose(mean, np.nanmean(edges, axis=0), rtol=1e-6)
+    np.testing.assert_allclose(var, np.nanvar(edges, axis=0, ddof=1),
+                               rtol=1e-5)
+    t_values, p_values = cube_paired_ttest(cube, 1, 0)
+    ref_t, ref_p = ttest_rel(edges[:, 1, 1], edges[:, 0, 1])
+    np.testing.assert_allclose(t_values[1], ref_t, rtol=1e-5)
+    np.testing.assert_allclose(p_values[1], ref_p, rtol=1e-5)
+    # missing subject ignored
+    ref_t, ref_p = ttest_rel(edges[:4, 1, 0], edges[:4, 0, 0])
+    np.testing.assert_allclose(t_values[0], ref_t, rtol=1e-5)
+    stats = np.load(compute_group_conmat_stats(cube_file, 'task', 'rest'))
+    assert stats['mean'].shape == (2, 2, n_nodes, n_nodes)
+    np.testing.assert_allclose(stats['t_values'][0][rows, cols], ref_t,
+                               rtol=1e-5)
@@ -0,0 +1,70 @@
+from neuropype_ephy.mvar import directed_connectivity, fit_mvar
+from neuropype_ephy.spectral import (compute_and_save_directed_connectivity,
+                                     multiple_windowed_directed_proc)
+import numpy as np
+import os
+
+
+def _var_data(n_epochs=10, n_times=1000):
+    """ VAR(2) with an influence of signal 0 on signal 1 """
+    rng = np.random.RandomState(0)
+    noise = rng.randn(n_epochs, 3, n_times)
+    data = np.zeros((n_epochs, 3, n_times))
+    for t in range(2, n_times):
+        data[:, 0, t] = 0.5 * data[:, 0, t - 1] - 0.3 * data[:, 0, t - 2]
+        data[:, 1, t] = 0.4 * data[:, 1, t - 1] + 0.5 * data[:, 0, t - 1]
+        data[:, 2, t] = 0.2 * data[:, 2, t - 2]
+        data[:, :, t] += noise[:, :, t]
+    return data
+
+
+def test_fit_mvar():
+    data = _var_data()
+    coefs, noise_cov = fit_mvar(data, 2)
+    true_coefs = np.zeros((2, 3, 3))
+    true_coefs[0, 0, 0], true_coefs[1, 0, 0] = 0.5, -0.3
+    true_coefs[0, 1, 1], true_coefs[0, 1, 0] = 0.4, 0.5
+    true_coefs[1, 2, 2] = 0.2
+    np.testing.assert_allclose(coefs, true_coefs, atol=0.05)
+    np.testing.assert_allclose(noise_cov, np.eye(3), atol=0.05)
+    # one model per leading index, same as separate fits
+    batch_coefs, _ = fit_mvar(data.reshape(2, 5, 3, -1), 2)
+    np.testing.assert_allclose(batch_coefs[1], fit_mvar(data[5:], 2)[0])
+
+
+def test_directed_connectivity():
+    data = _var_data()
+    cons, freqs = directed_connectivity(data, ['gc', 'pdc', 'dtf'], 100.,
+                                        0., 50., order=2)
+    for con in cons:
+        assert con.shape == (3, 3, 1)
+        # 0 -> 1 only
+        assert con[1, 0, 0] > 0.2
+        assert np.all(np.delete(con.ravel(), 3) < 0.05)
+    # the spectral Granger causality sums to the time-domain one
+    _, noise_cov = fit_mvar(data, 2)
+    _, reduced_cov = fit_mvar(data[:, [1, 2]], 2)
+    np.testing.assert_allclose(cons[0][1, 0, 0],
+                               np.log(reduced_cov[0, 0] / noise_cov[1, 1]),
+                               rtol=0.05)
+    pair_con, _ = directed_connectivity(data, 'pdc', 100., 0., 50., order=2,
+                                        indices=([0, 2], [1, 0]))
+    np.testing.assert_allclose(pair_con[:, 0], cons[1][[1, 0], [0, 2], 0])
+
+
+def test_directed_conmats(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _var_data(n_epochs=4, n_times=400)
+    conmat_files = compute_and_save_directed_connectivity(
+        data, 'gc', 100., [4., 20.], [12., 40.], order=2,
+        freq_band_names=['low', 'high'])
+    assert [os.path.basename(f) for f in conmat_files] == [
+        'conmat_0_gc_low.npy', 'conmat_0_gc_high.npy']
+    np.save('ts.npy', data.reshape(2, 2, 3, 400))
+    conmat_file = multiple_windowed_directed_proc('ts.npy', 100., [4., 12.],
+                                                  'dtf', order=2)
+    con = np.load(conmat_file)
+    assert con.shape == (2, 2, 3, 3)
+    ref_con, _ = directed_connectivity(data[3], 'dtf', 100., 4., 12.,
+                                       order=2)
+    np.testing.assert_allclose(con[1, 1], ref_con[..., 0])
@@ -0,0 +1,89 @@
+from neuropype_ephy import spectral_engine
+from neuropype_ephy.envelope import compute_band_analytic_signals
+from neuropype_ephy.nodes.pac import PAC
+from neuropype_ephy.pac import compute_pac
+import numpy as np
+import os
+import pytest
+
+
+def _pac_data():
+    """ gamma amplitude of node 1 locked to the theta phase of node 0 """
+    rng = np.random.RandomState(0)
+    times = np.arange(500) / 250.
+    theta = np.sin(2 * np.pi * 6. * times + rng.uniform(0, 2 * np.pi,
+                                                        (6, 1)))
+    data = 0.5 * rng.randn(6, 3, 500)
+    data[:, 0] += theta
+    data[:, 1] += (1. + theta) * np.sin(2 * np.pi * 60. * times)
+    return data
+
+
+def _naive_pac(data, phase_band, amp_band, method, n_bins=18):
+    z_phase, z_amp = compute_band_analytic_signals(
+        data, 250., [phase_band[0], amp_band[0]], [phase_band[1], amp_band[1]])
+    phase = np.concatenate(np.angle(z_phase), axis=-1)
+    amp = np.concatenate(np.abs(z_amp), axis=-1)
+    n_nodes = data.shape[1]
+    pac = np.zeros((n_nodes, n_nodes))
+    for i in range(n_nodes):
+        for j in range(n_nodes):
+            if method == 'mvl':
+                pac[i, j] = np.abs(np.mean(amp[j] * np.exp(1j * phase[i])))
+            else:
+                bins = np.minimum(((phase[i] + np.pi) / (2 * np.pi) *
+                                   n_bins).astype(int), n_bins - 1)
+                mean_amp = np.array([amp[j][bins == b].mean()
+                                     for b in range(n_bins)])
+                dist = mean_amp / mean_amp.sum()
+                pac[i, j] = 1. + np.sum(dist * np.log(dist)) / np.log(n_bins)
+    return pac
+
+
+@pytest.mark.parametrize('method', ['mi', 'mvl'])
+def test_compute_pac(method, monkeypatch):
+    data = _pac_data()
+    # chunks of 2 epochs
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes',
+                        2 * 16 * 3 * 500 * 5 + 2 * 8 * 3 * 500 * 18)
+    phase_bands, amp_bands = [[4., 8.]], [[50., 70.], [20., 30.]]
+    pac = compute_pac(data, 250., phase_bands, amp_bands, method=method)
+    assert pac.shape == (3, 3, 1, 2)
+    for a, amp_band in enumerate(amp_bands):
+        np.testing.assert_allclose(pac[:, :, 0, a],
+                                   _naive_pac(data, [4., 8.], amp_band,
+                                              method), atol=1e-10)
+    # theta phase of node 0 modulates the gamma amplitude of node 1
+    assert np.argmax(pac[..., 0, 0]) == 1
+
+
+@pytest.mark.parametrize('method', ['mi', 'mvl'])
+def test_continuous_pac(method, monkeypatch):
+    rng = np.random.RandomState(1)
+    times = np.arange(20000) / 250.
+    theta = np.sin(2 * np.pi * 6. * times)
+    data = 0.5 * rng.randn(3, 20000)
+    data[0] += theta
+    data[1] += (1. + theta) * np.sin(2 * np.pi * 60. * times)
+    ref_pac = compute_pac(data, 250., [[4., 8.]], [[50., 70.]], method)
+    # padded blocks of 3000 time points
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes',
+                        8 * 3 * 10 * (3000 + 2 * 1250))
+    pac = compute_pac(data, 250., [[4., 8.]], [[50., 70.]], method)
+    np.testing.assert_allclose(pac, ref_pac, atol=1e-2 * ref_pac.max())
+    assert np.argmax(pac) == np.argmax(ref_pac) == 1
+
+
+def test_pac_node(tmpdir):
+    os.chdir(str(tmpdir))
+    np.save('ts.npy', _pac_data())
+    pac_node = PAC()
+    pac_node.inputs.ts_file = os.path.abspath('ts.npy')
+    pac_node.inputs.sfreq = 250.
+    pac_node.inputs.phase_freq_bands = [[4., 8.]]
+    pac_node.inputs.amp_freq_bands = [[50., 70.]]
+    pac_file = pac_node.run().outputs.pac_file
+    assert os.path.basename(pac_file) == 'pac_mi.npy'
+    np.testing.assert_allclose(np.load(pac_file),
+                               compute_pac(_pac_data(), 250., [[4., 8.]],
+                                           [[50., 70.]]))
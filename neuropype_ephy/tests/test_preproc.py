@@ -0,0 +1,39 @@
+from neuropype_ephy import preproc
+from neuropype_ephy.preproc import (get_epochs_info, get_raw_info,
+                                    get_raw_sfreq)
+import mne
+import numpy as np
+import os
+
+
+def test_header_only_info(tmpdir, monkeypatch):
+    os.chdir(str(tmpdir))
+    info = mne.create_info(['MEG0111', 'MEG0121', 'EOG061'], 1000.,
+                           ['mag', 'mag', 'eog'])
+    raw = mne.io.RawArray(1e-12 * np.random.RandomState(0).randn(3, 5000),
+                          info, verbose=False)
+    raw.save('sub_raw.fif', verbose=False)
+    epochs = mne.Epochs(raw, mne.make_fixed_length_events(raw, duration=1.),
+                        tmin=0., tmax=0.5, baseline=None, preload=True,
+                        verbose=False).decimate(2)
+    epochs.save('sub-epo.fif')
+    n_reads = []
+    read_info = mne.io.read_info
+    monkeypatch.setattr(mne.io, 'read_info',
+                        lambda fname: n_reads.append(fname) or
+                        read_info(fname, verbose=False))
+    monkeypatch.setattr(preproc, '_fif_info_cache', {})
+    raw_info = get_raw_info('sub_raw.fif')
+    assert raw_info['filename'] == 'sub_raw.fif'
+    assert raw_info['ch_names'] == raw.info['ch_names']
+    assert get_raw_sfreq('sub_raw.fif') == 1000.
+    # modifying a returned info does not change the memoized one
+    raw_info['bads'] = ['MEG0111']
+    assert get_raw_info('sub_raw.fif')['bads'] == []
+    assert n_reads == ['sub_raw.fif']
+    assert get_epochs_info('sub-epo.fif')['sfreq'] == 500.
+    # a new file at the same path is read again
+    raw.crop(0., 2.).save('sub_raw.fif', overwrite=True, verbose=False)
+    os.utime('sub_raw.fif', (0, 0))
+    get_raw_info('sub_raw.fif')
+    assert n_reads == ['sub_raw.fif', 'sub-epo.fif', 'sub_raw.fif']
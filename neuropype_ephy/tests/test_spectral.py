@@ -0,0 +1,490 @@
+from neuropype_ephy.spectral import (compute_and_save_spectral_connectivity,
+                                     compute_and_save_streamed_spectral_connectivity,
+                                     epoch_continuous_data,
+                                     filter_adj_plot_mat,
+                                     get_contact_adjacency_mask,
+                                     get_plot_labels,
+                                     get_seed_target_indices,
+                                     load_conmat_pairs, load_packed_conmat,
+                                     load_packed_conmat_header,
+                                     multiple_dynamic_spectral_proc,
+                                     multiple_windowed_spectral_proc,
+                                     plot_circular_connectivity_batch,
+                                     select_top_edges)
+from neuropype_ephy import spectral
+from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+import numpy as np
+import os
+import pytest
+
+
+def _make_epochs(n_epochs=10, n_signals=5, n_times=500, seed=0):
+    rng = np.random.RandomState(seed)
+    data = rng.randn(n_epochs, n_signals, n_times)
+    # add some shared signal so that connectivity is not only noise
+    data[:, 1, :] += 0.5 * data[:, 0, :]
+    return data
+
+
+def test_multi_band_conmat(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs()
+    sfreq = 100.
+    bands = [[8., 12.], [15., 30.]]
+    conmat_files = compute_and_save_spectral_connectivity(
+        data, 'coh', sfreq, fmin=[b[0] for b in bands],
+        fmax=[b[1] for b in bands], freq_band_names=['alpha', 'beta'])
+    assert len(conmat_files) == 2
+    for band, conmat_file in zip(bands, conmat_files):
+        single_file = compute_and_save_spectral_connectivity(
+            data, 'coh', sfreq, fmin=band[0], fmax=band[1])
+        np.testing.assert_allclose(np.load(conmat_file),
+                                   np.load(single_file))
+
+
+def test_multi_method_conmat(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs()
+    sfreq = 100.
+    methods = ['coh', 'imcoh', 'wpli', 'plv']
+    conmat_files = compute_and_save_spectral_connectivity(
+        data, methods, sfreq, fmin=8., fmax=12.)
+    assert len(conmat_files) == len(methods)
+    conmats = [np.load(conmat_file) for conmat_file in conmat_files]
+    for method, conmat in zip(methods, conmats):
+        single_file = compute_and_save_spectral_connectivity(
+            data, method, sfreq, fmin=8., fmax=12.)
+        np.testing.assert_allclose(conmat, np.load(single_file))
+
+
+def test_numpy_backend_matches_mne(tmpdir):
+    from mne.connectivity import spectral_connectivity
+    data = _make_epochs()
+    sfreq = 100.
+    methods = ['coh', 'cohy', 'imcoh', 'plv', 'ppc', 'pli', 'pli2_unbiased',
+               'wpli', 'wpli2_debiased']
+    cons, _ = spectral_connectivity_numpy(data, methods, sfreq,
+                                          fmin=[8., 15.], fmax=[12., 30.])
+    ref_cons, _, _, _, _ = spectral_connectivity(
+        data, method=methods, sfreq=sfreq, fmin=(8., 15.), fmax=(12., 30.),
+        faverage=True, mt_adaptive=False)
+    for con, ref_con in zip(cons, ref_cons):
+        np.testing.assert_allclose(con, ref_con, atol=1e-10)
+
+
+def test_numpy_backend_windowed(tmpdir):
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(1)
+    ts_file = os.path.abspath('win_ts.npy')
+    np.save(ts_file, rng.randn(3, 4, 5, 200))
+    ref_file = multiple_windowed_spectral_proc(ts_file, 100., [10., 30.],
+                                               'coh')
+    ref_conmats = np.load(ref_file)
+    conmat_file = multiple_windowed_spectral_proc(ts_file, 100., [10., 30.],
+                                                  'coh', backend='numpy')
+    np.testing.assert_allclose(np.load(conmat_file), ref_conmats, atol=1e-10)
+
+
+def test_numpy_backend_n_jobs():
+    data = _make_epochs(n_epochs=12)
+    methods = ['coh', 'wpli2_debiased']
+    # single group: epochs are spread over the processes
+    cons, _ = spectral_connectivity_numpy(data, methods, 100., 10., 30.)
+    par_cons, _ = spectral_connectivity_numpy(data, methods, 100., 10., 30.,
+                                              n_jobs=3)
+    for con, par_con in zip(cons, par_cons):
+        np.testing.assert_allclose(par_con, con, atol=1e-12)
+
+
+@pytest.mark.parametrize('con_method', ['coh', 'imcoh'])
+def test_seed_pairs_conmat(tmpdir, con_method):
+    os.chdir(str(tmpdir))
+    data = _make_epochs()
+    dense_file = compute_and_save_spectral_connectivity(data, con_method,
+                                                        100., 10., 30.)
+    dense_conmat = np.load(dense_file)
+    indices = get_seed_target_indices([3, 1], data.shape[1])
+    # each seed-target pair is computed once, without self connections
+    assert len(indices[0]) == 2 * data.shape[1] - 3
+    # pairs with seed < target are moved to the lower triangle (imcoh negated)
+    assert np.any(indices[0] < indices[1])
+    for backend in ['mne', 'numpy']:
+        pairs_file = compute_and_save_spectral_connectivity(
+            data, con_method, 100., 10., 30., backend=backend,
+            indices=indices)
+        assert pairs_file.endswith('_pairs.npz')
+        conmat = load_conmat_pairs(pairs_file, dense=True)
+        mask = conmat != 0
+        np.testing.assert_allclose(conmat[mask], dense_conmat[mask],
+                                   atol=1e-10)
+        assert mask.sum() == len(indices[0])
+
+
+def test_packed_conmat(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs()
+    dense_file = compute_and_save_spectral_connectivity(data, 'coh', 100.,
+                                                        10., 30.)
+    packed_file = compute_and_save_spectral_connectivity(
+        data, 'coh', 100., 10., 30., conmat_format='packed')
+    assert packed_file.endswith('_packed.npz')
+    header = load_packed_conmat_header(packed_file)
+    assert header['con_method'] == 'coh'
+    assert header['freq_band'] == [10., 30.]
+    assert header['sfreq'] == 100.
+    assert header['n_labels'] == data.shape[1]
+    dense_conmat = np.load(dense_file)
+    conmat = load_packed_conmat(packed_file)
+    assert conmat.dtype == np.float32
+    np.testing.assert_allclose(conmat, dense_conmat, rtol=1e-6)
+    np.testing.assert_allclose(load_packed_conmat(packed_file,
+                                                  symmetric=True),
+                               dense_conmat + dense_conmat.T, rtol=1e-6)
+    # antisymmetric metric: the upper triangle is negated
+    packed_file = compute_and_save_spectral_connectivity(
+        data, 'imcoh', 100., 10., 30., conmat_format='packed')
+    dense_conmat = np.load(compute_and_save_spectral_connectivity(
+        data, 'imcoh', 100., 10., 30.))
+    np.testing.assert_allclose(load_packed_conmat(packed_file,
+                                                  symmetric=True),
+                               dense_conmat - dense_conmat.T, rtol=1e-5,
+                               atol=1e-7)
+
+
+def test_streamed_conmat(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs(n_epochs=11)
+    ref_file = compute_and_save_spectral_connectivity(
+        data, ['coh', 'wpli'], 100., [8., 15.], [12., 30.], backend='numpy')
+    ref_conmats = [np.load(f) for f in ref_file]
+    ts_file = os.path.abspath('epo_ts.npy')
+    np.save(ts_file, data)
+    conmat_files = compute_and_save_streamed_spectral_connectivity(
+        ts_file, ['coh', 'wpli'], 100., [8., 15.], [12., 30.],
+        n_epochs_chunk=4)
+    for conmat_file, ref_conmat in zip(conmat_files, ref_conmats):
+        np.testing.assert_allclose(np.load(conmat_file), ref_conmat,
+                                   atol=1e-10)
+    # continuous recording cut in windows of 5s (the rest is discarded)
+    ts_file = os.path.abspath('raw_ts.npy')
+    np.save(ts_file, np.hstack(list(data)))
+    conmat_file = compute_and_save_streamed_spectral_connectivity(
+        ts_file, 'coh', 100., 8., 12., epoch_window_length=5.,
+        n_epochs_chunk=3)
+    np.testing.assert_allclose(np.load(conmat_file), ref_conmats[0],
+                               atol=1e-10)
+
+
+
+
+def test_streaming_node_inputs(tmpdir):
+    from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+    os.chdir(str(tmpdir))
+    ts_file = os.path.abspath('raw_ts.npy')
+    np.save(ts_file, np.hstack(list(_make_epochs(n_epochs=2))))
+    spectral_node = SpectralConn()
+    spectral_node.inputs.ts_file = ts_file
+    spectral_node.inputs.sfreq = 100.
+    spectral_node.inputs.freq_band = [8., 12.]
+    spectral_node.inputs.con_method = 'coh'
+    spectral_node.inputs.streaming = True
+    # continuous data without epoch_window_length
+    with pytest.raises(ValueError):
+        spectral_node._run_interface(None)
+    with pytest.raises(ValueError):
+        compute_and_save_streamed_spectral_connectivity(ts_file, 'coh', 100.,
+                                                        8., 12.)
+    spectral_node.inputs.epoch_window_length = 2.
+    spectral_node.inputs.con_method = 'aec'
+    with pytest.raises(ValueError):
+        spectral_node._run_interface(None)
+
+
+def test_overlapping_epochs(tmpdir):
+    from neuropype_ephy.interfaces.mne.spectral import SpectralConn
+    os.chdir(str(tmpdir))
+    raw_data = np.hstack(list(_make_epochs(n_epochs=4)))
+    ts_file = os.path.abspath('raw_ts.npy')
+    np.save(ts_file, raw_data)
+    mmap_data = np.load(ts_file, mmap_mode='r')
+    # half-overlapping windows of 2s: views on the memory-mapped recording
+    epochs = epoch_continuous_data(mmap_data, 100., 2., 0.5)
+    ref_epochs = np.array([raw_data[:, start:start + 200]
+                           for start in range(0, 2000 - 200 + 1, 100)])
+    assert epochs.shape == ref_epochs.shape
+    assert np.may_share_memory(epochs, mmap_data)
+    np.testing.assert_array_equal(epochs, ref_epochs)
+    np.testing.assert_array_equal(
+        epoch_continuous_data(raw_data[:, :-50], 100., 5.),
+        np.array(np.split(raw_data[:, :1500], 3, axis=1)))
+    ref_file = compute_and_save_spectral_connectivity(
+        ref_epochs, 'coh', 100., 8., 12., backend='numpy')
+    ref_conmat = np.load(ref_file)
+    spectral_node = SpectralConn()
+    spectral_node.inputs.ts_file = ts_file
+    spectral_node.inputs.sfreq = 100.
+    spectral_node.inputs.freq_band = [8., 12.]
+    spectral_node.inputs.con_method = 'coh'
+    spectral_node.inputs.epoch_window_length = 2.
+    spectral_node.inputs.epoch_overlap = 0.5
+    spectral_node.inputs.backend = 'numpy'
+    conmat_file = spectral_node.run().outputs.conmat_file
+    np.testing.assert_allclose(np.load(conmat_file), ref_conmat, atol=1e-10)
+    conmat_file = compute_and_save_streamed_spectral_connectivity(
+        ts_file, 'coh', 100., 8., 12., epoch_window_length=2.,
+        epoch_overlap=0.5, n_epochs_chunk=4)
+    np.testing.assert_allclose(np.load(conmat_file), ref_conmat, atol=1e-10)
+
+
+def test_dynamic_conmat(tmpdir):
+    from mne.connectivity import spectral_connectivity
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(2)
+    ts_file = os.path.abspath('trials_ts.npy')
+    data = rng.randn(2, 4, 1000)
+    np.save(ts_file, data)
+    # 2s windows every 1s (50% overlap), 1s segments shared by the windows
+    conmat_file = multiple_dynamic_spectral_proc(ts_file, 100., [10., 30.],
+                                                 'wpli', win_length=2.,
+                                                 win_step=1.)
+    conmats = np.load(conmat_file)
+    assert conmats.shape == (2, 9, 4, 4)
+    # each window is the connectivity over its segments taken as epochs
+    segs = data[1, :, 300:500].reshape(4, 2, 100).transpose(1, 0, 2)
+    ref_con = spectral_connectivity(segs, method='wpli', sfreq=100.,
+                                    fmin=10., fmax=30., faverage=True,
+                                    mt_adaptive=False)[0]
+    np.testing.assert_allclose(conmats[1, 3], ref_con[:, :, 0], atol=1e-10)
+
+
+
+def test_sliding_window_estimator():
+    from neuropype_ephy.spectral_engine import \
+        sliding_window_connectivity_numpy
+    rng = np.random.RandomState(0)
+    data = rng.randn(4, 1000)
+    data[1] += 0.5 * data[0]
+    # win_step multiple of win_length: single-epoch estimator of each window
+    cons = sliding_window_connectivity_numpy(data, 'coh', 100., 10., 30.,
+                                             win_length=200, win_step=200)[0]
+    windows = data.reshape(4, 5, 200).transpose(1, 0, 2)
+    ref_cons = spectral_connectivity_numpy(windows[:, np.newaxis], 'coh', 100.,
+                                           10., 30.)[0]
+    np.testing.assert_allclose(cons, ref_cons, atol=1e-10)
+    # overlapping windows: segments of gcd(200, 50) samples as epochs
+    cons = sliding_window_connectivity_numpy(data, 'coh', 100., 10., 30.,
+                                             win_length=200, win_step=50)[0]
+    for i_win in [0, 5, 16]:
+        segs = data[:, 50 * i_win:50 * i_win + 200].reshape(4, 4, 50)
+        ref_con = spectral_connectivity_numpy(segs.transpose(1, 0, 2), 'coh',
+                                              100., 10., 30.)[0]
+        np.testing.assert_allclose(cons[i_win], ref_con, atol=1e-10)
+    # 10 samples segments: less than 5 cycles at 10 Hz
+    with pytest.raises(ValueError):
+        sliding_window_connectivity_numpy(data, 'coh', 100., 10., 30.,
+                                          win_length=200, win_step=70)
+
+
+@pytest.mark.parametrize('max_block_bytes', [20000, 2000])
+def test_numpy_backend_cwt_morlet(tmpdir, monkeypatch, max_block_bytes):
+    from mne.connectivity import spectral_connectivity
+    from neuropype_ephy import spectral_engine
+    os.chdir(str(tmpdir))
+    data = _make_epochs(n_epochs=6, n_times=300)
+    # small blocks: several blocks of time points and of node pairs, and
+    # FFTs by blocks of epochs (or of single signals with 2000 bytes)
+    monkeypatch.setattr(spectral_engine, 'max_block_bytes', max_block_bytes)
+    conmat_files = compute_and_save_spectral_connectivity(
+        data, ['coh', 'wpli'], 100., [8., 15.], [12., 30.],
+        mode='cwt_morlet', backend='numpy')
+    freqs = np.unique(np.concatenate([np.arange(8., 12.),
+                                      np.arange(15., 30.)]))
+    ref_cons = spectral_connectivity(
+        data, ['coh', 'wpli'], sfreq=100., mode='cwt_morlet',
+        cwt_freqs=freqs, cwt_n_cycles=freqs / 7., fmin=(8., 15.),
+        fmax=(12., 30.), faverage=True)[0]
+    for i, ref_con in enumerate(ref_cons):
+        for j in range(2):
+            np.testing.assert_allclose(np.load(conmat_files[2 * i + j]),
+                                       np.mean(ref_con[:, :, j], axis=-1),
+                                       atol=1e-10)
+
+
+
+def test_cwt_morlet_single_band_grid(tmpdir):
+    from mne.connectivity import spectral_connectivity
+    os.chdir(str(tmpdir))
+    data = _make_epochs(n_epochs=4, n_signals=3, n_times=200)
+    # fmin below 5 cycles (2.5 Hz): grid 3, 4, ... of the original code
+    conmat_file = compute_and_save_spectral_connectivity(
+        data, 'coh', 100., 2., 8., mode='cwt_morlet', backend='numpy')
+    freqs = np.arange(2., 8., 1)
+    ref_con = spectral_connectivity(
+        data, 'coh', sfreq=100., mode='cwt_morlet', cwt_freqs=freqs,
+        cwt_n_cycles=freqs / 7., faverage=True, verbose=False)[0]
+    np.testing.assert_allclose(np.load(conmat_file),
+                               np.mean(ref_con[:, :, 0], axis=-1), atol=1e-10)
+
+
+def test_cwt_morlet_adjacent_bands(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs(n_epochs=4, n_signals=3, n_times=300)
+    conmat_files = compute_and_save_spectral_connectivity(
+        data, ['coh', 'wpli'], 100., [8., 13.], [13., 30.],
+        mode='cwt_morlet', backend='numpy')
+    # each band as computed alone (13 Hz only in the second band)
+    for i, (fmin, fmax) in enumerate([(8., 13.), (13., 30.)]):
+        os.mkdir('band_{}'.format(i))
+        os.chdir('band_{}'.format(i))
+        band_files = compute_and_save_spectral_connectivity(
+            data, ['coh', 'wpli'], 100., fmin, fmax, mode='cwt_morlet',
+            backend='numpy')
+        os.chdir('..')
+        for j, band_file in enumerate(band_files):
+            np.testing.assert_allclose(np.load(conmat_files[2 * j + i]),
+                                       np.load(band_file), atol=1e-12)
+
+
+def test_float32_conmat(tmpdir):
+    os.chdir(str(tmpdir))
+    data = _make_epochs()
+    for backend in ['mne', 'numpy']:
+        conmat_files = compute_and_save_spectral_connectivity(
+            data, ['coh', 'cohy'], 100., 10., 30., backend=backend)
+        f32_files = compute_and_save_spectral_connectivity(
+            data.astype(np.float32), ['coh', 'cohy'], 100., 10., 30.,
+            backend=backend, dtype='float32')
+        for conmat_file, f32_file, f32_dtype in zip(
+                conmat_files, f32_files, [np.float32, np.complex64]):
+            conmat = np.load(conmat_file)
+            f32_conmat = np.load(f32_file)
+            assert f32_conmat.dtype == f32_dtype
+            np.testing.assert_allclose(f32_conmat, conmat, atol=1e-5)
+
+
+
+@pytest.mark.parametrize('n_times', [300, 301])
+def test_float32_fft(n_times):
+    from neuropype_ephy.spectral_engine import (_rfft,
+                                                spectral_connectivity_morlet)
+    data = _make_epochs(n_epochs=4, n_times=n_times)
+    x_fft = _rfft(data.astype(np.float32))
+    assert x_fft.dtype == np.complex64
+    ref_fft = np.fft.rfft(data, axis=-1)
+    np.testing.assert_allclose(x_fft, ref_fft,
+                               atol=1e-4 * np.abs(ref_fft).max())
+    freqs = np.arange(10., 30.)
+    con = spectral_connectivity_morlet(data, 'coh', 100., 10., 30., freqs,
+                                       n_cycles=freqs / 7.)[0]
+    f32_con = spectral_connectivity_morlet(data.astype(np.float32), 'coh',
+                                           100., 10., 30., freqs,
+                                           n_cycles=freqs / 7.)[0]
+    assert f32_con.dtype == np.float32
+    np.testing.assert_allclose(f32_con, con, atol=1e-5)
+
+
+def test_filter_adj_plot_mat(tmpdir):
+    from itertools import combinations
+    os.chdir(str(tmpdir))
+    labels = ["A-1", "A-2", "A-3", "A-5", "B-1", "B-2", "A-4", "B-3"]
+    with open('labels.txt', 'w') as f:
+        f.write("\n".join(labels))
+    split_labels = [label.split('-') for label in labels]
+    triu_indices = np.triu_indices(len(labels), 1)
+    for k_neigh in [1, 2]:
+        # previous implementation
+        ref_adj_mat = np.zeros((len(labels), len(labels)), dtype=bool)
+        for i in range(k_neigh):
+            ref_adj_mat[triu_indices] += [
+                a[0] == b[0] and int(a[1]) + i + 1 == int(b[1])
+                for a, b in combinations(split_labels, 2)]
+        adj_mat = get_contact_adjacency_mask('labels.txt', '-', k_neigh)
+        np.testing.assert_array_equal(adj_mat, ref_adj_mat)
+        assert get_contact_adjacency_mask('labels.txt', '-', k_neigh) is \
+            adj_mat
+    conmat = np.tril(np.random.RandomState(0).rand(8, 8), -1)
+    np.save('conmat.npy', conmat)
+    filtered_conmat = np.load(filter_adj_plot_mat('conmat.npy', 'labels.txt',
+                                                  '-', 1))
+    ref_conmat = conmat.copy()
+    ref_conmat[[1, 2, 5, 6, 7], [0, 1, 4, 2, 5]] = 0.
+    np.testing.assert_array_equal(filtered_conmat, ref_conmat)
+    # stack of conmats
+    np.save('conmats.npy', np.array([[conmat, 2 * conmat]]))
+    filtered_conmats = np.load(filter_adj_plot_mat('conmats.npy',
+                                                   'labels.txt', '-', 1))
+    np.testing.assert_array_equal(filtered_conmats[0, 1], 2 * ref_conmat)
+
+
+def test_plot_circular_connectivity_batch(tmpdir):
+    import matplotlib
+    matplotlib.use('Agg')
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    conmat = np.tril(rng.rand(12, 12), -1)
+    (rows, cols), values = select_top_edges(conmat, 5)
+    np.testing.assert_array_equal(np.sort(values),
+                                  np.sort(conmat.ravel())[-5:])
+    assert np.all(rows > cols)
+    conmat_files = []
+    for i in range(3):
+        np.save('conmat_{}.npy'.format(i), conmat * (i + 1))
+        conmat_files.append(os.path.abspath('conmat_{}.npy'.format(i)))
+    # same file name in another directory (e.g. MapNode iterations)
+    os.mkdir('iter_1')
+    np.save(os.path.join('iter_1', 'conmat_0.npy'), conmat)
+    conmat_files.append(os.path.abspath(os.path.join('iter_1',
+                                                     'conmat_0.npy')))
+    names = ['node{}'.format(i) for i in range(12)]
+    plot_files = plot_circular_connectivity_batch(conmat_files, names, None,
+                                                  names, nb_lines=5)
+    assert [os.path.basename(f) for f in plot_files] == [
+        'circle_0_conmat_0.png', 'circle_1_conmat_1.png',
+        'circle_2_conmat_2.png', 'circle_3_conmat_0.png']
+    assert all(os.path.getsize(f) > 0 for f in plot_files)
+
+
+def test_get_plot_labels(tmpdir, monkeypatch):
+    import mne
+    import pickle
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    labels = []
+    for name in ['a', 'b', 'c']:
+        for hemi in ['lh', 'rh']:
+            labels.append(mne.Label(np.arange(4), pos=rng.rand(4, 3),
+                                    hemi=hemi, name=name + '-' + hemi,
+                                    color=tuple(rng.rand(4))))
+    labels.append(mne.Label(np.arange(4), pos=rng.rand(4, 3), hemi='lh',
+                            name='Brain-Stem', color=(0., 0., 0., 1.)))
+    with open('labels.pkl', 'wb') as f:
+        pickle.dump(len(labels), f)
+        for label in labels:
+            pickle.dump(label, f)
+    plot_labels = get_plot_labels('labels.pkl')
+    assert plot_labels['label_names'] == [label.name for label in labels]
+    lh_ypos = [(np.mean(label.pos, axis=0)[1], label.name) for label in labels
+               if label.hemi == 'lh']
+    lh_order = [name for (_, name) in sorted(lh_ypos)]
+    assert plot_labels['node_order'] == lh_order[::-1] + [
+        name[:-2] + 'rh' for name in lh_order if name != 'Brain-Stem']
+    np.testing.assert_allclose(plot_labels['node_colors'][0], labels[0].color)
+    # parsed once, then reused from memory and from the sidecar file
+    assert os.path.exists('labels.pkl.parsed.npz')
+    assert get_plot_labels('labels.pkl') is plot_labels
+    spectral._plot_labels_cache.clear()
+    monkeypatch.setattr(spectral, '_parse_plot_labels', None)
+    reloaded = get_plot_labels('labels.pkl')
+    assert reloaded is not plot_labels
+    assert reloaded['node_order'] == plot_labels['node_order']
+    np.testing.assert_array_equal(reloaded['centroids'],
+                                  plot_labels['centroids'])
+    # no temporary file left, truncated sidecar parsed again
+    assert sorted(os.listdir('.')) == ['labels.pkl', 'labels.pkl.parsed.npz']
+    with open('labels.pkl.parsed.npz', 'r+b') as f:
+        f.truncate(20)
+    spectral._plot_labels_cache.clear()
+    monkeypatch.undo()
+    reparsed = get_plot_labels('labels.pkl')
+    assert reparsed['node_order'] == plot_labels['node_order']
+    assert np.load('labels.pkl.parsed.npz')['node_order'].shape == (7,)
@@ -0,0 +1,80 @@
+from neuropype_ephy import surrogates
+from neuropype_ephy.spectral import compute_and_save_surrogate_connectivity
+from neuropype_ephy.spectral_engine import spectral_connectivity_numpy
+from neuropype_ephy.surrogates import (compute_surrogate_stats,
+                                       surrogate_connectivity_numpy)
+import numpy as np
+import os
+import pytest
+
+
+def _coupled_data():
+    rng = np.random.RandomState(0)
+    data = rng.randn(20, 4, 200)
+    data[:, 1] += data[:, 0]
+    return data
+
+
+@pytest.mark.parametrize('surrogate_type', ['phase', 'time_shift'])
+def test_surrogate_connectivity(surrogate_type, monkeypatch):
+    data = _coupled_data()
+    methods = ['coh', 'imcoh', 'plv', 'wpli2_debiased']
+    # several batches
+    monkeypatch.setattr(surrogates, 'max_batch_size', 7)
+    cons, null_cons, freqs = surrogate_connectivity_numpy(
+        data, methods, 100., [8., 20.], [13., 30.], n_surrogates=30,
+        surrogate_type=surrogate_type, random_state=42)
+    ref_cons, ref_freqs = spectral_connectivity_numpy(
+        data, methods, 100., [8., 20.], [13., 30.])
+    np.testing.assert_allclose(freqs, ref_freqs)
+    for con, null_con, ref_con in zip(cons, null_cons, ref_cons):
+        np.testing.assert_allclose(con, ref_con, atol=1e-12)
+        assert null_con.shape == (30,) + con.shape
+        assert np.all(null_con[:, np.triu_indices(4)[0],
+                               np.triu_indices(4)[1]] == 0.)
+    p_values, null_percentiles = compute_surrogate_stats(cons[0],
+                                                         null_cons[0])
+    assert null_percentiles.shape == (2,) + cons[0].shape
+    # coupled edge above all the surrogates, not the others
+    assert np.all(p_values[1, 0] == 1. / 31)
+    assert np.mean(p_values[[2, 3, 3], [0, 0, 2]]) > 0.2
+    # same surrogates for pairs
+    indices = (np.array([1, 3]), np.array([0, 2]))
+    pair_cons, pair_null_cons, _ = surrogate_connectivity_numpy(
+        data, methods, 100., [8., 20.], [13., 30.], n_surrogates=30,
+        surrogate_type=surrogate_type, random_state=42, indices=indices)
+    for null_con, pair_null_con in zip(null_cons, pair_null_cons):
+        np.testing.assert_allclose(pair_null_con, null_con[:, indices[0],
+                                                           indices[1]],
+                                   atol=1e-12)
+
+
+def test_time_shift_surrogate_blocks(monkeypatch):
+    rng = np.random.RandomState(0)
+    x_mt = (rng.randn(6, 5, 4, 2) + 1j * rng.randn(6, 5, 4, 2))
+    methods = ['coh', 'wpli']
+    freq_idx_bands = [np.arange(3), np.arange(3, 5)]
+    ref_null_cons = surrogates._time_shift_surrogate_batch(
+        x_mt, methods, 9, 0, freq_idx_bands)
+    # shifted spectra gathered two surrogates at a time
+    monkeypatch.setattr(surrogates.spectral_engine, 'max_block_bytes',
+                        2 * x_mt.nbytes)
+    null_cons = surrogates._time_shift_surrogate_batch(
+        x_mt, methods, 9, 0, freq_idx_bands)
+    for null_con, ref_null_con in zip(null_cons, ref_null_cons):
+        assert null_con.shape == (9, 4, 4, 2)
+        np.testing.assert_allclose(null_con, ref_null_con, atol=1e-12)
+
+
+def test_compute_and_save_surrogate_connectivity(tmpdir):
+    os.chdir(str(tmpdir))
+    stats_file = compute_and_save_surrogate_connectivity(
+        _coupled_data(), 'coh', 100., 8., 13., n_surrogates=20,
+        random_state=0)
+    assert os.path.basename(stats_file) == 'conmat_0_coh_surrogates.npz'
+    stats = np.load(stats_file)
+    assert stats['con'].shape == (4, 4)
+    assert stats['p_values'][1, 0] == 1. / 21
+    assert stats['null_percentiles'].shape == (2, 4, 4)
+    assert np.all(stats['null_percentiles'][1] >=
+                  stats['null_percentiles'][0])
@@ -0,0 +1,95 @@
+from mne.time_frequency.multitaper import dpss_windows
+from mne.time_frequency.tfr import morlet
+from neuropype_ephy import window_cache
+from neuropype_ephy.spectral import compute_and_save_spectral_connectivity
+import numpy as np
+import os
+import pytest
+
+
+@pytest.fixture
+def tmp_cache(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.mkdir('window_cache'))
+    monkeypatch.setattr(window_cache, 'cache_dir', cache_dir)
+    window_cache.clear_memory_cache()
+    yield cache_dir
+    window_cache.clear_memory_cache()
+
+
+def test_dpss_cache(tmp_cache):
+    ref_tapers, ref_eigvals = dpss_windows(500, 4., 8)
+    tapers, eigvals = window_cache.get_dpss_windows(500, 4., 8)
+    np.testing.assert_array_equal(tapers, ref_tapers)
+    np.testing.assert_array_equal(eigvals, ref_eigvals)
+    assert len(os.listdir(tmp_cache)) == 1
+    # read back from disk
+    window_cache.clear_memory_cache()
+    tapers, eigvals = window_cache.get_dpss_windows(500, 4., 8)
+    np.testing.assert_array_equal(tapers, ref_tapers)
+
+
+def test_morlet_cache(tmp_cache):
+    freqs = np.arange(10., 20.)
+    ref_wavelets = morlet(100., freqs, n_cycles=freqs / 7., zero_mean=True)
+    for _ in range(2):
+        wavelets = window_cache.get_morlet_wavelets(100., freqs, freqs / 7.,
+                                                    zero_mean=True)
+        for wavelet, ref_wavelet in zip(wavelets, ref_wavelets):
+            np.testing.assert_array_equal(wavelet, ref_wavelet)
+
+
+def test_disk_cache_eviction(tmp_cache, monkeypatch):
+    monkeypatch.setattr(window_cache, 'max_disk_items', 2)
+    for n_times in [100, 200, 300]:
+        window_cache.get_dpss_windows(n_times, 4., 8)
+    assert len(os.listdir(tmp_cache)) == 2
+
+
+def test_cached_spectral_connectivity(tmp_cache, tmpdir):
+    from mne.connectivity import spectral_connectivity
+    import mne.connectivity.spectral as mne_con_spectral
+    os.chdir(str(tmpdir))
+    rng = np.random.RandomState(0)
+    data = rng.randn(5, 3, 400)
+    # first call fills the cache, second one reads from it
+    conmats = [np.load(compute_and_save_spectral_connectivity(
+        data, 'coh', 100., 10., 30.)) for _ in range(2)]
+    np.testing.assert_array_equal(conmats[0], conmats[1])
+    assert len(os.listdir(tmp_cache)) == 1
+    freqs = np.arange(10., 30.)
+    ref_con = spectral_connectivity(data, 'coh', sfreq=100., mode='cwt_morlet',
+                                    cwt_freqs=freqs, cwt_n_cycles=freqs / 7.)[0]
+    with window_cache.cached_spectral_windows():
+        con = spectral_connectivity(data, 'coh', sfreq=100.,
+                                    mode='cwt_morlet', cwt_freqs=freqs,
+                                    cwt_n_cycles=freqs / 7.)[0]
+    np.testing.assert_array_equal(con, ref_con)
+    assert len(os.listdir(tmp_cache)) == 2
+    # mne functions are restored after the computation
+    assert mne_con_spectral.morlet is morlet
+
+
+def test_no_disk_cache(monkeypatch):
+    from mne.connectivity import spectral_connectivity
+    from mne.time_frequency import multitaper
+    import mne.connectivity.spectral as mne_con_spectral
+    monkeypatch.setattr(window_cache, 'cache_dir', None)
+    window_cache.clear_memory_cache()
+    data = np.random.RandomState(0).randn(5, 3, 400)
+    n_calls = []
+    monkeypatch.setattr(window_cache, '_mne_dpss_windows',
+                        lambda *args, **kwargs: n_calls.append(1) or
+                        dpss_windows(*args, **kwargs))
+    # the in-process cache is used by mne without disk cache
+    with window_cache.cached_spectral_windows():
+        for _ in range(2):
+            spectral_connectivity(data, 'coh', sfreq=100., fmin=10.,
+                                  fmax=30., verbose=False)
+        # nested blocks keep the cached functions until the outermost exits
+        with window_cache.cached_spectral_windows():
+            assert mne_con_spectral.morlet is not morlet
+        assert multitaper.dpss_windows is window_cache.get_dpss_windows
+    assert len(n_calls) == 1
+    assert multitaper.dpss_windows is window_cache._mne_dpss_windows
+    assert mne_con_spectral.morlet is morlet
+    window_cache.clear_memory_cache()
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of DPSS tapers and Morlet wavelet banks
+
+Tapers and wavelets only depend on a few parameters (number of samples,
+half bandwidth, sfreq, frequencies and cycles), which are the same for all
+the iterations of a MapNode. They are kept in an in-process LRU cache, so
+that they are computed once per set of parameters instead of once per call.
+
+The disk cache is opt-in: when cache_dir is set (by default from the
+NEUROPYPE_EPHY_CACHE_DIR environment variable, None when it is not
+defined), the banks are also stored there (one .npz file per bank, the
+least recently used files being removed beyond max_disk_items), to be
+shared between processes.
+
+The numpy engine passes the cached windows explicitly (get_dpss_windows,
+get_morlet_wavelets). mne functions (e.g. spectral_connectivity,
+psd_multitaper) have no parameter for precomputed windows: inside a
+cached_spectral_windows() block, the mne window functions are replaced by
+the cached ones (the originals being restored when the outermost block of
+all threads exits).
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from mne.time_frequency import multitaper as _mne_multitaper
+from mne.time_frequency.tfr import morlet as _mne_morlet
+
+# directory of the on-disk cache (None: in-process cache only)
+cache_dir = os.environ.get('NEUROPYPE_EPHY_CACHE_DIR')
+
+max_memory_items = 32
+max_disk_items = 512
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+_mne_dpss_windows = _mne_multitaper.dpss_windows
+
+# number of cached_spectral_windows blocks being executed (all threads)
+_patch_lock = threading.Lock()
+_patch_depth = [0]
+
+
+def _hash_arrays(*arrays):
+    """ Short hash of the values of arrays """
+    sha = hashlib.sha1()
+    for array in arrays:
+        sha.update(np.ascontiguousarray(array, dtype=float).tostring())
+    return sha.hexdigest()[:16]
+
+
+def _evict_disk_cache():
+    """ Remove the least recently used files beyond max_disk_items """
+    cache_files = [os.path.join(cache_dir, fname)
+                   for fname in os.listdir(cache_dir)
+                   if fname.endswith('.npz') and
+                   not fname.startswith('.tmp_')]
+
+    if len(cache_files) <= max_disk_items:
+        return
+
+    cache_files.sort(key=os.path.getmtime)
+
+    for cache_file in cache_files[:len(cache_files) - max_disk_items]:
+        try:
+            os.remove(cache_file)
+        except OSError:
+            # already removed by another process
+            pass
+
+
+def _load_disk_cache(key):
+    """ List of arrays stored for key, or None """
+    if cache_dir is None:
+        return None
+
+    cache_file = os.path.join(cache_dir, key + '.npz')
+
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        arrays = np.load(cache_file)
+        value = [arrays['arr_%d' % i] for i in range(len(arrays.files))]
+    except (IOError, ValueError, KeyError):
+        # partially written or corrupted file, computed again
+        return None
+
+    # the modification time is used as last access time for eviction
+    os.utime(cache_file, None)
+
+    return value
+
+
+def _save_disk_cache(key, value):
+    """ Store the list of arrays value for key (atomic rename) """
+    if cache_dir is None:
+        return
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir,
+                                        prefix='.tmp_')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, *value)
+        os.rename(tmp_file, os.path.join(cache_dir, key + '.npz'))
+
+        _evict_disk_cache()
+
+    except (IOError, OSError):
+        # read-only or full disk, the cache is only in memory
+        pass
+
+
+def get_cached(key, compute):
+    """
+    Value (list of arrays) for key, from the in-process LRU cache, the disk
+    cache, or computed by compute() and stored in both
+    """
+    with _memory_lock:
+        if key in _memory_cache:
+            value = _memory_cache.pop(key)
+            _memory_cache[key] = value
+            return value
+
+    value = _load_disk_cache(key)
+
+    if value is None:
+        value = [np.asarray(array) for array in compute()]
+        _save_disk_cache(key, value)
+
+    with _memory_lock:
+        _memory_cache[key] = value
+
+        while len(_memory_cache) > max_memory_items:
+            _memory_cache.popitem(last=False)
+
+    return value
+
+
+def clear_memory_cache():
+    """ Empty the in-process cache """
+    _memory_cache.clear()
+
+
+def get_dpss_windows(N, half_nbw, Kmax, low_bias=True, interp_from=None,
+                     interp_kind='linear'):
+    """
+    Cached version of mne.time_frequency.multitaper.dpss_windows (same
+    parameters and returned values); interpolated windows are not cached
+    """
+    if interp_from is not None:
+        return _mne_dpss_windows(N, half_nbw, Kmax, low_bias=low_bias,
+                                 interp_from=interp_from,
+                                 interp_kind=interp_kind)
+
+    key = 'dpss_{}_{}_{}_{}'.format(int(N), _hash_arrays([half_nbw]),
+                                    int(Kmax), int(bool(low_bias)))
+
+    tapers, eigvals = get_cached(key, lambda: _mne_dpss_windows(
+        N, half_nbw, Kmax, low_bias=low_bias))
+
+    # copies, so that the cached arrays are never modified in place
+    return tapers.copy(), eigvals.copy()
+
+
+def get_morlet_wavelets(sfreq, freqs, n_cycles=7.0, sigma=None,
+                        zero_mean=False):
+    """
+    Cached version of mne.time_frequency.tfr.morlet (same parameters and
+    returned list of wavelets)
+    """
+    sigma_values = [] if sigma is None else [sigma]
+
+    key = 'morlet_{}'.format(_hash_arrays([sfreq], freqs, np.ravel(n_cycles),
+                                          sigma_values, [bool(zero_mean)],
+                                          [sigma is None]))
+
+    wavelets = get_cached(key, lambda: _mne_morlet(
+        sfreq, freqs, n_cycles=n_cycles, sigma=sigma, zero_mean=zero_mean))
+
+    return [wavelet.copy() for wavelet in wavelets]
+
+
+@contextmanager
+def cached_spectral_windows():
+    """
+    Make mne spectral functions (spectral_connectivity, psd_multitaper...)
+    use the cached tapers and wavelets inside a with block (blocks can be
+    nested or run in several threads)
+    """
+    import mne.connectivity.spectral as mne_con_spectral
+
+    with _patch_lock:
+        if _patch_depth[0] == 0:
+            _mne_multitaper.dpss_windows = get_dpss_windows
+            mne_con_spectral.morlet = get_morlet_wavelets
+        _patch_depth[0] += 1
+
+    try:
+        yield
+    finally:
+        with _patch_lock:
+            _patch_depth[0] -= 1
+            if _patch_depth[0] == 0:
+                _mne_multitaper.dpss_windows = _mne_dpss_windows
+                mne_con_spectral.morlet = _mne_morlet